@@ -0,0 +1,246 @@
+"""In-memory indexes over the datasets, for the query API.
+
+The resources of the valid and geographic data packages are read once,
+with the types of their schemas, and indexed by the columns that are
+queried: municipality code, state, branch, sphere and portal type. A
+query looks up the rows in the smallest of the indexes of its filters
+and checks the other filters only on those rows. Municipality names are
+searched by normalized keys (without accents, case or punctuation),
+matching the whole name or the start of any of its words.
+
+Índices em memória sobre os conjuntos de dados, para a API de consulta.
+"""
+
+import bisect
+import csv
+import json
+import os
+import re
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from unidecode import unidecode
+
+DATA_PACKAGES = [
+    '../../data/valid/datapackage.json',
+    '../../data/auxiliary/geographic/datapackage.json',
+]
+# the resources served, by the name used in the API
+RESOURCES = {
+    'websites': 'brazilian-municipality-and-state-websites',
+    'portals': 'brazilian-transparency-and-open-data-portals',
+    'municipalities': 'municipality',
+    'states': 'uf',
+}
+INDEXED_COLUMNS = {
+    'websites': ['municipality_code', 'state_code', 'branch', 'sphere'],
+    'portals': ['municipality_code', 'state_code', 'branch', 'sphere', 'type'],
+    'municipalities': ['code', 'uf'],
+    'states': ['code', 'abbr'],
+}
+SEARCH_LIMIT = 20
+
+def normalize(text: str) -> str:
+    """Normalizes a name for searching: without accents, in lowercase and
+    with only letters, digits and single spaces.
+
+    Args:
+        text (str): The name.
+
+    Returns:
+        str: The normalized key.
+    """
+    return ' '.join(re.sub(r'[^a-z0-9 ]', ' ', unidecode(text).lower()).split())
+
+def read_resource(folder: str, descriptor: dict) -> List[dict]:
+    """Reads the CSV file of a resource, converting the values to the
+    types of its schema. Missing values are None.
+
+    Args:
+        folder (str): The folder of the data package.
+        descriptor (dict): The descriptor of the resource.
+
+    Returns:
+        List[dict]: The rows.
+    """
+    schema = descriptor.get('schema', {})
+    missing_values = set(schema.get('missingValues', ['']))
+    converters = {field['name']: {'integer': int, 'number': float}
+        .get(field.get('type'), str) for field in schema.get('fields', [])}
+    with open(os.path.join(folder, descriptor['path']), encoding='utf-8',
+            newline='') as csv_file:
+        return [{column: None if value in missing_values
+                else converters.get(column, str)(value)
+                for column, value in row.items()}
+            for row in csv.DictReader(csv_file)]
+
+def source_files(data_packages: List[str] = DATA_PACKAGES) -> List[str]:
+    """Lists the files the indexes are built from.
+
+    Args:
+        data_packages (List[str]): Paths to the datapackage.json files.
+
+    Returns:
+        List[str]: The paths to the datapackage.json and CSV files.
+    """
+    paths = []
+    for package_path in data_packages:
+        paths.append(package_path)
+        with open(package_path, encoding='utf-8') as package_file:
+            package = json.load(package_file)
+        paths.extend(os.path.join(os.path.dirname(package_path), resource['path'])
+            for resource in package['resources']
+            if resource['name'] in RESOURCES.values())
+    return paths
+
+def files_signature(paths: List[str]) -> Tuple:
+    """Gets a signature of the files that changes when any of them is
+    changed or replaced.
+
+    Args:
+        paths (List[str]): The paths to the files.
+
+    Returns:
+        Tuple: The modification time and size of each file.
+    """
+    signature = []
+    for path in paths:
+        status = os.stat(path)
+        signature.append((path, status.st_mtime_ns, status.st_size))
+    return tuple(signature)
+
+class DatasetIndex:
+    """The rows of the resources and their indexes. Not changed after it
+    is built, so it can be shared by the threads of the server and
+    replaced by a new one when the files change.
+
+    Args:
+        data_packages (List[str]): Paths to the datapackage.json files.
+    """
+    def __init__(self, data_packages: List[str] = DATA_PACKAGES):
+        self.signature = files_signature(source_files(data_packages))
+        self.loaded = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        self.tables: Dict[str, List[dict]] = {}
+        self.types: Dict[str, Dict[str, type]] = {}
+        for package_path in data_packages:
+            with open(package_path, encoding='utf-8') as package_file:
+                package = json.load(package_file)
+            for resource in package['resources']:
+                for name, resource_name in RESOURCES.items():
+                    if resource['name'] == resource_name:
+                        self.tables[name] = read_resource(
+                            os.path.dirname(package_path), resource)
+                        self.types[name] = {field['name']:
+                            int if field.get('type') == 'integer' else str
+                            for field in resource['schema']['fields']}
+        missing = set(RESOURCES) - set(self.tables)
+        if missing:
+            raise FileNotFoundError(f'Resources not found: {sorted(missing)}')
+
+        self.indexes: Dict[str, Dict[str, Dict[object, List[dict]]]] = {}
+        for name, columns in INDEXED_COLUMNS.items():
+            self.indexes[name] = {column: {} for column in columns}
+            for row in self.tables[name]:
+                for column in columns:
+                    if row[column] is not None:
+                        self.indexes[name][column] \
+                            .setdefault(row[column], []).append(row)
+
+        # keys for the whole name and for the name from each word on
+        keys = set()
+        for row in self.tables['municipalities']:
+            words = normalize(row['name']).split()
+            for position in range(len(words)):
+                keys.add((' '.join(words[position:]), position, row['code']))
+        self.name_keys = sorted(keys)
+
+    def counts(self) -> Dict[str, int]:
+        """Counts the rows of each resource.
+
+        Returns:
+            Dict[str, int]: The number of rows, by resource.
+        """
+        return {name: len(rows) for name, rows in self.tables.items()}
+
+    def query(self, name: str, filters: Dict[str, str]) -> List[dict]:
+        """Gets the rows of a resource matching all the filters.
+
+        Args:
+            name (str): The resource, e.g. "websites".
+            filters (Dict[str, str]): The value of each column, as given
+                in the query string. At least one of the columns must be
+                indexed.
+
+        Returns:
+            List[dict]: The rows, in the order of the CSV file.
+
+        Raises:
+            ValueError: If a column is unknown, a value has the wrong
+                type or no column is indexed.
+        """
+        if not filters:
+            return self.tables[name]
+        values = {}
+        for column, value in filters.items():
+            if column not in self.types[name]:
+                raise ValueError(f'Unknown column: {column}')
+            try:
+                values[column] = self.types[name][column](value)
+            except ValueError as error:
+                raise ValueError(f'Invalid value for {column}: {value}') \
+                    from error
+        indexed = [column for column in values if column in self.indexes[name]]
+        if not indexed:
+            raise ValueError('Filter by at least one of: ' +
+                ', '.join(INDEXED_COLUMNS[name]))
+        candidates = min((self.indexes[name][column].get(values[column], [])
+            for column in indexed), key=len)
+        return [row for row in candidates
+            if all(row[column] == value for column, value in values.items())]
+
+    def get(self, name: str, column: str, value) -> Optional[dict]:
+        """Gets the first row of a resource with a value in an indexed
+        column.
+
+        Args:
+            name (str): The resource.
+            column (str): The indexed column.
+            value: The value.
+
+        Returns:
+            dict: The row, or None if there is none.
+        """
+        rows = self.indexes[name][column].get(value)
+        return rows[0] if rows else None
+
+    def search(self, text: str, state: Optional[str] = None,
+        limit: int = SEARCH_LIMIT) -> List[dict]:
+        """Searches municipalities by name. Whole names matching the
+        text come first, then names starting with it, then names with a
+        word starting with it.
+
+        Args:
+            text (str): The text to search for.
+            state (str): Optional state abbreviation to search in.
+            limit (int): Maximum number of municipalities.
+
+        Returns:
+            List[dict]: The municipalities found.
+        """
+        key = normalize(text)
+        if not key:
+            return []
+        start = bisect.bisect_left(self.name_keys, (key,))
+        end = bisect.bisect_left(self.name_keys, (key + '￿',))
+        matches = sorted(self.name_keys[start:end],
+            key=lambda match: (match[1] > 0, match[0] != key, match[0]))
+        found, codes = [], set()
+        for _, _, code in matches:
+            municipality = self.get('municipalities', 'code', code)
+            if code in codes or (state and municipality['uf'] != state):
+                continue
+            codes.add(code)
+            found.append(municipality)
+            if len(found) == limit:
+                break
+        return found
@@ -0,0 +1,243 @@
+"""
+This script serves a read-only HTTP API, in JSON, over the websites and
+portals datasets and the geographic data, so that other services can
+look up what exists for a municipality or a state without parsing the
+CSV files on each request.
+
+The data is loaded and indexed once (see index.py). While the server
+runs, the files are watched and, when any of them changes, the indexes
+are built again in the background and replace the old ones, which go on
+answering meanwhile.
+
+Endpoints:
+  GET /                                  counts of rows and load time
+  GET /states                            the states
+  GET /states/{uf}                       a state, its websites and portals
+  GET /municipalities?q=name&uf=SP       search by name, or list by state
+  GET /municipalities/{code}             a municipality, its websites and portals
+  GET /websites?state_code=AC&branch=executive
+  GET /portals?municipality_code=3550308&type=SIC
+
+Usage:
+  python server.py [--port 8000]
+
+For instructions use:
+  python server.py --help
+
+Este script serve uma API HTTP somente leitura, em JSON, sobre os
+conjuntos de dados de sites e portais e os dados geográficos, mantidos
+em memória com índices e recarregados quando os arquivos mudam.
+"""
+
+import argparse
+import json
+import logging
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+from api.index import (DatasetIndex, DATA_PACKAGES, SEARCH_LIMIT,
+    files_signature, source_files)
+
+HOST = '127.0.0.1'
+PORT = 8000
+RELOAD_INTERVAL = 2 # seconds between checks for changed files
+
+class DatasetWatcher:
+    """Keeps the current index of the datasets, building it again when
+    the files change.
+
+    Args:
+        data_packages (List[str]): Paths to the datapackage.json files.
+        interval (float): Time, in seconds, between checks for changes.
+    """
+    def __init__(self, data_packages: List[str] = DATA_PACKAGES,
+        interval: float = RELOAD_INTERVAL):
+        self.data_packages = data_packages
+        self.interval = interval
+        self.index = DatasetIndex(data_packages)
+        logging.info('Loaded %s.', self.index.counts())
+        self._stop = threading.Event()
+
+    def reload_if_changed(self) -> bool:
+        """Builds the index again if any of the files changed. If the new
+        files cannot be read, e.g. while they are being written, the
+        current index is kept and the next check tries again.
+
+        Returns:
+            bool: True if the index was replaced.
+        """
+        try:
+            if files_signature(source_files(self.data_packages)) == \
+                    self.index.signature:
+                return False
+            index = DatasetIndex(self.data_packages)
+        except (OSError, ValueError, KeyError) as error:
+            logging.warning('Could not reload the datasets: %s', error)
+            return False
+        self.index = index # replaced at once, for the requests to come
+        logging.info('Reloaded %s.', index.counts())
+        return True
+
+    def watch(self):
+        """Checks for changes until stopped. Meant to run in a thread."""
+        while not self._stop.wait(self.interval):
+            self.reload_if_changed()
+
+    def start(self):
+        """Starts watching in a background thread."""
+        threading.Thread(target=self.watch, daemon=True).start()
+
+    def stop(self):
+        """Stops watching."""
+        self._stop.set()
+
+def route(index: DatasetIndex, path: str, params: dict) \
+    -> Tuple[HTTPStatus, object]:
+    """Answers a request.
+
+    Args:
+        index (DatasetIndex): The index to answer from.
+        path (str): The path of the url.
+        params (dict): The parameters of the query string.
+
+    Returns:
+        Tuple[HTTPStatus, object]: The status and the data to send.
+    """
+    parts = [part for part in path.split('/') if part]
+    if not parts:
+        return HTTPStatus.OK, {'loaded': index.loaded, 'counts': index.counts()}
+    name, key = parts[0], parts[1] if len(parts) == 2 else None
+    if name not in index.tables or len(parts) > 2:
+        return HTTPStatus.NOT_FOUND, {'error': f'Not found: {path}'}
+
+    if key is None:
+        if name == 'municipalities' and 'q' in params:
+            try:
+                limit = int(params.pop('limit', SEARCH_LIMIT))
+            except ValueError:
+                limit = 0
+            if limit < 1:
+                return HTTPStatus.BAD_REQUEST, {'error': 'Invalid limit'}
+            uf = params.pop('uf', None)
+            return HTTPStatus.OK, index.search(params.pop('q'),
+                uf.upper() if uf else None, limit)
+        for column in ('state_code', 'uf', 'abbr'):
+            if column in params:
+                params[column] = params[column].upper()
+        try:
+            return HTTPStatus.OK, index.query(name, params)
+        except ValueError as error:
+            return HTTPStatus.BAD_REQUEST, {'error': str(error)}
+
+    if name == 'municipalities':
+        found = index.get('municipalities', 'code', to_int(key))
+        column, value = 'municipality_code', found and found['code']
+    elif name == 'states':
+        found = index.get('states', 'abbr', key.upper())
+        column, value = 'state_code', found and found['abbr']
+    else:
+        found = None
+    if found is None:
+        return HTTPStatus.NOT_FOUND, {'error': f'Not found: {path}'}
+    return HTTPStatus.OK, {
+        **found,
+        'websites': index.indexes['websites'][column].get(value, []),
+        'portals': index.indexes['portals'][column].get(value, []),
+    }
+
+def to_int(text: str) -> Optional[int]:
+    """Converts text to an integer, or None if it is not one."""
+    try:
+        return int(text)
+    except ValueError:
+        return None
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Answers the requests with the index of the server's watcher."""
+    protocol_version = 'HTTP/1.1' # keep connections alive
+    disable_nagle_algorithm = True # headers and body are sent apart
+    server_version = 'transparencia-dados-abertos-brasil'
+
+    def do_GET(self):
+        """Answers a GET request."""
+        url = urlsplit(self.path)
+        status, data = route(self.server.watcher.index, url.path,
+            dict(parse_qsl(url.query)))
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+def serve(host: str = HOST, port: int = PORT,
+    data_packages: List[str] = DATA_PACKAGES,
+    interval: float = RELOAD_INTERVAL):
+    """Serves the API until interrupted.
+
+    Args:
+        host (str): The address to listen on.
+        port (int): The port to listen on.
+        data_packages (List[str]): Paths to the datapackage.json files.
+        interval (float): Time, in seconds, between checks for changed
+            files.
+    """
+    watcher = DatasetWatcher(data_packages, interval)
+    watcher.start()
+    with ThreadingHTTPServer((host, port), RequestHandler) as server:
+        server.daemon_threads = True
+        server.watcher = watcher
+        logging.info('Serving on http://%s:%d/', host, port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.stop()
+
+def parse_cli() -> dict:
+    """Parses the command line interface.
+
+    Returns:
+        dict: A dict containing the values for host, port, data_packages
+            and interval.
+    """
+    parser = argparse.ArgumentParser(
+        description='Serves a read-only JSON API over the datasets.')
+    parser.add_argument('packages',
+        help='paths to datapackage.json files',
+        nargs='*',
+        default=DATA_PACKAGES,
+    )
+    parser.add_argument('--host',
+        help=f'address to listen on (default {HOST})',
+        default=HOST,
+    )
+    parser.add_argument('-p', '--port',
+        metavar='int', type=int,
+        help=f'port to listen on (default {PORT})',
+        default=PORT,
+    )
+    parser.add_argument('-i', '--interval',
+        metavar='seconds', type=float,
+        help=('time between checks for changed files '
+            f'(default {RELOAD_INTERVAL})'),
+        default=RELOAD_INTERVAL,
+    )
+    args = parser.parse_args()
+    return {
+        'host': args.host,
+        'port': args.port,
+        'data_packages': args.packages,
+        'interval': args.interval,
+    }
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    serve(**parse_cli())
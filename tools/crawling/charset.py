@@ -0,0 +1,151 @@
+"""Decoding of fetched pages.
+
+When a server does not declare the charset of a page, requests runs its
+encoding detector over the whole body when the text is accessed, which
+on large pages costs more than fetching them. Here the charset is taken,
+in order, from the content-type header, from a meta tag in the first
+bytes of the page, from checking whether a bounded sample of the body is
+UTF-8, from what was previously detected for the same host and, only as
+a last resort, from running the detector over the sample.
+
+Decodificação das páginas obtidas, evitando a detecção de codificação
+sobre o corpo inteiro da resposta.
+"""
+
+import codecs
+import re
+import threading
+import urllib.parse
+from typing import Dict, Optional
+
+import requests
+from requests.compat import chardet
+
+SNIFF_BYTES = 4096
+DETECT_BYTES = 32 * 1024
+FALLBACK_ENCODING = 'utf-8'
+
+re_header_charset = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+re_meta_charset = re.compile(
+    rb'<meta\s[^>]*charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
+
+_detected: Dict[str, str] = {} # encodings detected by host
+_lock = threading.Lock()
+
+def valid_encoding(name: Optional[str]) -> Optional[str]:
+    """Normalizes an encoding name, if Python knows it.
+
+    Args:
+        name (str): The encoding name, as declared.
+
+    Returns:
+        str: The canonical name, or None if unknown.
+    """
+    if not name:
+        return None
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return None
+
+def header_charset(headers) -> Optional[str]:
+    """Gets the charset declared in the content-type header. Unlike
+    requests, does not assume ISO-8859-1 when none is declared.
+
+    Args:
+        headers: The response headers.
+
+    Returns:
+        str: The encoding, or None if not declared.
+    """
+    content_type = next((value for name, value in headers.items()
+        if name.lower() == 'content-type'), '')
+    match = re_header_charset.search(content_type or '')
+    return valid_encoding(match.group(1)) if match else None
+
+def meta_charset(content: bytes) -> Optional[str]:
+    """Gets the charset declared by a meta tag (either <meta charset> or
+    <meta http-equiv="content-type">) in the first bytes of a page.
+
+    Args:
+        content (bytes): The page.
+
+    Returns:
+        str: The encoding, or None if not declared.
+    """
+    match = re_meta_charset.search(content[:SNIFF_BYTES])
+    return valid_encoding(match.group(1).decode('ascii')) if match else None
+
+def detect_encoding(content: bytes, url: Optional[str] = None) -> str:
+    """Finds the encoding of a page that does not declare one, running
+    the detector over at most DETECT_BYTES of it. A sample that decodes
+    as UTF-8 is taken as UTF-8. Otherwise, the encoding detected before
+    for the host of the url is used, as the pages of a site tend to
+    share one. Only encodings found from non-ASCII content are cached,
+    as an ASCII sample says nothing about the rest of the site.
+
+    Args:
+        content (bytes): The page.
+        url (str): Optional url of the page.
+
+    Returns:
+        str: The encoding.
+    """
+    host = urllib.parse.urlsplit(url).netloc.lower() if url else None
+    sample = content[:DETECT_BYTES]
+    if sample.isascii():
+        return _detected.get(host, FALLBACK_ENCODING)
+    try:
+        sample.decode('utf-8')
+        encoding = 'utf-8' # the most common, and cheap to check
+    except UnicodeDecodeError as error:
+        if error.reason == 'unexpected end of data': # sample cut mid character
+            encoding = 'utf-8'
+        elif _detected.get(host, 'utf-8') != 'utf-8':
+            return _detected[host]
+        else:
+            encoding = valid_encoding(
+                chardet.detect(sample).get('encoding')) or FALLBACK_ENCODING
+    if host:
+        with _lock:
+            _detected[host] = encoding
+    return encoding
+
+def page_encoding(content: bytes, headers, url: Optional[str] = None) -> str:
+    """Finds the encoding of a page.
+
+    Args:
+        content (bytes): The page.
+        headers: The response headers.
+        url (str): Optional url of the page, to cache detected encodings.
+
+    Returns:
+        str: The encoding.
+    """
+    return header_charset(headers) or meta_charset(content) or \
+        detect_encoding(content, url)
+
+def decode(content: bytes, headers, url: Optional[str] = None) -> str:
+    """Decodes a page. Invalid bytes are replaced.
+
+    Args:
+        content (bytes): The page.
+        headers: The response headers.
+        url (str): Optional url of the page, to cache detected encodings.
+
+    Returns:
+        str: The text of the page.
+    """
+    return content.decode(page_encoding(content, headers, url), 'replace')
+
+def decode_response(response: requests.Response) -> str:
+    """Decodes the body of a response, as a faster replacement for
+    response.text.
+
+    Args:
+        response (requests.Response): The response.
+
+    Returns:
+        str: The text of the page.
+    """
+    return decode(response.content, response.headers, response.url)
@@ -0,0 +1,106 @@
+"""Fetching of pages while crawling.
+
+Pages are requested through the host scheduler, so that each host is
+visited politely, and only HTML pages are downloaded, up to a maximum
+size. Their encoding is found by crawling.charset. Pages disallowed by
+the robots.txt file of their site, or of a site that could not be
+reached for it, are not fetched (see crawling.robots).
+The responses are captured in, or replayed from, a WARC archive if
+crawling.warc is so configured.
+
+Obtenção das páginas durante a navegação pelos sites.
+"""
+
+from typing import NamedTuple, Optional
+
+import requests
+
+from crawling import robots, warc
+from crawling.charset import page_encoding
+from crawling.politeness import HostScheduler
+from crawling.probe import get_session
+from settings import DEFAULT_TIMEOUT
+
+MAX_BYTES = 2 * 1024 * 1024
+HTML_TYPES = ('text/html', 'application/xhtml+xml')
+
+class Page(NamedTuple):
+    """A fetched page."""
+    url: str # the url requested
+    final_url: str # after redirects
+    status_code: int
+    headers: dict
+    content: bytes
+    encoding: str # declared or detected
+
+def fetch_page(url: str, scheduler: Optional[HostScheduler] = None,
+    max_bytes: int = MAX_BYTES, timeout: float = DEFAULT_TIMEOUT) \
+        -> Optional[Page]:
+    """Fetches an HTML page.
+
+    Args:
+        url (str): The url of the page.
+        scheduler (HostScheduler): Optional scheduler to wait for the
+            turn of the host. The crawl-delay asked for by the host is
+            applied to it.
+        max_bytes (int): Maximum size of the content to download. Longer
+            pages are truncated.
+        timeout (float): Timeout in seconds.
+
+    Returns:
+        Page: The page, or None if the request failed, is disallowed by
+            robots.txt, the site is unreachable or the content is not
+            HTML.
+    """
+    if warc.replaying():
+        response = warc.replay(url)
+        if response is None or not response.headers.get('content-type', '') \
+                .lower().startswith(HTML_TYPES):
+            return None
+        return to_page(url, response, response.content[:max_bytes])
+    if not robots.allowed(url, scheduler):
+        return None
+    session = get_session()
+    def get():
+        return session.get(url, timeout=timeout, stream=True)
+    try:
+        if scheduler is None:
+            response = get()
+        else:
+            with scheduler.slot(url):
+                response = get()
+        with response:
+            content_type = response.headers.get('content-type', '')
+            if not content_type.lower().startswith(HTML_TYPES):
+                return None
+            chunks, size = [], 0
+            for chunk in response.iter_content(64 * 1024):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= max_bytes:
+                    break
+            content = b''.join(chunks)[:max_bytes]
+    except (requests.exceptions.RequestException, UnicodeError):
+        return None
+    warc.record(response, content)
+    return to_page(url, response, content)
+
+def to_page(url: str, response: requests.Response, content: bytes) -> Page:
+    """Builds the page of a response.
+
+    Args:
+        url (str): The url requested.
+        response (requests.Response): The response.
+        content (bytes): The content downloaded.
+
+    Returns:
+        Page: The page.
+    """
+    return Page(
+        url=url,
+        final_url=response.url,
+        status_code=response.status_code,
+        headers=dict(response.headers),
+        content=content,
+        encoding=page_encoding(content, response.headers, response.url),
+    )
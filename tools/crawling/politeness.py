@@ -0,0 +1,88 @@
+"""Politeness towards the crawled hosts.
+
+Many municipality websites are small servers, and several of them are
+often hosted by the same provider. When crawling with many threads, a
+shared scheduler makes sure that each host gets at most one request at a
+time and that consecutive requests to it are spaced by a minimum delay,
+while requests to different hosts proceed in parallel.
+
+Cortesia com os hosts visitados: no máximo uma requisição por vez a cada
+host, com um intervalo mínimo entre elas.
+"""
+
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+MIN_DELAY = 1.0 # seconds between requests to the same host
+
+def host_of(url: str) -> str:
+    """Gets the host (and port, if any) of a url, lowercased.
+
+    Args:
+        url (str): The url.
+
+    Returns:
+        str: The host.
+    """
+    return urllib.parse.urlsplit(url).netloc.lower()
+
+class HostScheduler:
+    """Spaces out the requests to each host. Safe to share among threads.
+
+    Args:
+        min_delay (float): Minimum time, in seconds, between the start of
+            a request to a host and the start of the next one.
+    """
+    def __init__(self, min_delay: float = MIN_DELAY):
+        self.min_delay = min_delay
+        self.delays: Dict[str, float] = {} # hosts that asked for longer delays
+        self._next_time: Dict[str, float] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def set_delay(self, host: str, delay: float):
+        """Sets a longer delay for a host, e.g. the one asked for by its
+        robots.txt file.
+
+        Args:
+            host (str): The host.
+            delay (float): The delay in seconds. Values shorter than the
+                minimum delay are ignored.
+        """
+        with self._lock:
+            self.delays[host] = max(delay, self.min_delay)
+
+    def delay_of(self, host: str) -> float:
+        """Gets the delay between requests to a host.
+
+        Args:
+            host (str): The host.
+
+        Returns:
+            float: The delay in seconds.
+        """
+        return self.delays.get(host, self.min_delay)
+
+    @contextmanager
+    def slot(self, url: str) -> Iterator[None]:
+        """Waits for the turn of the host of a url and holds it while the
+        request is made, e.g.:
+
+            with scheduler.slot(url):
+                response = session.get(url)
+
+        Args:
+            url (str): The url to be requested.
+        """
+        host = host_of(url)
+        with self._lock:
+            host_lock = self._locks.setdefault(host, threading.Lock())
+        with host_lock:
+            wait = self._next_time.get(host, 0) - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._next_time[host] = time.monotonic() + self.delay_of(host)
+            yield
@@ -0,0 +1,151 @@
+"""Bulk liveness probing of hosts.
+
+Checking tens of thousands of hostnames one request at a time would take
+hours, as most of them do not exist and each failed request waits for a
+timeout. Here the hosts are checked in two concurrent stages: first a
+DNS lookup, which quickly rules out the hostnames that do not exist,
+then an HTTP request to only the ones that resolved.
+
+Verificação em massa de quais hosts respondem, primeiro por DNS e depois
+por HTTP.
+"""
+
+import logging
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Sequence
+
+import requests
+from tqdm import tqdm
+
+from settings import USER_AGENT, DEFAULT_TIMEOUT
+
+MAX_SIMULTANEOUS = 100
+SCHEMES = ('https', 'http')
+
+class ProbeResult(NamedTuple):
+    """The result of probing a host."""
+    hostname: str
+    url: Optional[str] # the url that answered, None if none did
+    status_code: Optional[int]
+    final_url: Optional[str] # after redirects
+
+_local = threading.local()
+
+def get_session(pool_size: int = MAX_SIMULTANEOUS) -> requests.Session:
+    """Gets a session for the current thread, so that connections are
+    reused without sharing a session across threads.
+
+    Args:
+        pool_size (int): Maximum number of connections to keep.
+
+    Returns:
+        requests.Session: The session.
+    """
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['user-agent'] = USER_AGENT
+        _local.session = session
+    return session
+
+def resolves(hostname: str) -> bool:
+    """Checks whether a hostname has a DNS record.
+
+    Args:
+        hostname (str): The hostname.
+
+    Returns:
+        bool: True if the hostname resolves to an address.
+    """
+    try:
+        return bool(socket.getaddrinfo(hostname, None, proto=socket.IPPROTO_TCP))
+    except (socket.gaierror, UnicodeError, OSError):
+        return False
+
+def probe_url(url: str, timeout: float = DEFAULT_TIMEOUT) \
+        -> Optional[requests.Response]:
+    """Makes a lightweight request to a url, following redirects. A HEAD
+    request is tried first and, if the server does not support it, a GET
+    request whose body is not downloaded.
+
+    Args:
+        url (str): The url.
+        timeout (float): Timeout in seconds.
+
+    Returns:
+        requests.Response: The response, or None if the request failed.
+    """
+    session = get_session()
+    try:
+        response = session.head(url, allow_redirects=True, timeout=timeout)
+        if response.status_code in (403, 405, 501):
+            response = session.get(url, allow_redirects=True, timeout=timeout,
+                stream=True)
+            response.close()
+        return response
+    except (requests.exceptions.RequestException, UnicodeError):
+        return None
+
+def probe_host(hostname: str, schemes: Sequence[str] = SCHEMES,
+    timeout: float = DEFAULT_TIMEOUT) -> ProbeResult:
+    """Probes the root page of a host, trying each scheme in turn.
+
+    Args:
+        hostname (str): The hostname.
+        schemes (Sequence[str]): The schemes to try, in order.
+        timeout (float): Timeout in seconds.
+
+    Returns:
+        ProbeResult: The first successful answer, or the last one.
+    """
+    result = ProbeResult(hostname, None, None, None)
+    for scheme in schemes:
+        url = f'{scheme}://{hostname}/'
+        response = probe_url(url, timeout)
+        if response is None:
+            continue
+        result = ProbeResult(hostname, url, response.status_code, response.url)
+        if response.ok:
+            break
+    return result
+
+def probe_hosts(hostnames: Iterable[str], schemes: Sequence[str] = SCHEMES,
+    max_simultaneous: int = MAX_SIMULTANEOUS, timeout: float = DEFAULT_TIMEOUT,
+    progress: bool = True) -> Iterator[ProbeResult]:
+    """Probes many hosts concurrently: first all of them are looked up in
+    the DNS, then the root pages of those that resolved are requested.
+
+    Args:
+        hostnames (Iterable[str]): The hostnames. Repeated ones are
+            probed only once.
+        schemes (Sequence[str]): The schemes to try, in order.
+        max_simultaneous (int): Maximum number of simultaneous lookups
+            and requests.
+        timeout (float): Timeout of the requests, in seconds.
+        progress (bool): Whether to show progress bars.
+
+    Yields:
+        ProbeResult: The result for each host that resolved, in the
+            order of the hostnames.
+    """
+    hostnames: List[str] = list(dict.fromkeys(hostnames))
+    with ThreadPoolExecutor(max_workers=max_simultaneous) as executor:
+        logging.info('Looking up %d hostnames...', len(hostnames))
+        resolved = [
+            hostname
+            for hostname, found in zip(hostnames, tqdm(
+                executor.map(resolves, hostnames),
+                total=len(hostnames), disable=not progress))
+            if found
+        ]
+        logging.info('%d hostnames resolved, probing them...', len(resolved))
+        def probe(hostname):
+            return probe_host(hostname, schemes, timeout)
+        yield from tqdm(executor.map(probe, resolved),
+            total=len(resolved), disable=not progress)
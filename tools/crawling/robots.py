@@ -0,0 +1,369 @@
+"""Robots exclusion (robots.txt) for all the crawlers.
+
+The robots.txt file of each site is fetched once and kept in a cache for
+a day, so that checking it does not add a request for every url. The
+cache is a SQLite database that can be shared by all the processes of a
+run and by the different tools: when several processes need the file of
+the same site at once, one of them fetches it while the others wait for
+the result. Failures are cached too, for a shorter time.
+
+As in RFC 9309, a file that does not exist (status 4xx) allows
+everything and a server error (status 5xx) disallows everything, while
+a file that cannot be read for other reasons, such as a redirect loop,
+is taken as missing. A site that cannot be connected to, or that times
+out, counts as unreachable and its pages are not requested either, so
+that a dead site does not cost a timeout for its robots.txt file and
+another for each page. The crawl-delay (or request-rate) asked
+for by a site is applied to the host scheduler of the crawler and, with
+a shared cache, the turns of the site are also kept in the database, so
+that the delay holds among all the processes.
+
+Exclusão de robôs (robots.txt) para todos os programas que navegam nos
+sites, com cache compartilhado entre processos.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+import urllib.robotparser
+from typing import Dict, Optional, Tuple
+
+import requests
+
+from crawling.politeness import HostScheduler, host_of
+from settings import USER_AGENT, DEFAULT_TIMEOUT
+
+AGENT = USER_AGENT.split('/', maxsplit=1)[0] # the product token
+TTL = 24 * 3600 # seconds to keep a robots.txt file
+NEGATIVE_TTL = 3600 # seconds to keep a failure to get it
+CLAIM_TIMEOUT = 2 * DEFAULT_TIMEOUT # seconds to wait for another process
+POLL_INTERVAL = 0.5 # seconds
+MAX_BYTES = 500 * 1024 # as in RFC 9309, the rest is ignored
+MAX_CRAWL_DELAY = 60 # seconds, longer delays asked for are shortened
+
+def origin_of(url: str) -> str:
+    """Gets the origin (scheme, host and port) of a url, to which a
+    robots.txt file applies.
+
+    Args:
+        url (str): The url.
+
+    Returns:
+        str: The origin, e.g. "https://www.example.gov.br".
+    """
+    parts = urllib.parse.urlsplit(url)
+    return f'{parts.scheme.lower()}://{parts.netloc.lower()}'
+
+def fetch_robots(origin: str, timeout: float = DEFAULT_TIMEOUT) -> Tuple[int, str]:
+    """Fetches the robots.txt file of a site.
+
+    Args:
+        origin (str): The origin of the site.
+        timeout (float): Timeout in seconds.
+
+    Returns:
+        Tuple[int, str]: The status code, 0 if the site could not be
+            reached, 404 if the file could not be read for another
+            reason (e.g. a redirect loop), and the contents of the file.
+    """
+    try:
+        response = requests.get(f'{origin}/robots.txt',
+            headers={'user-agent': USER_AGENT}, timeout=timeout)
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout):
+        return 0, ''
+    except (requests.exceptions.RequestException, UnicodeError):
+        return 404, '' # as if there were no file
+    if response.status_code != 200:
+        return response.status_code, ''
+    return 200, response.content[:MAX_BYTES].decode('utf-8', 'replace')
+
+def parse_robots(status_code: int, body: str) -> urllib.robotparser.RobotFileParser:
+    """Builds the rules of a site from its robots.txt file.
+
+    Args:
+        status_code (int): The status code of the request for the file.
+        body (str): The contents of the file.
+
+    Returns:
+        urllib.robotparser.RobotFileParser: The rules.
+    """
+    rules = urllib.robotparser.RobotFileParser()
+    if status_code == 200:
+        rules.parse(body.splitlines())
+    elif status_code >= 500:
+        rules.disallow_all = True
+    else: # not found or not reachable
+        rules.allow_all = True
+    return rules
+
+def crawl_delay(rules: urllib.robotparser.RobotFileParser) -> Optional[float]:
+    """Gets the delay between requests a site asks for, either as a
+    crawl-delay or as a request-rate.
+
+    Args:
+        rules (urllib.robotparser.RobotFileParser): The rules of the site.
+
+    Returns:
+        float: The delay in seconds, at most MAX_CRAWL_DELAY, or None if
+            none is asked for.
+    """
+    delay = rules.crawl_delay(AGENT)
+    rate = rules.request_rate(AGENT)
+    if rate and rate.requests:
+        delay = max(delay or 0, rate.seconds / rate.requests)
+    return min(float(delay), MAX_CRAWL_DELAY) if delay else None
+
+class RobotsCache:
+    """The rules of the sites, fetched once per site and kept in memory
+    and, optionally, in a SQLite database shared with other processes.
+    Safe to share among threads, and among processes of a pool, to
+    which it can be passed as an argument.
+
+    Args:
+        path (str): Path to the SQLite database, or None to keep the
+            rules only in memory.
+        ttl (float): Time, in seconds, to keep a robots.txt file.
+        negative_ttl (float): Time, in seconds, to keep a failure to get
+            a robots.txt file.
+    """
+    def __init__(self, path: Optional[str] = None, ttl: float = TTL,
+        negative_ttl: float = NEGATIVE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._setup()
+
+    def _setup(self):
+        self._rules: Dict[str,
+            Tuple[urllib.robotparser.RobotFileParser, int, float]] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if self.path:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._connection().execute('''CREATE TABLE IF NOT EXISTS robots (
+                origin TEXT PRIMARY KEY,
+                status INTEGER,
+                body TEXT,
+                expires REAL,
+                claimed REAL
+            )''')
+            self._connection().execute('''CREATE TABLE IF NOT EXISTS turns (
+                host TEXT PRIMARY KEY,
+                next REAL
+            )''')
+
+    def __getstate__(self):
+        return {'path': self.path, 'ttl': self.ttl,
+            'negative_ttl': self.negative_ttl}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._setup()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Gets the connection of the current thread to the database. A
+        forked process does not use the connection of its parent."""
+        if getattr(self._local, 'pid', None) != os.getpid():
+            # autocommit mode, transactions are started explicitly
+            self._local.connection = sqlite3.connect(self.path, timeout=60,
+                isolation_level=None)
+            self._local.connection.execute('PRAGMA journal_mode=WAL')
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def _expires(self, status_code: int) -> float:
+        failed = status_code == 0 or status_code >= 500
+        return time.time() + (self.negative_ttl if failed else self.ttl)
+
+    def _load(self, origin: str) -> Tuple[int, str, float]:
+        """Gets the robots.txt file of a site from the database or, if it
+        is not there or has expired, from the site. Only one process
+        fetches it: the others wait for it to be stored.
+
+        Returns:
+            Tuple[int, str, float]: The status code, the contents of the
+                file and when they expire.
+        """
+        connection = self._connection()
+        while True:
+            now = time.time()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute('SELECT status, body, expires, claimed '
+                    'FROM robots WHERE origin = ?', (origin,)).fetchone()
+                if row and row[2] and row[2] > now:
+                    return row[0], row[1], row[2]
+                # a claim older than CLAIM_TIMEOUT was abandoned
+                claimed_elsewhere = bool(row and row[3]
+                    and row[3] > now - CLAIM_TIMEOUT)
+                if not claimed_elsewhere:
+                    connection.execute('INSERT INTO robots (origin, claimed) '
+                        'VALUES (?, ?) ON CONFLICT (origin) '
+                        'DO UPDATE SET claimed = excluded.claimed', (origin, now))
+            finally:
+                connection.execute('COMMIT')
+            if not claimed_elsewhere:
+                break
+            time.sleep(POLL_INTERVAL)
+        status_code, body = fetch_robots(origin)
+        expires = self._expires(status_code)
+        connection.execute('UPDATE robots SET status = ?, body = ?, '
+            'expires = ?, claimed = NULL WHERE origin = ?',
+            (status_code, body, expires, origin))
+        return status_code, body, expires
+
+    def _site(self, url: str) -> Tuple[urllib.robotparser.RobotFileParser, int]:
+        """Gets the rules of the site of a url and the status code of the
+        request for its robots.txt file.
+        """
+        origin = origin_of(url)
+        cached = self._rules.get(origin)
+        if cached and cached[2] > time.time():
+            return cached[:2]
+        with self._lock:
+            origin_lock = self._locks.setdefault(origin, threading.Lock())
+        with origin_lock: # one request per site among the threads
+            cached = self._rules.get(origin)
+            if cached and cached[2] > time.time():
+                return cached[:2]
+            if self.path:
+                status_code, body, expires = self._load(origin)
+            else:
+                status_code, body = fetch_robots(origin)
+                expires = self._expires(status_code)
+            rules = parse_robots(status_code, body)
+            self._rules[origin] = (rules, status_code, expires)
+            return rules, status_code
+
+    def rules(self, url: str) -> urllib.robotparser.RobotFileParser:
+        """Gets the rules of the site of a url.
+
+        Args:
+            url (str): The url.
+
+        Returns:
+            urllib.robotparser.RobotFileParser: The rules.
+        """
+        return self._site(url)[0]
+
+    def reachable(self, url: str) -> bool:
+        """Checks whether the site of a url could be reached when its
+        robots.txt file was last requested.
+
+        Args:
+            url (str): The url.
+
+        Returns:
+            bool: False if the request for the file failed to connect or
+                timed out.
+        """
+        return self._site(url)[1] != 0
+
+    def allowed(self, url: str, scheduler: Optional[HostScheduler] = None) -> bool:
+        """Checks whether the robots.txt file of a site allows fetching a
+        url, and applies its crawl-delay to the scheduler. The urls of a
+        site that could not be reached are not allowed.
+
+        Args:
+            url (str): The url.
+            scheduler (HostScheduler): Optional scheduler of the crawler.
+
+        Returns:
+            bool: True if the url may be fetched.
+        """
+        rules, status_code = self._site(url)
+        if status_code == 0:
+            logging.info('Unreachable: %s', url)
+            return False
+        if scheduler is not None:
+            delay = crawl_delay(rules)
+            if delay and delay > scheduler.delay_of(host_of(url)):
+                scheduler.set_delay(host_of(url), delay)
+        if rules.can_fetch(AGENT, url):
+            return True
+        logging.info('Disallowed by robots.txt: %s', url)
+        return False
+
+    def wait_turn(self, url: str):
+        """Waits for the turn of the host of a url among all the processes
+        sharing the database, if its site asks for a crawl-delay. Each
+        process takes the next turn and sets the one after it, so that
+        the requests of all of them are spaced by the delay. Without a
+        database, the scheduler of the crawler is enough.
+
+        Args:
+            url (str): The url to be requested.
+        """
+        delay = crawl_delay(self.rules(url))
+        if not delay or not self.path:
+            return
+        host = host_of(url)
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT next FROM turns WHERE host = ?',
+                (host,)).fetchone()
+            start = max(time.time(), row[0] if row else 0)
+            connection.execute('INSERT INTO turns (host, next) VALUES (?, ?) '
+                'ON CONFLICT (host) DO UPDATE SET next = excluded.next',
+                (host, start + delay))
+        finally:
+            connection.execute('COMMIT')
+        wait = start - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+# the cache of the crawlers of the current process
+_cache = RobotsCache()
+
+def configure(cache: RobotsCache):
+    """Sets the cache used by the crawlers of the current process, e.g. to
+    share one with other processes. Can be used as the initializer of a
+    pool.
+
+    Args:
+        cache (RobotsCache): The cache.
+    """
+    global _cache
+    _cache = cache
+
+def allowed(url: str, scheduler: Optional[HostScheduler] = None) -> bool:
+    """Checks whether the robots.txt file of a site allows fetching a
+    url, and applies its crawl-delay to the scheduler. The urls of a site
+    that could not be reached are not allowed.
+
+    Args:
+        url (str): The url.
+        scheduler (HostScheduler): Optional scheduler of the crawler.
+
+    Returns:
+        bool: True if the url may be fetched.
+    """
+    return _cache.allowed(url, scheduler)
+
+def reachable(url: str) -> bool:
+    """Checks whether the site of a url could be reached when its
+    robots.txt file was last requested.
+
+    Args:
+        url (str): The url.
+
+    Returns:
+        bool: False if the request for the file failed to connect or
+            timed out.
+    """
+    return _cache.reachable(url)
+
+def wait_turn(url: str):
+    """Waits for the turn of the host of a url among all the processes
+    sharing the cache, if its site asks for a crawl-delay.
+
+    Args:
+        url (str): The url to be requested.
+    """
+    _cache.wait_turn(url)
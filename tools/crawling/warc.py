@@ -0,0 +1,459 @@
+"""Capture of crawled pages in WARC files, and replay from them.
+
+When capturing, every response the crawlers get (including the redirects
+that led to it) is written as a WARC response record, with its headers
+and a body of at most MAX_BODY bytes. Each record is a gzip member of
+its own, as in the usual .warc.gz files, and each process writes to a
+file of its own, so the processes of a pool never share a file.
+
+When replaying, the crawlers get their responses from the archive
+instead of the network: a url that was not captured is treated as a
+request that failed, as it did when the archive was written. This way the
+classification, fingerprinting and portal discovery can be run again
+over what the sites looked like when they were crawled, in seconds and
+offline.
+
+The body is stored as requests delivers it, i.e. already decompressed,
+so the content-encoding and transfer-encoding headers are not recorded.
+
+Usage, to list or show the captures:
+  python warc.py archive.warc.gz [-u url]
+
+Captura das páginas visitadas em arquivos WARC e reprodução a partir
+deles, sem acesso à rede.
+"""
+
+import argparse
+import base64
+import glob
+import gzip
+import hashlib
+import logging
+import os
+import pathlib
+import threading
+import urllib.parse
+import uuid
+import zlib
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+MAX_BODY = 256 * 1024
+MAX_REDIRECTS = 30
+WARC_VERSION = 'WARC/1.1'
+DROPPED_HEADERS = {'content-encoding', 'transfer-encoding', 'content-length'}
+REDIRECT_CODES = {301, 302, 303, 307, 308}
+BLOCK_SIZE = 64 * 1024
+
+class WarcRecord(NamedTuple):
+    """A response record read from an archive."""
+    url: str
+    date: str
+    status_code: int
+    reason: str
+    headers: CaseInsensitiveDict
+    content: bytes
+
+def url_key(url: str) -> str:
+    """Normalizes a url the way requests does before sending it (e.g.
+    adding the slash after the host name), so that the url of a candidate
+    link matches the url recorded in the archive.
+
+    Args:
+        url (str): The url.
+
+    Returns:
+        str: The normalized url.
+    """
+    try:
+        return requests.Request('GET', url).prepare().url
+    except requests.exceptions.RequestException:
+        return url
+
+def _warc_member(warc_type: str, fields: Dict[str, str], block: bytes) -> bytes:
+    """Renders a WARC record as a gzip member.
+
+    Args:
+        warc_type (str): The WARC-Type of the record.
+        fields (Dict[str, str]): The other named fields of the record.
+        block (bytes): The content block.
+
+    Returns:
+        bytes: The compressed record.
+    """
+    head = {
+        'WARC-Type': warc_type,
+        'WARC-Record-ID': f'<urn:uuid:{uuid.uuid4()}>',
+        'WARC-Date': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        **fields,
+        'Content-Length': str(len(block)),
+    }
+    record = (f'{WARC_VERSION}\r\n' + ''.join(
+        f'{name}: {value}\r\n' for name, value in head.items()) + '\r\n'
+    ).encode('utf-8') + block + b'\r\n\r\n'
+    return gzip.compress(record)
+
+def _http_block(response: requests.Response, content: bytes) -> bytes:
+    """Renders the status line, headers and body of a response as they
+    go in a WARC response record.
+    """
+    lines = [f'HTTP/1.1 {response.status_code} {response.reason or ""}'.rstrip()]
+    lines.extend(f'{name}: {value}' for name, value in response.headers.items()
+        if name.lower() not in DROPPED_HEADERS)
+    lines.append(f'Content-Length: {len(content)}')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1', 'replace') + content
+
+def _payload_digest(content: bytes) -> str:
+    return 'sha1:' + base64.b32encode(hashlib.sha1(content).digest()).decode('ascii')
+
+class WarcWriter:
+    """Writes the responses of a crawl to WARC files in a folder, one file
+    per process. Safe to share among threads, and among processes of a
+    pool, to which it can be passed as an argument.
+
+    Args:
+        folder (str): The folder of the WARC files.
+        prefix (str): The beginning of the file names, e.g. the name of
+            the crawler.
+        max_body (int): Maximum size of the body recorded for each
+            response. Longer bodies are truncated.
+    """
+    def __init__(self, folder: str, prefix: str = 'crawl',
+        max_body: int = MAX_BODY):
+        self.folder = folder
+        self.prefix = prefix
+        self.max_body = max_body
+        self.path: Optional[str] = None
+        self._file = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(path=None, _file=None, _pid=None, _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _open(self):
+        """Opens the file of the current process, if not yet open."""
+        if self._pid == os.getpid():
+            return
+        pathlib.Path(self.folder).mkdir(parents=True, exist_ok=True)
+        started = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
+        self.path = os.path.join(self.folder,
+            f'{self.prefix}-{started}-{os.getpid()}.warc.gz')
+        self._file = open(self.path, 'ab')
+        self._pid = os.getpid()
+        info = (f'software: {self.prefix}\r\n'
+            'format: WARC File Format 1.1\r\n').encode('utf-8')
+        self._file.write(_warc_member('warcinfo', {
+            'WARC-Filename': os.path.basename(self.path),
+            'Content-Type': 'application/warc-fields',
+        }, info))
+
+    def write_response(self, response: requests.Response,
+        content: Optional[bytes] = None):
+        """Writes a response, and the redirects that led to it.
+
+        Args:
+            response (requests.Response): The response.
+            content (bytes): The body, if the response was streamed and
+                its content is not available. Defaults to the content of
+                the response.
+        """
+        hops = [(hop, hop.content) for hop in response.history]
+        hops.append((response, response.content if content is None else content))
+        members = []
+        for hop, body in hops:
+            fields = {
+                'WARC-Target-URI': hop.url,
+                'Content-Type': 'application/http; msgtype=response',
+                'WARC-Payload-Digest': _payload_digest(body[:self.max_body]),
+            }
+            if len(body) > self.max_body:
+                fields['WARC-Truncated'] = 'length'
+            members.append(_warc_member('response', fields,
+                _http_block(hop, body[:self.max_body])))
+        with self._lock:
+            self._open()
+            self._file.write(b''.join(members))
+            self._file.flush()
+
+    def close(self):
+        """Closes the file of the current process."""
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._file.close()
+            self._file = None
+            self._pid = None
+
+def _read_member(file, offset: int) -> Tuple[bytes, int]:
+    """Decompresses the gzip member that starts at an offset of a file.
+
+    Returns:
+        Tuple[bytes, int]: The decompressed data and the offset of the
+            next member, or empty data at the end of the file.
+    """
+    file.seek(offset)
+    decompressor = zlib.decompressobj(wbits=31)
+    parts = []
+    consumed = 0
+    while not decompressor.eof:
+        block = file.read(BLOCK_SIZE)
+        if not block:
+            if consumed:
+                logging.warning('Truncated record at offset %d of "%s".',
+                    offset, file.name)
+            return b'', offset
+        parts.append(decompressor.decompress(block))
+        consumed += len(block) - len(decompressor.unused_data)
+    return b''.join(parts), offset + consumed
+
+def _parse_fields(head: bytes) -> Dict[str, str]:
+    fields = {}
+    for line in head.decode('utf-8', 'replace').split('\r\n')[1:]:
+        name, _, value = line.partition(':')
+        fields[name.strip().lower()] = value.strip()
+    return fields
+
+def parse_record(data: bytes) -> Optional[WarcRecord]:
+    """Parses a WARC record.
+
+    Args:
+        data (bytes): The decompressed record.
+
+    Returns:
+        WarcRecord: The record, or None if it is not a response record.
+    """
+    head, _, rest = data.partition(b'\r\n\r\n')
+    fields = _parse_fields(head)
+    if fields.get('warc-type') != 'response':
+        return None
+    block = rest[:int(fields['content-length'])]
+    http_head, _, content = block.partition(b'\r\n\r\n')
+    status_line = http_head.split(b'\r\n', 1)[0].decode('latin-1')
+    _, status_code, reason = (status_line.split(' ', 2) + [''])[:3]
+    headers = CaseInsensitiveDict()
+    for line in http_head.decode('latin-1').split('\r\n')[1:]:
+        name, _, value = line.partition(':')
+        if name.strip().lower() in headers:
+            headers[name.strip()] += f', {value.strip()}'
+        else:
+            headers[name.strip()] = value.strip()
+    return WarcRecord(
+        url=fields.get('warc-target-uri', ''),
+        date=fields.get('warc-date', ''),
+        status_code=int(status_code),
+        reason=reason,
+        headers=headers,
+        content=content,
+    )
+
+def iter_records(path: str) -> Iterator[Tuple[int, WarcRecord]]:
+    """Reads the response records of a WARC file.
+
+    Args:
+        path (str): Path to the .warc.gz file.
+
+    Yields:
+        Tuple[int, WarcRecord]: The offset and contents of each record.
+    """
+    with open(path, 'rb') as file:
+        offset = 0
+        while True:
+            data, next_offset = _read_member(file, offset)
+            if not data:
+                return
+            record = parse_record(data)
+            if record is not None:
+                yield offset, record
+            offset = next_offset
+
+def archive_paths(paths: List[str]) -> List[str]:
+    """Expands folders into the WARC files in them.
+
+    Args:
+        paths (List[str]): Paths to WARC files or folders.
+
+    Returns:
+        List[str]: The WARC files, in the order given and, within each
+            folder, in the order of their names (i.e. of their start).
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.warc.gz'))))
+        else:
+            files.append(path)
+    return files
+
+class WarcArchive:
+    """Looks up the responses captured in WARC files. When a url was
+    captured more than once, the last capture is used. Can be passed to
+    the processes of a pool: only the index is copied, and the files are
+    opened by each process when reading.
+
+    Args:
+        paths (List[str]): Paths to WARC files or to folders with them.
+    """
+    def __init__(self, paths: List[str]):
+        self.paths = archive_paths(paths)
+        self.index: Dict[str, Tuple[str, int]] = {}
+        for path in self.paths:
+            for offset, record in iter_records(path):
+                self.index[url_key(record.url)] = (path, offset)
+        logging.info('Indexed %d captured urls in %d WARC files.',
+            len(self.index), len(self.paths))
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, url: str) -> bool:
+        return url_key(url) in self.index
+
+    def read(self, url: str) -> Optional[WarcRecord]:
+        """Reads the capture of a url.
+
+        Args:
+            url (str): The url.
+
+        Returns:
+            WarcRecord: The record, or None if not captured.
+        """
+        location = self.index.get(url_key(url))
+        if location is None:
+            return None
+        path, offset = location
+        with open(path, 'rb') as file:
+            data, _ = _read_member(file, offset)
+        return parse_record(data)
+
+    def get_response(self, url: str) -> Optional[requests.Response]:
+        """Replays a request, following the captured redirects.
+
+        Args:
+            url (str): The url requested.
+
+        Returns:
+            requests.Response: The response as it was captured, or None
+                if the url was not captured.
+        """
+        history = []
+        for _ in range(MAX_REDIRECTS + 1):
+            record = self.read(url)
+            if record is None:
+                return None
+            response = requests.Response()
+            response.url = record.url
+            response.status_code = record.status_code
+            response.reason = record.reason
+            response.headers = record.headers
+            response.encoding = get_encoding_from_headers(record.headers)
+            response._content = record.content
+            response._content_consumed = True
+            response.warc_date = record.date
+            response.history = list(history)
+            location = record.headers.get('location')
+            if record.status_code not in REDIRECT_CODES or not location:
+                return response
+            history.append(response)
+            url = urllib.parse.urljoin(record.url, location)
+        return None # too many redirects
+
+# the archive the crawlers of the current process write to or read from
+_writer: Optional[WarcWriter] = None
+_archive: Optional[WarcArchive] = None
+
+def configure(writer: Optional[WarcWriter] = None,
+    archive: Optional[WarcArchive] = None):
+    """Sets whether the crawlers of the current process capture their
+    responses or replay them. Can be used as the initializer of a pool.
+
+    Args:
+        writer (WarcWriter): The writer to capture responses with, or
+            None.
+        archive (WarcArchive): The archive to replay responses from, or
+            None.
+    """
+    global _writer, _archive
+    _writer, _archive = writer, archive
+
+def replaying() -> bool:
+    """Tells whether responses are replayed from an archive."""
+    return _archive is not None
+
+def replay(url: str) -> Optional[requests.Response]:
+    """Gets the captured response to a url.
+
+    Args:
+        url (str): The url requested.
+
+    Returns:
+        requests.Response: The response, or None if not captured.
+    """
+    return _archive.get_response(url)
+
+def capture_date(response: requests.Response) -> Optional[datetime]:
+    """Gets when a replayed response was captured.
+
+    Args:
+        response (requests.Response): The response.
+
+    Returns:
+        datetime: The time of the capture, in UTC without time zone (as
+            datetime.utcnow), or None if the response was not replayed.
+    """
+    date = getattr(response, 'warc_date', None)
+    return datetime.strptime(date, '%Y-%m-%dT%H:%M:%SZ') if date else None
+
+def record(response: requests.Response, content: Optional[bytes] = None):
+    """Captures a response, if capturing.
+
+    Args:
+        response (requests.Response): The response.
+        content (bytes): The body, if the response was streamed.
+    """
+    if _writer is not None:
+        _writer.write_response(response, content)
+
+def parse_cli() -> dict:
+    """Parses the command line interface.
+
+    Returns:
+        dict: A dict containing the values for paths and url.
+    """
+    parser = argparse.ArgumentParser(
+        description='Lists the captures in WARC files, or shows one.')
+    parser.add_argument('paths', nargs='+',
+        help='WARC files or folders with them')
+    parser.add_argument('-u', '--url',
+        help='show the headers and body captured for this url',
+        default=None,
+    )
+    args = parser.parse_args()
+    return {'paths': args.paths, 'url': args.url}
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_cli()
+    if options['url']:
+        captured = WarcArchive(options['paths']).read(options['url'])
+        if captured is None:
+            print('Not captured.')
+        else:
+            print(captured.date, captured.status_code, captured.reason)
+            for header, header_value in captured.headers.items():
+                print(f'{header}: {header_value}')
+            print()
+            print(captured.content.decode('utf-8', 'replace'))
+    else:
+        for warc_path in archive_paths(options['paths']):
+            for _, captured in iter_records(warc_path):
+                print(captured.date, captured.status_code, captured.url)
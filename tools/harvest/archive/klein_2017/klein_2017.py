@@ -15,17 +15,22 @@
 # 
 
 import os
+import logging
 from typing import List
 
 import pandas as pd
 from frictionless import Package
 
+from storage.upsert import key_hashes, upsert
+from storage.writer import conform_to_schema, write_csv
+
 INPUT_PATH = '../../../../data/archive'
 INPUT_MUNICIPAL = 'portais-municipais.csv'
 INPUT_STATE = 'portais-estaduais.csv'
 OUTPUT_PATH = '../../../../data/valid'
 OUTPUT_FILE = 'brazilian-transparency-and-open-data-portals.csv'
 IBGE_CODE_PATH = '../../../../data/auxiliary/geographic'
+RESOURCE_NAME = 'brazilian-transparency-and-open-data-portals'
 
 def get_schema() -> List[str]:
     """Gets the column names from the data schema.
@@ -37,6 +42,38 @@ def get_schema() -> List[str]:
     fields = package.get_resource('brazilian-transparency-and-open-data-portals').schema.fields
     return [field.name for field in fields]
 
+def get_primary_key() -> List[str]:
+    """Gets the primary key columns from the data schema.
+
+    Returns:
+        List(str): The list of column names.
+    """
+    package = Package(os.path.join(OUTPUT_PATH,'datapackage.json'))
+    return package.get_resource(RESOURCE_NAME).schema.primary_key
+
+def find_url_conflicts(existing: pd.DataFrame, new: pd.DataFrame,
+    key: List[str]) -> pd.DataFrame:
+    """Finds the new rows whose key matches an existing row with a
+    different url, e.g. another portal of the same municipality, sphere
+    and branch, which must not be overwritten.
+
+    Args:
+        existing (pd.DataFrame): The existing data, with the key as
+            columns.
+        new (pd.DataFrame): The data to merge.
+        key (List[str]): The names of the key columns.
+
+    Returns:
+        pd.DataFrame: The conflicting rows of the new data, with the
+            existing url.
+    """
+    existing_urls = pd.Series(existing.url.to_numpy(),
+        index=key_hashes(existing, key))
+    existing_urls = existing_urls[~existing_urls.index.duplicated(keep=False)]
+    matched = existing_urls.reindex(key_hashes(new, key)).to_numpy()
+    conflicting = pd.notna(matched) & (matched != new.url.to_numpy())
+    return new[conflicting].assign(existing_url=matched[conflicting])
+
 def get_state_dataframe(input_path: str, file_name: str):
     """Obtains a state data portals dataframe from the specified csv file.
 
@@ -144,28 +181,47 @@ def save_and_merge_existing_data(table: pd.DataFrame, output_path: str,
     file_name: str):
     """Saves the dataframe, merging existing data, if present.
 
+    Rows are matched by the primary key of the schema: existing rows are
+    updated and new rows are added. Rows with ambiguous keys, or whose
+    key matches an existing row with a different url, are reported and
+    left out.
+
     Args:
         table (pd.DataFrame): The dataframe to save do disk.
         output_path (str): The path where to save the file.
         file_name(str): The name of the file to be saved or merged.
     """
-    index_columns = ['state_code', 'municipality_code', 'sphere', 'branch']
     if os.path.exists(os.path.join(output_path, file_name)):
         package = Package(os.path.join(output_path, 'datapackage.json'))
         df_existing = (
             package
-            .get_resource('brazilian-transparency-and-open-data-portals')
+            .get_resource(RESOURCE_NAME)
             .to_pandas()
-            .set_index(index_columns)
+            .reset_index()
         )
-        df_existing.update(table.set_index(index_columns))
-        table = df_existing.reset_index()
-    columns = get_schema()
-    table = table[columns] # reorder columns
-
-    table.to_csv(os.path.join(output_path, file_name), index=False)
+        key = get_primary_key()
+        url_conflicts = find_url_conflicts(df_existing, table, key)
+        for _, conflict in url_conflicts.iterrows():
+            logging.warning('Conflict (url differs from %s): %s',
+                conflict['existing_url'], conflict[key + ['url']].to_dict())
+        table = table.drop(url_conflicts.index)
+        result = upsert(df_existing, table, key)
+        logging.info('Inserted %d and updated %d rows.',
+            result.inserted, result.updated)
+        for _, conflict in result.conflicts.iterrows():
+            logging.warning('Conflict (%s): %s', conflict['reason'],
+                conflict[key + ['url']].to_dict())
+        table = result.table
+    package = Package(os.path.join(output_path, 'datapackage.json'))
+    fields = package.get_resource(RESOURCE_NAME).schema.fields
+
+    write_csv(
+        conform_to_schema(table, fields), # reorder columns, keep ints as ints
+        os.path.join(output_path, file_name)
+    )
 
 if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
     df = set_municipal_codes(
         concatenate_sources([
             get_state_dataframe(INPUT_PATH, INPUT_STATE),
@@ -18,6 +18,8 @@ import yaml
 import pandas as pd
 from frictionless import Package
 
+from storage.writer import write_csv
+
 GEO_FOLDER = '../../../data/auxiliary/geographic'
 GEO_FILE = 'municipality.csv'
 OUTPUT_FOLDER = '../../../data/auxiliary/geographic'
@@ -187,7 +189,7 @@ def update_from_dbpedia(
     mun['wikidata'] = update_column(mun, dbp, 'wikidata')
 
     # write back the csv
-    mun.to_csv(output_file, index=False)
+    write_csv(mun, output_file)
 
 if __name__ == '__main__':
     with open(CONFIG_FILE, 'r') as f:
@@ -21,10 +21,13 @@ import logging
 import pandas as pd
 from frictionless import Package
 
+from storage.candidates import CandidateStore
+
 GEO_FOLDER = '../../../data/auxiliary/geographic'
 GEO_FILE = 'municipality.csv'
 OUTPUT_FOLDER = '../../../data/unverified'
 OUTPUT_FILE = 'municipality-website-candidate-links.csv'
+SOURCE_NAME = 'dbpedia'
 re_remove_parenthesis = re.compile(r'[^(,]+')
 
 def get_config(file_name: str = 'config.yaml') -> dict:
@@ -242,9 +245,9 @@ def clean_dbpedia_links(table: pd.DataFrame) -> pd.DataFrame:
     return table
 
 def store_dbpedia_links(table: pd.DataFrame, output_folder: str,
-    output_file: str):
-    """Store the links in a CSV file. If the file already exists, merge
-    the existing with the obtained data.
+    output_file: str, source: str = SOURCE_NAME) -> int:
+    """Store the links in the candidate links file. Links already in the
+    file are only recorded as seen again by this source.
 
     Args:
         table (pd.DataFrame): A Pandas dataframe containing the links
@@ -253,42 +256,44 @@ def store_dbpedia_links(table: pd.DataFrame, output_folder: str,
         output_folder (str): The path where the output file should be
             stored.
         output_file: (str): The file name of the output.
-    """
-    # prepare output
+        source (str): The name of the source of the links, recorded as
+            their provenance.
 
+    Returns:
+        int: The number of new links.
+    """
     # check if the output folder alredy does exist and, if not, create it
     if not os.path.exists(output_folder):
         print(f'Output folder does not yet exist. Creating "{output_folder}"...')
         os.mkdir(output_folder)
 
     output = os.path.join(output_folder, output_file)
-    generated_df = table
-    # check whether if there is an existing file to merge
-    if os.path.exists(output):
-        recorded_df = pd.read_csv(output)
-        new_df = pd.concat([recorded_df, generated_df], sort=True)
-    else:
-        new_df = generated_df.copy()
-    # remove duplicate entries
-    new_df.drop_duplicates(inplace=True)
-    # store the results
-    new_df.to_csv(output, index=False)
+    with CandidateStore(output) as store:
+        return store.add_all(table.to_dict('records'), source)
+
+def query_source_name(query: dict) -> str:
+    """Gets the name of a query to record as the source of its links,
+    e.g. "dbpedia:dbpedia-pt".
+
+    Args:
+        query (dict): The query, as in the configuration.
+
+    Returns:
+        str: The source name.
+    """
+    return f'{SOURCE_NAME}:{os.path.splitext(query["sparql_file"])[0]}'
 
 if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
     config = get_config()
 
-    # combine data: concatenate the results
-    dbp_links = pd.concat(
-        [
-            get_dbpedia_links_dataframe(query['url'])
-            for source in config['sources']
-            for query in source['queries']
-        ],
-        sort=True
-    )
+    for source in config['sources']:
+        for query in source['queries']:
+            dbp_links = get_dbpedia_links_dataframe(query['url'])
 
-    # remove garbage links
-    dbp_links = clean_dbpedia_links(dbp_links)
+            # remove garbage links
+            dbp_links = clean_dbpedia_links(dbp_links)
 
-    # store the results
-    store_dbpedia_links(dbp_links, OUTPUT_FOLDER, OUTPUT_FILE)
+            # store the results, keeping track of which query found them
+            store_dbpedia_links(dbp_links, OUTPUT_FOLDER, OUTPUT_FILE,
+                source=query_source_name(query))
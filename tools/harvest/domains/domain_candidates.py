@@ -0,0 +1,183 @@
+"""
+This script generates candidate links for the municipality websites from
+the usual patterns of their domain names, such as <slug>.<uf>.gov.br for
+city halls and camara<slug>.<uf>.leg.br for city councils, and keeps the
+ones that answer.
+
+Usage:
+  python domain_candidates.py
+
+For instructions use:
+  python domain_candidates.py --help
+
+Este script gera links candidatos para os sites dos municípios a partir
+dos padrões usuais de nomes de domínio, como <nome>.<uf>.gov.br para as
+prefeituras e camara<nome>.<uf>.leg.br para as câmaras municipais, e
+mantém os que respondem.
+"""
+
+import argparse
+import logging
+import os
+import pathlib
+import re
+from typing import Dict, List, Optional
+
+from frictionless import Package
+from unidecode import unidecode
+
+from crawling.probe import probe_hosts, MAX_SIMULTANEOUS
+from storage.candidates import CandidateStore
+
+GEO_FOLDER = '../../../data/auxiliary/geographic'
+OUTPUT_FOLDER = '../../../data/unverified'
+OUTPUT_FILE = 'municipality-website-candidate-links.csv'
+SOURCE_NAME = 'domains'
+LINK_TYPE = 'generated'
+
+# hostname patterns, filled in with the slug of the name and the
+# lowercase state abbreviation
+PATTERNS = [
+    '{slug}.{uf}.gov.br',
+    'www.{slug}.{uf}.gov.br',
+    'pm{slug}.{uf}.gov.br',
+    'prefeitura{slug}.{uf}.gov.br',
+    'camara{slug}.{uf}.leg.br',
+    'www.camara{slug}.{uf}.leg.br',
+    '{slug}.{uf}.leg.br',
+    'cm{slug}.{uf}.gov.br',
+    'camara{slug}.{uf}.gov.br',
+]
+STOP_WORDS = {'d', 'da', 'das', 'de', 'do', 'dos', 'e'}
+
+re_non_word = re.compile(r'[^a-z0-9]+')
+
+def slug_variants(name: str) -> List[str]:
+    """Generates the ways a municipality name is usually written in
+    domain names: without accents, spaces and punctuation, either with
+    all words, without prepositions or with hyphens.
+
+    Args:
+        name (str): The name of the municipality.
+
+    Returns:
+        List[str]: The distinct slugs.
+    """
+    words = [word for word in
+        re_non_word.split(unidecode(name).lower()) if word]
+    variants = [
+        ''.join(words),
+        ''.join(word for word in words if word not in STOP_WORDS),
+        '-'.join(words),
+    ]
+    return [slug for slug in dict.fromkeys(variants) if slug]
+
+def generate_hostnames(municipalities: List[dict]) -> Dict[str, dict]:
+    """Generates the candidate hostnames of the municipalities.
+
+    Args:
+        municipalities (List[dict]): The municipalities, with the keys
+            code, name and uf.
+
+    Returns:
+        Dict[str, dict]: The municipality of each hostname. Hostnames that
+            could belong to more than one municipality are left out.
+    """
+    hostnames = {}
+    ambiguous = set()
+    for municipality in municipalities:
+        uf = municipality['uf'].lower()
+        for slug in slug_variants(municipality['name']):
+            for pattern in PATTERNS:
+                hostname = pattern.format(slug=slug, uf=uf)
+                previous = hostnames.setdefault(hostname, municipality)
+                if previous['code'] != municipality['code']:
+                    ambiguous.add(hostname)
+    for hostname in ambiguous:
+        del hostnames[hostname]
+    return hostnames
+
+def get_municipalities(geo_folder: str = GEO_FOLDER,
+    states: Optional[List[str]] = None) -> List[dict]:
+    """Reads the municipalities from the geographic data package.
+
+    Args:
+        geo_folder (str): Path to the geographic data package.
+        states (List[str]): Optional state abbreviations to restrict to.
+
+    Returns:
+        List[dict]: The municipalities, with the keys code, name and uf.
+    """
+    package = Package(os.path.join(geo_folder, 'datapackage.json'))
+    mun = package.get_resource('municipality').to_pandas()
+    if states:
+        mun = mun[mun.uf.isin([state.upper() for state in states])]
+    return mun[['code', 'name', 'uf']].to_dict('records')
+
+def generate_candidates(municipalities: List[dict],
+    max_simultaneous: int = MAX_SIMULTANEOUS) -> List[dict]:
+    """Generates the candidate hostnames and probes them.
+
+    Args:
+        municipalities (List[dict]): The municipalities, as output by
+            get_municipalities.
+        max_simultaneous (int): Maximum number of simultaneous lookups
+            and requests.
+
+    Returns:
+        List[dict]: The candidate links that answered, with the keys
+            code, link, link_type, name and uf.
+    """
+    hostnames = generate_hostnames(municipalities)
+    logging.info('Generated %d hostnames for %d municipalities.',
+        len(hostnames), len(municipalities))
+    links = []
+    for result in probe_hosts(hostnames, max_simultaneous=max_simultaneous):
+        if result.status_code is None or result.status_code >= 400:
+            continue
+        links.append({
+            **hostnames[result.hostname],
+            'link': result.url,
+            'link_type': LINK_TYPE,
+        })
+    logging.info('%d generated hostnames answered.', len(links))
+    return links
+
+def parse_cli() -> dict:
+    """Parses the command line interface.
+
+    Returns:
+        dict: A dict containing the values for states and
+            max_simultaneous.
+    """
+    parser = argparse.ArgumentParser(
+        description='Generates candidate links from the usual domain name '
+            'patterns of municipality websites.'
+    )
+    parser.add_argument('states',
+        help='abbreviations of the states to generate candidates for '
+            '(default: all)',
+        nargs='*',
+    )
+    parser.add_argument('-p', '--processes',
+        metavar='int', type=int,
+        help='number of simultaneous lookups and requests',
+        default=MAX_SIMULTANEOUS,
+    )
+    args = parser.parse_args()
+    return {
+        'states': args.states,
+        'max_simultaneous': args.processes,
+    }
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_cli()
+    candidates = generate_candidates(
+        get_municipalities(states=options['states']),
+        max_simultaneous=options['max_simultaneous'])
+    pathlib.Path(OUTPUT_FOLDER).mkdir(parents=True, exist_ok=True)
+    with CandidateStore(os.path.join(OUTPUT_FOLDER, OUTPUT_FILE)) as store:
+        added = store.add_all(candidates, SOURCE_NAME)
+    logging.info('Added %d new links to "%s".', added,
+        os.path.join(OUTPUT_FOLDER, OUTPUT_FILE))
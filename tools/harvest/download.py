@@ -0,0 +1,271 @@
+"""Download helpers shared by the harvest scripts.
+
+Files are streamed into a ``.part`` file next to their final destination
+and only renamed into place after their size and hash are verified, so
+an interrupted run never leaves a truncated file that looks complete.
+Interrupted downloads are resumed with HTTP Range requests and a small
+metadata file kept alongside each download records its size, hash and
+the validators (ETag, Last-Modified) needed to ask the server, with a
+conditional request, whether the upstream file has changed.
+
+Funções auxiliares de download usadas pelos scripts de coleta. Os
+downloads interrompidos são retomados e os arquivos são verificados
+antes de serem usados.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import time
+import urllib
+from typing import Optional
+
+import requests
+from tqdm import tqdm
+
+from settings import USER_AGENT, DEFAULT_TIMEOUT
+
+PARTIAL_SUFFIX = '.part'
+METADATA_SUFFIX = '.meta.json'
+HASH_ALGORITHM = 'sha256'
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+TARGET_CHUNK_SECONDS = 0.5
+
+def file_hash(file_path: str, algorithm: str = HASH_ALGORITHM) -> str:
+    """Computes the hash of a file, reading it in chunks.
+
+    Args:
+        file_path (str): Path to the file.
+        algorithm (str): Name of a hashlib algorithm.
+
+    Returns:
+        str: The hex digest of the file contents.
+    """
+    digest = hashlib.new(algorithm)
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(MAX_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_metadata(file_path: str) -> dict:
+    """Reads the metadata recorded for a downloaded file.
+
+    Args:
+        file_path (str): Path to the downloaded file (not the metadata
+            file itself).
+
+    Returns:
+        dict: The recorded metadata, or an empty dict if there is none.
+    """
+    try:
+        with open(file_path + METADATA_SUFFIX, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def write_metadata(file_path: str, metadata: dict):
+    """Records the metadata of a downloaded file atomically.
+
+    Args:
+        file_path (str): Path to the downloaded file (not the metadata
+            file itself).
+        metadata (dict): The metadata to record.
+    """
+    temporary = file_path + METADATA_SUFFIX + PARTIAL_SUFFIX
+    with open(temporary, 'w', encoding='utf-8') as file:
+        json.dump(metadata, file, indent=2, sort_keys=True)
+    os.replace(temporary, file_path + METADATA_SUFFIX)
+
+def is_complete(file_path: str, expected_hash: Optional[str] = None) -> bool:
+    """Checks whether a downloaded file is complete and intact.
+
+    A file is considered complete only if it has recorded metadata and
+    both its size and its hash match what was recorded when the download
+    finished. If an expected hash is given, it must match as well.
+
+    Args:
+        file_path (str): Path to the downloaded file.
+        expected_hash (str): Optional known hash of the file.
+
+    Returns:
+        bool: True if the file can be used as is.
+    """
+    if not os.path.exists(file_path):
+        return False
+    metadata = read_metadata(file_path)
+    if not metadata:
+        return False
+    if os.path.getsize(file_path) != metadata.get('size'):
+        return False
+    recorded_hash = metadata.get(HASH_ALGORITHM)
+    if expected_hash and recorded_hash != expected_hash.lower():
+        return False
+    return file_hash(file_path) == recorded_hash
+
+def _validators(metadata: dict) -> dict:
+    """Gets the request headers for a conditional request from the
+    recorded metadata.
+    """
+    headers = {}
+    if metadata.get('etag'):
+        headers['If-None-Match'] = metadata['etag']
+    if metadata.get('last_modified'):
+        headers['If-Modified-Since'] = metadata['last_modified']
+    return headers
+
+def _total_size(response: requests.Response, offset: int) -> Optional[int]:
+    """Gets the full size of the remote file from the response headers,
+    if the server informs it.
+    """
+    content_range = response.headers.get('Content-Range', '')
+    if response.status_code == 206 and '/' in content_range:
+        total = content_range.rsplit('/', 1)[-1]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get('Content-Length')
+    if length is None or response.headers.get('Content-Encoding'):
+        return None
+    return int(length) + (offset if response.status_code == 206 else 0)
+
+def _stream_to_file(response: requests.Response, file, digest,
+    progress: tqdm):
+    """Copies the response body to a file, growing the chunk size while
+    chunks arrive faster than TARGET_CHUNK_SECONDS and shrinking it when
+    they arrive slower.
+    """
+    chunk_size = MIN_CHUNK_SIZE
+    while True:
+        started = time.monotonic()
+        chunk = response.raw.read(chunk_size, decode_content=True)
+        if not chunk:
+            break
+        file.write(chunk)
+        digest.update(chunk)
+        progress.update(len(chunk))
+        elapsed = time.monotonic() - started
+        if elapsed < TARGET_CHUNK_SECONDS / 2:
+            chunk_size = min(chunk_size * 2, MAX_CHUNK_SIZE)
+        elif elapsed > TARGET_CHUNK_SECONDS * 2:
+            chunk_size = max(chunk_size // 2, MIN_CHUNK_SIZE)
+
+def download_file(folder: str, url: str, expected_hash: Optional[str] = None,
+    check_updates: bool = False,
+    session: Optional[requests.Session] = None) -> str:
+    """Download a (large) file using a progress bar.
+
+    An existing complete download is reused. If check_updates is set,
+    a conditional request is made first and the file is only downloaded
+    again if the server reports that it has changed. A partial download
+    left by an interrupted run is resumed from where it stopped, as long
+    as the server supports range requests and the remote file has not
+    changed in the meantime.
+
+    Args:
+        folder (str): The folder where to store the file.
+        url (str): The url of the file to download.
+        expected_hash (str): Optional known hash (sha256) of the file.
+        check_updates (bool): Whether or not to ask the server if an
+            already downloaded file has changed.
+        session (requests.Session): Optional session to reuse.
+
+    Returns:
+        str: The path to the downloaded file.
+    """
+    pathlib.Path(folder).mkdir(parents=True, exist_ok=True)
+    file_name = os.path.basename(urllib.parse.urlparse(url).path)
+    local_filename = os.path.join(folder, file_name)
+    partial_filename = local_filename + PARTIAL_SUFFIX
+    session = session or requests.Session()
+    headers = {'user-agent': USER_AGENT}
+
+    metadata = read_metadata(local_filename)
+    if is_complete(local_filename, expected_hash):
+        if not check_updates:
+            logging.info('Using cached file "%s".', local_filename)
+            return local_filename
+        headers.update(_validators(metadata))
+
+    # resume a partial download, if the remote file is still the same
+    partial_metadata = read_metadata(partial_filename)
+    offset = 0
+    if os.path.exists(partial_filename) and partial_metadata.get('url') == url:
+        offset = os.path.getsize(partial_filename)
+        validator = partial_metadata.get('etag') or \
+            partial_metadata.get('last_modified')
+        if offset and validator:
+            headers['Range'] = f'bytes={offset}-'
+            headers['If-Range'] = validator
+            # the conditional headers do not apply to a range request
+            headers.pop('If-None-Match', None)
+            headers.pop('If-Modified-Since', None)
+        else:
+            offset = 0
+
+    try:
+        response = session.get(url, headers=headers, stream=True,
+            timeout=DEFAULT_TIMEOUT)
+    except requests.exceptions.ConnectionError:
+        if is_complete(local_filename, expected_hash):
+            logging.warning('Unable to check "%s" for updates, '
+                'using cached file.', url)
+            return local_filename
+        raise
+
+    with response:
+        if response.status_code == 304:
+            logging.info('Remote file has not changed, using cached file '
+                '"%s".', local_filename)
+            return local_filename
+        if response.status_code == 416: # cached partial file is unusable
+            os.remove(partial_filename)
+            return download_file(folder, url, expected_hash, check_updates,
+                session)
+        response.raise_for_status()
+        if response.status_code != 206:
+            offset = 0 # the server sent the whole file
+        if offset:
+            logging.info('Resuming download of "%s" at byte %d.', url, offset)
+        else:
+            logging.info('Downloading "%s"...', url)
+
+        total = _total_size(response, offset)
+        write_metadata(partial_filename, {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        })
+
+        digest = hashlib.new(HASH_ALGORITHM)
+        if offset:
+            with open(partial_filename, 'rb') as file:
+                for chunk in iter(lambda: file.read(MAX_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        with open(partial_filename, 'ab' if offset else 'wb') as file:
+            with tqdm(total=total, initial=offset, unit='B',
+                      unit_scale=True, unit_divisor=1024) as progress:
+                _stream_to_file(response, file, digest, progress)
+            file.flush()
+            os.fsync(file.fileno())
+
+    size = os.path.getsize(partial_filename)
+    if total is not None and size != total:
+        raise IOError(f'Incomplete download of {url}: got {size} bytes, '
+            f'expected {total}. Run again to resume.')
+    hexdigest = digest.hexdigest()
+    if expected_hash and hexdigest != expected_hash.lower():
+        os.remove(partial_filename)
+        os.remove(partial_filename + METADATA_SUFFIX)
+        raise IOError(f'Hash mismatch for {url}: got {hexdigest}, '
+            f'expected {expected_hash}.')
+
+    partial_metadata = read_metadata(partial_filename)
+    os.replace(partial_filename, local_filename)
+    os.remove(partial_filename + METADATA_SUFFIX)
+    write_metadata(local_filename, {
+        **partial_metadata,
+        'size': size,
+        HASH_ALGORITHM: hexdigest,
+    })
+    return local_filename
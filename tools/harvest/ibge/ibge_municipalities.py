@@ -3,43 +3,57 @@ municipalities. This will be useful later for disambiguation and finding out
 the municipality codes.
 
 Usage:
-  python ibge_municipalities.py
+  python ibge_municipalities.py [--years 2021 2022 ...]
+
+For instructions use:
+  python ibge_municipalities.py --help
 
 Este script faz o download e armazena dados auxiliares do IBGE sobre os
 municípios. Isso será útil mais tarde para desambiguação e para descobrir
 os códigos de municípios.
 """
 
-import os, io, pathlib
+import os, re, pathlib, shutil
+import argparse
 import urllib
-import requests
 import ftplib
+import tempfile
 from zipfile import ZipFile
 import logging
+from typing import Tuple
 
 from tqdm import tqdm
 import pandas as pd
 from frictionless import Package
+from unidecode import unidecode
+
+from harvest.download import download_file, file_hash, read_metadata
+from storage.writer import write_csv, write_resource
 
 TEMPORARY_FOLDER = '../../../data/download-cache'
-DOWNLOAD_URL = 'https://geoftp.ibge.gov.br/organizacao_do_territorio/estrutura_territorial/divisao_territorial/2021/DTB_2021.zip'
+DOWNLOAD_URL_TEMPLATE = 'https://geoftp.ibge.gov.br/organizacao_do_territorio/estrutura_territorial/divisao_territorial/{year}/DTB_{year}.zip'
+DEFAULT_YEARS = [2021]
+DOWNLOAD_URL = DOWNLOAD_URL_TEMPLATE.format(year=DEFAULT_YEARS[-1])
 OUTPUT_FOLDER = '../../../data/auxiliary/geographic'
 OUTPUT_FILE = 'municipality.csv'
+CHANGES_FILE = 'municipality-changes.csv'
+CHANGES_COLUMNS = ['year', 'change', 'code', 'uf', 'name', 'old_uf', 'old_name']
 
 IBGE_FILE_NAME = os.path.basename(urllib.parse.urlparse(DOWNLOAD_URL).path)
 
-def download_file(folder, url):
-    'Download a (large) file using a progress bar.'
-    local_filename = os.path.join(folder,url.split('/')[-1])
-    # NOTE the stream=True parameter below
-    with requests.get(url, stream=True) as response:
-        response.raise_for_status()
-        with open(local_filename, 'wb') as file:
-            for chunk in tqdm(response.iter_content(chunk_size=8192)):
-                if chunk: # filter out keep-alive new chunks
-                    file.write(chunk)
-                    # f.flush()
-    return local_filename
+# the municipality spreadsheet has had slightly different names along
+# the years, e.g. RELATORIO_DTB_BRASIL_MUNICIPIO.xls or
+# RELATORIO_DTB_BRASIL_2024_MUNICIPIOS.xlsx
+re_municipality_member = re.compile(
+    r'RELATORIO_DTB_BRASIL.*MUNICIPIO.*\.xlsx?$', re.IGNORECASE)
+
+# the only columns we need from the spreadsheet, as normalized by
+# normalize_column_name, and their names in the original file
+NEEDED_COLUMNS = {
+    'uf': 'UF',
+    'codigomunicipiocompleto': 'Código Município Completo',
+    'nomemunicipio': 'Nome_Município',
+}
 
 def download_ftp_file(folder, url):
     'Download a file using the FTP protocol using a progress bar.'
@@ -61,36 +75,119 @@ def download_ftp_file(folder, url):
                 download_chunk
             )
 
+def normalize_column_name(name: str) -> str:
+    """Normalizes a spreadsheet column name, so that small variations
+    of case, accents, spaces and underscores among the DTB years do not
+    matter.
+
+    Args:
+        name (str): The column name as it appears in the spreadsheet.
+
+    Returns:
+        str: The normalized column name.
+    """
+    return re.sub(r'[^a-z]', '', unidecode(str(name)).lower())
+
+def find_municipality_member(pacote: ZipFile) -> str:
+    """Finds the name of the municipality spreadsheet inside the DTB
+    zip file.
+
+    Args:
+        pacote (ZipFile): The opened DTB zip file.
+
+    Returns:
+        str: The name of the zip member containing the spreadsheet.
+    """
+    members = [
+        name for name in pacote.namelist()
+        if re_municipality_member.search(os.path.basename(name))
+    ]
+    if not members:
+        raise ValueError(
+            'Municipality spreadsheet not found in the IBGE file. '
+            f'Members are: {pacote.namelist()}')
+    return sorted(members, key=len)[0]
+
+def read_municipality_spreadsheet(file_path: str) -> pd.DataFrame:
+    """Reads only the needed columns from the municipality spreadsheet
+    inside the DTB zip file.
+
+    The spreadsheet is streamed out of the zip file into a temporary
+    file instead of being fully read into memory, and then parsed from
+    disk.
+
+    Args:
+        file_path (str): Path to the DTB zip file.
+
+    Returns:
+        pd.DataFrame: A dataframe containing the UF code, municipality
+            code and municipality name, with their original column names.
+    """
+    with ZipFile(file_path) as pacote:
+        member = find_municipality_member(pacote)
+        logging.info('Reading "%s" from "%s"...', member, file_path)
+        suffix = os.path.splitext(member)[1]
+        with tempfile.TemporaryDirectory() as tmp_folder:
+            spreadsheet = os.path.join(tmp_folder, f'municipalities{suffix}')
+            with pacote.open(member) as source, \
+                    open(spreadsheet, 'wb') as destination:
+                shutil.copyfileobj(source, destination)
+            table = pd.read_excel(
+                spreadsheet,
+                usecols=lambda column: normalize_column_name(column) \
+                    in NEEDED_COLUMNS,
+            )
+
+    table.rename(
+        columns=lambda column: NEEDED_COLUMNS[normalize_column_name(column)],
+        inplace=True
+    )
+    missing = set(NEEDED_COLUMNS.values()) - set(table.columns)
+    if missing:
+        raise ValueError(f'Columns not found in the IBGE spreadsheet: {missing}')
+
+    return table.astype({
+        'UF': 'int64',
+        'Código Município Completo': 'int64',
+        'Nome_Município': 'string',
+    })
+
 def fetch_ibge_spreadsheet(tmp_path: str,
-    url: str) -> pd.DataFrame:
+    url: str, check_updates: bool = True) -> pd.DataFrame:
     """Check if folder and downloaded file already do exist and, if not,
     create and download them.
 
+    A downloaded file is only reused if it is complete and intact. A
+    partial download left by an interrupted run is resumed. The parsed
+    spreadsheet is cached in a Feather file named after the hash of the
+    zip file, so that the slow Excel parsing only happens once for each
+    version of the IBGE file.
+
     Args:
         tmp_path (str): Temporary folder path.
         url (str): The url of the file to download.
+        check_updates (bool): Whether or not to ask the server if the
+            file has changed since it was downloaded.
     """
-    file_name = os.path.basename(urllib.parse.urlparse(url).path)
-
     if not os.path.exists(tmp_path):
         logging.info('Temporary folder does not yet exist. Creating "%s"...', tmp_path)
         pathlib.Path(tmp_path).mkdir(parents=True, exist_ok=True)
 
-    if not os.path.exists(os.path.join(tmp_path, file_name)):
-        logging.info('IBGE file does not yet exist. Downloading from "%s"...', url)
-        download_file(tmp_path, url)
+    file_path = download_file(tmp_path, url, check_updates=check_updates)
 
-    # unpack the zipped file
-    with ZipFile(os.path.join(tmp_path, file_name)) as pacote:
-        with io.BytesIO(pacote.read('RELATORIO_DTB_BRASIL_MUNICIPIO.xls')) as f:
-            table = pd.read_excel(
-                f,
-                dtype={
-                    'Nome_UF': 'category',
-                    'Nome_Mesorregião': 'category',
-                    'Nome_Microrregião': 'category'
-                }
-            )
+    archive_hash = read_metadata(file_path).get('sha256') or file_hash(file_path)
+    cache_file = os.path.join(tmp_path,
+        f'{os.path.basename(file_path)}.{archive_hash[:16]}.feather')
+    if os.path.exists(cache_file):
+        logging.info('Using parsed IBGE data cached in "%s".', cache_file)
+        return pd.read_feather(cache_file)
+
+    table = read_municipality_spreadsheet(file_path)
+    # written aside and then renamed, so an interrupted run does not
+    # leave a truncated cache that would be read as valid
+    temporary = cache_file + '.part'
+    table.to_feather(temporary)
+    os.replace(temporary, cache_file)
 
     return table
 
@@ -142,40 +239,204 @@ def remove_and_rename_columns(table: pd.DataFrame) -> pd.DataFrame:
 
     return table
 
-def merge_existing(table: pd.DataFrame, data_package_path: str) -> pd.DataFrame:
-    """Merges with existing data.
+def get_existing(data_package_path: str) -> pd.DataFrame:
+    """Reads the existing municipality data, if present.
 
     Args:
-        table (pd.DataFrame): A Pandas dataframe with the new data.
-        data_package_path (str): Path to the data package with exsiting
+        data_package_path (str): Path to the data package with existing
             data.
 
     Returns:
-        pd.DataFrame: The pandas dataframe with the merged data.
+        pd.DataFrame: The existing data, or None if there is none.
     """
-    # checks if the table already exists. If not, return just the new data
     data_package_file_name = os.path.join(data_package_path,
         'datapackage.json')
     if not os.path.exists(data_package_file_name):
-        print(data_package_file_name)
-        return table
+        logging.info('Data package "%s" not found.', data_package_file_name)
+        return None
     package = Package(data_package_file_name)
     resource = package.get_resource('municipality')
     resource_path = os.path.join(data_package_path, resource.path)
     if not os.path.exists(resource_path):
-        print(resource_path)
-        return table
-    old_table = resource.to_pandas()
-    # update rows that might have changed
-    old_table.set_index('code').update(table.set_index('code'))
-    # add new rows that might have been added
-    new_values = table[~table.code.isin(old_table.code.unique())]
-    return pd.concat([old_table, new_values])
+        logging.info('Resource "%s" not found.', resource_path)
+        return None
+    return resource.to_pandas()
 
-if __name__ == '__main__':
-    table = fetch_ibge_spreadsheet(TEMPORARY_FOLDER, DOWNLOAD_URL)
+def get_dtb_table(year: int, tmp_path: str = TEMPORARY_FOLDER,
+    check_updates: bool = True) -> pd.DataFrame:
+    """Gets the municipalities in the IBGE territorial division (DTB) of
+    a given year, in our schema.
+
+    Args:
+        year (int): The year of the territorial division.
+        tmp_path (str): Temporary folder path.
+        check_updates (bool): Whether or not to ask the server if the
+            file has changed since it was downloaded.
+
+    Returns:
+        pd.DataFrame: The dataframe with uf, code and name columns.
+    """
+    table = fetch_ibge_spreadsheet(
+        tmp_path, DOWNLOAD_URL_TEMPLATE.format(year=year), check_updates)
     table = add_state_codes(table)
-    table = remove_and_rename_columns(table)
-    table = merge_existing(table, OUTPUT_FOLDER)
-    table = table.sort_values(['uf', 'name', 'code'])
-    table.to_csv(os.path.join(OUTPUT_FOLDER, OUTPUT_FILE), index=False)
+    return remove_and_rename_columns(table)
+
+def diff_municipalities(old: pd.DataFrame, new: pd.DataFrame) -> pd.DataFrame:
+    """Compares two lists of municipalities by their codes.
+
+    Args:
+        old (pd.DataFrame): The older list, with uf, code and name columns.
+        new (pd.DataFrame): The newer list, with uf, code and name columns.
+
+    Returns:
+        pd.DataFrame: One row for each municipality that was added,
+            removed or renamed (including moving to another state), with
+            the columns change, code, uf, name, old_uf and old_name.
+    """
+    columns = ['uf', 'code', 'name']
+    compared = (
+        old.loc[:, columns].astype({'uf': 'string', 'name': 'string'})
+        .merge(
+            new.loc[:, columns].astype({'uf': 'string', 'name': 'string'}),
+            on='code',
+            how='outer',
+            suffixes=('_old', ''),
+            indicator=True,
+        )
+        .rename(columns={'uf_old': 'old_uf', 'name_old': 'old_name'})
+    )
+    renamed = (
+        (compared['_merge'] == 'both') &
+        (
+            (compared['old_uf'] != compared['uf']) |
+            (compared['old_name'] != compared['name'])
+        )
+    )
+    compared['change'] = pd.NA
+    compared.loc[compared['_merge'] == 'right_only', 'change'] = 'added'
+    compared.loc[compared['_merge'] == 'left_only', 'change'] = 'removed'
+    compared.loc[renamed, 'change'] = 'renamed'
+    return (
+        compared
+        .loc[compared.change.notna(), CHANGES_COLUMNS[1:]]
+        .sort_values(by=['change', 'code'])
+        .reset_index(drop=True)
+    )
+
+def apply_diff(table: pd.DataFrame, diff: pd.DataFrame) -> pd.DataFrame:
+    """Applies the changes obtained with diff_municipalities to the
+    municipality table, keeping any other columns (e.g. the DBPedia and
+    Wikidata URIs) of the municipalities that remain.
+
+    Args:
+        table (pd.DataFrame): The municipality table.
+        diff (pd.DataFrame): The changes to apply.
+
+    Returns:
+        pd.DataFrame: The updated municipality table.
+    """
+    columns = table.columns
+    removed = diff.loc[diff.change == 'removed', 'code']
+    table = table.loc[~table.code.isin(removed)].set_index('code')
+
+    renamed = diff.loc[diff.change == 'renamed'].set_index('code')
+    table.loc[renamed.index, 'uf'] = renamed['uf']
+    table.loc[renamed.index, 'name'] = renamed['name']
+
+    added = (
+        diff.loc[diff.change == 'added', ['uf', 'code', 'name']]
+        .set_index('code')
+    )
+    return pd.concat([table, added]).reset_index().loc[:, columns]
+
+def record_changes(changes: pd.DataFrame, output_path: str):
+    """Appends changes to the change log file.
+
+    Args:
+        changes (pd.DataFrame): The changes, with the columns in
+            CHANGES_COLUMNS.
+        output_path (str): Path to the change log csv file.
+    """
+    if changes.empty:
+        return
+    logging.info('Recording %d changes to "%s".', len(changes), output_path)
+    if os.path.exists(output_path):
+        changes = pd.concat([pd.read_csv(output_path), changes])
+    # the existing rows are kept as they are, so only the new ones show in diffs
+    write_csv(changes.loc[:, CHANGES_COLUMNS], output_path)
+
+def update_municipalities(years: list, data_package_path: str,
+    tmp_path: str = TEMPORARY_FOLDER,
+    check_updates: bool = True) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Brings the municipality table up to date with the territorial
+    divisions of the given years, in order.
+
+    The table is only changed where the divisions differ: each year is
+    compared to the previous one (the first to the existing data) and
+    the resulting changes are applied in turn.
+
+    Args:
+        years (list): The years of the territorial divisions to ingest.
+        data_package_path (str): Path to the data package with existing
+            data.
+        tmp_path (str): Temporary folder path.
+        check_updates (bool): Whether or not to ask the server if the
+            files have changed since they were downloaded.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: The updated municipality
+            table and the changes applied, with a column for the year.
+    """
+    table = get_existing(data_package_path)
+    previous = table
+    all_changes = []
+    for year in sorted(years):
+        current = get_dtb_table(year, tmp_path, check_updates)
+        if previous is None:
+            table = current
+        else:
+            changes = diff_municipalities(previous, current)
+            logging.info('DTB %d: %s', year,
+                changes.change.value_counts().to_dict())
+            table = apply_diff(table, changes)
+            changes.insert(0, 'year', year)
+            all_changes.append(changes)
+        previous = current
+    changes = pd.concat(all_changes) if all_changes else \
+        pd.DataFrame(columns=CHANGES_COLUMNS)
+    return table, changes
+
+def parse_cli() -> dict:
+    """Parses the command line interface.
+
+    Returns:
+        dict: A dict containing the values for years and check_updates.
+    """
+    parser = argparse.ArgumentParser(
+        description='Downloads municipality data from the IBGE territorial '
+            'division (DTB) files and updates the municipality table.'
+    )
+    parser.add_argument('-y', '--years',
+        metavar='int', type=int, nargs='+',
+        help='years of the territorial divisions to ingest, in order',
+        default=DEFAULT_YEARS,
+    )
+    parser.add_argument('--no-check-updates',
+        help='do not ask the server whether downloaded files have changed',
+        action='store_true',
+    )
+    args = parser.parse_args()
+    return {
+        'years': args.years,
+        'check_updates': not args.no_check_updates,
+    }
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_cli()
+    table, changes = update_municipalities(
+        options['years'], OUTPUT_FOLDER,
+        check_updates=options['check_updates'])
+    write_resource(table, os.path.join(OUTPUT_FOLDER, 'datapackage.json'),
+        'municipality', sort_by=['uf', 'name', 'code'])
+    record_changes(changes, os.path.join(OUTPUT_FOLDER, CHANGES_FILE))
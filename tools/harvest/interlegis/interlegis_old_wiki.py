@@ -0,0 +1,350 @@
+"""interlegis_old_wiki.py
+
+This script reads the lists of city council and city hall websites from
+archived versions (Web Archive) of the old Interlegis wiki page about the
+Portal Modelo and appends them to the candidate links file.
+
+Usage:
+    python interlegis_old_wiki.py
+
+For instructions use:
+    python interlegis_old_wiki.py --help
+
+Este script lê as listas de sites de câmaras e prefeituras das versões
+arquivadas (Web Archive) da antiga página do wiki do Interlegis sobre o
+Portal Modelo e as acrescenta ao arquivo de links candidatos.
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import pathlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import urlparse
+
+import requests
+from bs4 import BeautifulSoup
+from frictionless import Package
+from unidecode import unidecode
+
+from settings import USER_AGENT, DEFAULT_TIMEOUT
+from storage.candidates import CandidateStore
+
+GEO_FOLDER = '../../../data/auxiliary/geographic'
+CACHE_FOLDER = '../../../data/download-cache/interlegis'
+OUTPUT_FOLDER = '../../../data/unverified'
+OUTPUT_FILE = 'municipality-website-candidate-links.csv'
+SOURCE_NAME = 'interlegis'
+BATCH_SIZE = 500
+MAX_SIMULTANEOUS = 4
+
+ORIGINAL_URL = 'http://colab.interlegis.leg.br:80/wiki/CasasUsamPortalModelo'
+SOURCE_URL = 'https://web.archive.org/web/20190110071424/http://colab.interlegis.leg.br:80/wiki/CasasUsamPortalModelo'
+CDX_URL = 'https://web.archive.org/cdx/search/cdx'
+
+# links in archived pages point to the Web Archive, e.g.
+# /web/20190110071424/http://www.camara.sp.leg.br/
+re_wayback_link = re.compile(
+    r'^(?:https?://web\.archive\.org)?/web/\d+[a-z_]*/(?P<url>.+)$')
+
+def normalize_name(name: str) -> str:
+    """Normalizes a municipality name for comparison, removing accents,
+    case, punctuation and extra spaces.
+
+    Args:
+        name (str): The municipality name.
+
+    Returns:
+        str: The normalized name.
+    """
+    return ' '.join(re.sub(r'[^a-z0-9 ]', ' ', unidecode(name).lower()).split())
+
+def original_url(href: str) -> str:
+    """Gets the original url from a link rewritten by the Web Archive.
+
+    Args:
+        href (str): The link, as found in the archived page.
+
+    Returns:
+        str: The original url.
+    """
+    match = re_wayback_link.match(href)
+    return match.group('url') if match else href
+
+def state_from_hostname(hostname: str) -> Optional[str]:
+    """Gets the state (UF) abbreviation from a hostname such as
+    www.cidade.sp.leg.br or www.cidade.sp.gov.br.
+
+    Args:
+        hostname (str): The hostname.
+
+    Returns:
+        str: The UF abbreviation, or None if it is not in the hostname.
+    """
+    parts = (hostname or '').lower().split('.')
+    if len(parts) >= 3 and parts[-1] == 'br' and len(parts[-3]) == 2 \
+            and parts[-2] in ('leg', 'gov'):
+        return parts[-3].upper()
+    return None
+
+def fetch_snapshot(url: str, cache_folder: str = CACHE_FOLDER,
+    session: Optional[requests.Session] = None) -> bytes:
+    """Gets the contents of an archived page. As Web Archive snapshots do
+    not change, they are cached on disk and downloaded only once.
+
+    Args:
+        url (str): The url of the snapshot.
+        cache_folder (str): The folder where to cache snapshots.
+        session (requests.Session): Optional session to reuse.
+
+    Returns:
+        bytes: The contents of the page.
+    """
+    pathlib.Path(cache_folder).mkdir(parents=True, exist_ok=True)
+    cache_file = os.path.join(cache_folder,
+        hashlib.sha1(url.encode('utf-8')).hexdigest() + '.html')
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as file:
+            return file.read()
+
+    logging.info('Downloading snapshot "%s"...', url)
+    response = (session or requests).get(
+        url,
+        headers={'user-agent': USER_AGENT},
+        timeout=DEFAULT_TIMEOUT * 3
+    )
+    if response.status_code != 200:
+        raise ValueError(
+            f'Request to {url} failed with status code {response.status_code}'
+            )
+    temporary = cache_file + '.part'
+    with open(temporary, 'wb') as file:
+        file.write(response.content)
+    os.replace(temporary, cache_file)
+    return response.content
+
+def list_snapshots(url: str = ORIGINAL_URL, limit: int = 20) -> List[str]:
+    """Lists the distinct archived versions of a page, using the Web
+    Archive CDX API.
+
+    Args:
+        url (str): The original url of the page.
+        limit (int): Maximum number of snapshots to list.
+
+    Returns:
+        List[str]: The urls of the snapshots.
+    """
+    response = requests.get(
+        CDX_URL,
+        params={
+            'url': url,
+            'output': 'json',
+            'filter': 'statuscode:200',
+            'collapse': 'digest', # skip unchanged versions
+            'limit': limit,
+        },
+        headers={'user-agent': USER_AGENT},
+        timeout=DEFAULT_TIMEOUT * 3
+    )
+    response.raise_for_status()
+    rows = response.json()
+    if not rows:
+        return []
+    header, rows = rows[0], rows[1:]
+    timestamp, original = header.index('timestamp'), header.index('original')
+    return [
+        f'https://web.archive.org/web/{row[timestamp]}/{row[original]}'
+        for row in rows
+    ]
+
+def parse_portals(content: bytes) -> List[dict]:
+    """Reads the city council and city hall links from the wiki page.
+
+    The page lists the city councils first and then, in the list right
+    after the "Prefeituras" heading, the city halls. Whatever follows
+    that list, such as the links at the foot of the wiki, is left out.
+    The document is walked only once, keeping track of which section the
+    current item is in.
+
+    Args:
+        content (bytes): The contents of the page.
+
+    Returns:
+        List[dict]: A list of dicts with the keys name, link, link_type
+            and uf.
+    """
+    soup = BeautifulSoup(content, 'html.parser')
+    wikipage = soup.find(id='wikipage')
+    if wikipage is None:
+        return []
+
+    portals = []
+    link_type, city_halls = 'camara', None
+    for element in wikipage.find_all(True):
+        if element.get('id') == 'Prefeituras':
+            link_type, city_halls = 'prefeitura', element.find_next('ul')
+            continue
+        if element.name != 'li' or element.a is None \
+                or not element.a.get('href'):
+            continue
+        if link_type == 'prefeitura' and \
+                not any(parent is city_halls for parent in element.parents):
+            continue # not in the list of city halls
+        link = original_url(element.a['href'])
+        uf = state_from_hostname(urlparse(link).hostname)
+        if link_type == 'camara' and uf is None:
+            continue # not a link to a city council website
+        portals.append({
+            'name': element.get_text().split('-')[0].strip(),
+            'link': link,
+            'link_type': link_type,
+            'uf': uf,
+        })
+    return portals
+
+def get_municipality_codes(geo_folder: str = GEO_FOLDER) -> (Dict, Dict):
+    """Builds lookup tables for the IBGE municipality codes.
+
+    Args:
+        geo_folder (str): Path to the geographic data package.
+
+    Returns:
+        (dict, dict): A dict from (uf, normalized name) to code and a dict
+            from normalized name to code, containing only the names that
+            are unique in the country.
+    """
+    package = Package(os.path.join(geo_folder, 'datapackage.json'))
+    mun = package.get_resource('municipality').to_pandas()
+    mun['key'] = mun.name.apply(normalize_name)
+    by_state = dict(zip(zip(mun.uf, mun.key), mun.code))
+    unique = mun.drop_duplicates(subset='key', keep=False)
+    by_name = dict(zip(unique.key, unique.code))
+    return by_state, by_name
+
+def resolve_codes(portals: Iterable[dict], geo_folder: str = GEO_FOLDER) \
+        -> List[dict]:
+    """Sets the IBGE code (and the UF, if missing) of each portal.
+    Portals whose municipality cannot be found are left out.
+
+    Args:
+        portals (Iterable[dict]): The portals, as output by parse_portals.
+        geo_folder (str): Path to the geographic data package.
+
+    Returns:
+        List[dict]: The portals with the code set.
+    """
+    by_state, by_name = get_municipality_codes(geo_folder)
+    uf_of_code = {code: uf for (uf, _), code in by_state.items()}
+    resolved = []
+    for portal in portals:
+        key = normalize_name(portal['name'])
+        code = by_state.get((portal['uf'], key)) if portal['uf'] \
+            else by_name.get(key)
+        if code is None:
+            logging.warning('Municipality not found: %s (%s).',
+                portal['name'], portal['uf'])
+            continue
+        resolved.append({**portal, 'code': code, 'uf': uf_of_code[code]})
+    return resolved
+
+def append_candidates(portals: List[dict], output_folder: str = OUTPUT_FOLDER,
+    output_file: str = OUTPUT_FILE, batch_size: int = BATCH_SIZE) -> int:
+    """Adds the links not yet present to the candidate links file,
+    writing them in batches.
+
+    Args:
+        portals (List[dict]): The portals, with the code set.
+        output_folder (str): The folder of the candidate links file.
+        output_file (str): The name of the candidate links file.
+        batch_size (int): Number of rows to write at a time.
+
+    Returns:
+        int: The number of rows appended.
+    """
+    pathlib.Path(output_folder).mkdir(parents=True, exist_ok=True)
+    with CandidateStore(os.path.join(output_folder, output_file)) as store:
+        return store.add_all(portals, SOURCE_NAME, batch_size)
+
+def harvest(snapshot_urls: List[str], max_simultaneous: int = MAX_SIMULTANEOUS,
+    cache_folder: str = CACHE_FOLDER, geo_folder: str = GEO_FOLDER) \
+        -> List[dict]:
+    """Fetches several snapshots of the wiki page concurrently and reads
+    the portals from all of them.
+
+    Args:
+        snapshot_urls (List[str]): The urls of the snapshots.
+        max_simultaneous (int): Maximum number of simultaneous downloads.
+        cache_folder (str): The folder where to cache snapshots.
+        geo_folder (str): Path to the geographic data package.
+
+    Returns:
+        List[dict]: The distinct portals found, with codes resolved.
+    """
+    session = requests.Session()
+    def fetch(url):
+        try:
+            return fetch_snapshot(url, cache_folder, session)
+        except (requests.exceptions.RequestException, ValueError) as error:
+            logging.warning('Unable to fetch snapshot "%s": %s', url, error)
+            return b''
+
+    portals = {}
+    with ThreadPoolExecutor(max_workers=max_simultaneous) as executor:
+        for url, content in zip(snapshot_urls, executor.map(fetch, snapshot_urls)):
+            if not content:
+                continue
+            found = parse_portals(content)
+            logging.info('Read data about %d portals from "%s".',
+                len(found), url)
+            for portal in found:
+                portals.setdefault(portal['link'], portal)
+
+    logging.info("Read data about %d portals from Interlegis' old wiki.",
+        len(portals))
+    return resolve_codes(portals.values(), geo_folder)
+
+def parse_cli() -> dict:
+    """Parses the command line interface.
+
+    Returns:
+        dict: A dict containing the values for snapshot_urls and
+            max_simultaneous.
+    """
+    parser = argparse.ArgumentParser(
+        description="Reads city council and city hall websites from "
+            "archived versions of Interlegis' old wiki."
+    )
+    parser.add_argument('snapshots',
+        help='urls of Web Archive snapshots of the page',
+        nargs='*',
+    )
+    parser.add_argument('-a', '--all-snapshots',
+        metavar='int', type=int,
+        help='use up to this many distinct snapshots listed by the Web Archive',
+        default=0,
+    )
+    parser.add_argument('-p', '--processes',
+        metavar='int', type=int,
+        help='number of simultaneous downloads',
+        default=MAX_SIMULTANEOUS,
+    )
+    args = parser.parse_args()
+    snapshot_urls = args.snapshots or [SOURCE_URL]
+    if args.all_snapshots:
+        snapshot_urls = list(dict.fromkeys(
+            snapshot_urls + list_snapshots(limit=args.all_snapshots)))
+    return {
+        'snapshot_urls': snapshot_urls,
+        'max_simultaneous': args.processes,
+    }
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_cli()
+    found_portals = harvest(**options)
+    appended = append_candidates(found_portals)
+    logging.info('Appended %d new links to "%s".', appended,
+        os.path.join(OUTPUT_FOLDER, OUTPUT_FILE))
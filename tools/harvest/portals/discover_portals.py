@@ -0,0 +1,346 @@
+"""
+This script looks for transparency and open data portals by crawling the
+verified municipality and state websites. Starting from the home page of
+each website, it follows the links within the same site whose text or
+url mention transparency or open data, up to a maximum depth and number
+of pages per site, and records as portal candidates the links that do,
+with the number of websites that link to each of them.
+
+Usage:
+  python discover_portals.py
+
+For instructions use:
+  python discover_portals.py --help
+
+Este script procura portais da transparência e de dados abertos
+navegando pelos sites verificados de municípios e estados. A partir da
+página inicial de cada site, segue os links do próprio site cujo texto
+ou url mencionam transparência ou dados abertos, até uma profundidade e
+quantidade de páginas máximas por site, e registra esses links como
+candidatos a portais.
+"""
+
+import argparse
+import logging
+import os
+import re
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import pandas as pd
+from bs4 import BeautifulSoup
+from frictionless import Package
+from tqdm import tqdm
+from unidecode import unidecode
+
+from crawling import robots, warc
+from crawling.fetch import Page, fetch_page
+from crawling.politeness import HostScheduler, host_of, MIN_DELAY
+from storage.candidates import normalize_url
+from validation.fingerprint import identify_page
+from storage.upsert import upsert
+from storage.writer import write_csv
+
+DATA_PACKAGE_PATH = '../../../data/valid/datapackage.json'
+WEBSITE_RESOURCE_NAME = 'brazilian-municipality-and-state-websites'
+OUTPUT_FOLDER = '../../../data/unverified'
+OUTPUT_FILE = 'portal-candidate-links.csv'
+OUTPUT_COLUMNS = ['state_code', 'municipality_code', 'municipality', 'sphere',
+    'branch', 'url', 'type', 'platform', 'found_on', 'anchor', 'shared_by']
+SITE_COLUMNS = ['state_code', 'municipality_code', 'sphere', 'branch']
+MAX_DEPTH = 2
+MAX_PAGES = 20 # per site
+MAX_SIMULTANEOUS = 32
+WARC_FOLDER = '../../../data/download-cache/warc'
+ROBOTS_CACHE = '../../../data/download-cache/robots.sqlite'
+
+re_transparency = re.compile(
+    r'transparencia|acesso a informacao|lei de acesso|\be-sic\b|\besic\b')
+re_open_data = re.compile(r'dados[ _-]?abertos|open[ _-]?data|\bckan\b')
+re_file = re.compile(r'\.(?:pdf|docx?|xlsx?|odt|ods|zip|rar|jpe?g|png|gif)$')
+
+def portal_type(text: str) -> Optional[str]:
+    """Detects the type of portal (according to KLEIN, 2017) that a link
+    leads to, from its text and url.
+
+    Args:
+        text (str): The text of the link and its url.
+
+    Returns:
+        str: SPT (transparency only), PEDAG (open data only), PTDAG (both)
+            or None if the link seems to be of neither.
+    """
+    text = unidecode(text).lower()
+    transparency = bool(re_transparency.search(text))
+    open_data = bool(re_open_data.search(text))
+    if transparency and open_data:
+        return 'PTDAG'
+    if transparency:
+        return 'SPT'
+    if open_data:
+        return 'PEDAG'
+    return None
+
+def same_site(url: str, start_url: str) -> bool:
+    """Checks whether a url is on the same site as the start url,
+    ignoring the "www." prefix.
+
+    Args:
+        url (str): The url.
+        start_url (str): The url where the crawl started.
+
+    Returns:
+        bool: True if both are on the same host.
+    """
+    def site(address):
+        host = host_of(address)
+        return host[len('www.'):] if host.startswith('www.') else host
+    return site(url) == site(start_url)
+
+def read_links(page: Page) -> List[dict]:
+    """Reads the links of a page.
+
+    Args:
+        page (Page): The page.
+
+    Returns:
+        List[dict]: The links, with the keys url and text.
+    """
+    base_url = page.final_url
+    soup = BeautifulSoup(
+        page.content.decode(page.encoding, 'replace'), 'html.parser')
+    links = []
+    for anchor in soup.find_all('a', href=True):
+        url = urllib.parse.urljoin(base_url, anchor['href'].strip())
+        url = urllib.parse.urldefrag(url)[0]
+        if not url.startswith(('http://', 'https://')):
+            continue
+        text = ' '.join(filter(None, [
+            anchor.get_text(' ', strip=True),
+            anchor.get('title'),
+            ' '.join(image.get('alt', '') for image in anchor.find_all('img')),
+        ]))
+        links.append({'url': url, 'text': text})
+    return links
+
+def crawl_site(website: dict, scheduler: HostScheduler,
+    max_depth: int = MAX_DEPTH, max_pages: int = MAX_PAGES) -> List[dict]:
+    """Crawls a website breadth first, following only the links within
+    the site that look like transparency or open data pages, and finds
+    the portal candidates. The platform of the candidates that are
+    fetched is identified from their pages.
+
+    Args:
+        website (dict): The website, as a row of the websites resource.
+        scheduler (HostScheduler): The scheduler shared among the
+            crawling threads.
+        max_depth (int): Maximum number of links to follow from the home
+            page.
+        max_pages (int): Maximum number of pages to fetch from the site.
+
+    Returns:
+        List[dict]: The portal candidates, with the columns of the output
+            file.
+    """
+    start_url = website['url']
+    frontier = deque([(start_url, 0)])
+    seen = {normalize_url(start_url)}
+    candidates: Dict[str, dict] = {}
+    pages = 0
+    while frontier and pages < max_pages:
+        url, depth = frontier.popleft()
+        page = fetch_page(url, scheduler)
+        pages += 1
+        if page is None or page.status_code != 200:
+            continue
+        fingerprint = identify_page(page)
+        if fingerprint and normalize_url(url) in candidates:
+            # the candidate was fetched itself: the platform is more
+            # reliable than the mentions of the link
+            candidate = candidates[normalize_url(url)]
+            candidate['platform'] = fingerprint.platform
+            candidate['type'] = fingerprint.portal_type or candidate['type']
+        for link in read_links(page):
+            detected_type = portal_type(f'{link["text"]} {link["url"]}')
+            if detected_type is None or re_file.search(
+                    urllib.parse.urlsplit(link['url']).path.lower()):
+                continue
+            key = normalize_url(link['url'])
+            if key not in candidates:
+                candidates[key] = {
+                    'state_code': website['state_code'],
+                    'municipality_code': website['municipality_code'],
+                    'municipality': website['municipality'],
+                    'sphere': website['sphere'],
+                    'branch': website['branch'],
+                    'url': link['url'],
+                    'type': detected_type,
+                    'platform': None,
+                    'found_on': page.final_url,
+                    'anchor': link['text'][:200],
+                }
+            elif candidates[key]['type'] != detected_type:
+                candidates[key]['type'] = 'PTDAG' # both kinds of mention
+            if depth < max_depth and key not in seen and \
+                    same_site(link['url'], start_url):
+                seen.add(key)
+                frontier.append((link['url'], depth + 1))
+    return list(candidates.values())
+
+def get_websites(data_package_path: str = DATA_PACKAGE_PATH) -> List[dict]:
+    """Reads the verified websites.
+
+    Args:
+        data_package_path (str): Path to the valid data package.
+
+    Returns:
+        List[dict]: The websites.
+    """
+    package = Package(data_package_path)
+    table = package.get_resource(WEBSITE_RESOURCE_NAME).to_pandas()
+    if any(table.index.names):
+        table = table.reset_index()
+    return table.to_dict('records')
+
+def discover_portals(websites: List[dict], max_depth: int = MAX_DEPTH,
+    max_pages: int = MAX_PAGES, max_simultaneous: int = MAX_SIMULTANEOUS,
+    min_delay: float = MIN_DELAY) -> pd.DataFrame:
+    """Crawls many websites concurrently, looking for portals.
+
+    Args:
+        websites (List[dict]): The websites to start from.
+        max_depth (int): Maximum number of links to follow from each
+            home page.
+        max_pages (int): Maximum number of pages to fetch from each site.
+        max_simultaneous (int): Maximum number of sites crawled at a time.
+        min_delay (float): Minimum delay between requests to the same
+            host, in seconds.
+
+    Returns:
+        pd.DataFrame: The portal candidates found, one row per website
+            and url, with the number of websites linking to the url in
+            the column shared_by.
+    """
+    scheduler = HostScheduler(min_delay)
+    def crawl(website):
+        return crawl_site(website, scheduler, max_depth, max_pages)
+    found = []
+    with ThreadPoolExecutor(max_workers=max_simultaneous) as executor:
+        for candidates in tqdm(executor.map(crawl, websites), total=len(websites)):
+            found.extend(candidates)
+    table = pd.DataFrame(found, columns=OUTPUT_COLUMNS)
+    # the same url may be a candidate of many websites, e.g. the federal
+    # transparency portal or the portal of a state court of accounts,
+    # so the candidates are kept per website and the number of websites
+    # linking to each url is recorded, to tell the shared portals apart
+    table['key'] = table['url'].apply(normalize_url)
+    table = table.drop_duplicates(subset=SITE_COLUMNS + ['key'])
+    table['shared_by'] = table.groupby('key')['key'].transform('size')
+    table = table.drop(columns='key')
+    logging.info('Found %d portal candidates in %d websites, %d of them '
+        'linked to by more than one website.', len(table), len(websites),
+        (table['shared_by'] > 1).sum())
+    return table
+
+def store_portals(table: pd.DataFrame, output_folder: str = OUTPUT_FOLDER,
+    output_file: str = OUTPUT_FILE):
+    """Merges the portal candidates into the output file, updating the
+    ones already there.
+
+    Args:
+        table (pd.DataFrame): The portal candidates.
+        output_folder (str): The folder of the output file.
+        output_file (str): The name of the output file.
+    """
+    output = os.path.join(output_folder, output_file)
+    if os.path.exists(output):
+        existing = pd.read_csv(output).reindex(columns=OUTPUT_COLUMNS)
+        table = upsert(existing, table, key=SITE_COLUMNS + ['url']).table
+    table['municipality_code'] = pd.to_numeric(
+        table['municipality_code'], errors='coerce').astype('Int64')
+    table['shared_by'] = table['shared_by'].astype('Int64')
+    write_csv(table[OUTPUT_COLUMNS], output,
+        sort_by=['state_code', 'municipality', 'url'])
+
+def parse_cli() -> dict:
+    """Parses the command line interface.
+
+    Returns:
+        dict: A dict containing the values for max_depth, max_pages,
+            max_simultaneous, min_delay, states, warc_folder, replay and
+            robots_cache.
+    """
+    parser = argparse.ArgumentParser(
+        description='Looks for transparency and open data portals by '
+            'crawling the verified websites.'
+    )
+    parser.add_argument('states',
+        help='abbreviations of the states whose websites to crawl '
+            '(default: all)',
+        nargs='*',
+    )
+    parser.add_argument('-d', '--depth',
+        metavar='int', type=int,
+        help='maximum number of links to follow from the home page',
+        default=MAX_DEPTH,
+    )
+    parser.add_argument('-n', '--pages',
+        metavar='int', type=int,
+        help='maximum number of pages to fetch per site',
+        default=MAX_PAGES,
+    )
+    parser.add_argument('-p', '--processes',
+        metavar='int', type=int,
+        help='number of sites to crawl at a time',
+        default=MAX_SIMULTANEOUS,
+    )
+    parser.add_argument('--delay',
+        metavar='seconds', type=float,
+        help='minimum delay between requests to the same host',
+        default=MIN_DELAY,
+    )
+    archive = parser.add_mutually_exclusive_group()
+    archive.add_argument('--warc',
+        metavar='folder', nargs='?', const=WARC_FOLDER,
+        help=('capture the responses in WARC files in this folder '
+            f'(default {WARC_FOLDER})'),
+        default=None,
+    )
+    archive.add_argument('--replay',
+        metavar='path', nargs='+',
+        help=('crawl the responses captured in these WARC files or '
+            'folders, without network access'),
+        default=None,
+    )
+    parser.add_argument('--robots-cache',
+        metavar='path',
+        help=('SQLite file in which the robots.txt files of the sites are '
+            f'kept and shared with other tools (default {ROBOTS_CACHE})'),
+        default=ROBOTS_CACHE,
+    )
+    args = parser.parse_args()
+    return {
+        'states': [state.upper() for state in args.states],
+        'max_depth': args.depth,
+        'max_pages': args.pages,
+        'max_simultaneous': args.processes,
+        'min_delay': args.delay,
+        'warc_folder': args.warc,
+        'replay': args.replay,
+        'robots_cache': args.robots_cache,
+    }
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_cli()
+    states = options.pop('states')
+    warc_folder, replay = options.pop('warc_folder'), options.pop('replay')
+    warc.configure(
+        writer=warc.WarcWriter(warc_folder, 'portals') if warc_folder else None,
+        archive=warc.WarcArchive(replay) if replay else None)
+    robots.configure(robots.RobotsCache(options.pop('robots_cache')))
+    start_websites = [website for website in get_websites()
+        if not states or website['state_code'] in states]
+    store_portals(discover_portals(start_websites, **options))
@@ -0,0 +1,267 @@
+"""
+This script gets the official websites of the municipalities from
+Wikidata, using the Wikidata entities recorded in the geographic data
+package by the DBPedia scripts, and adds them to the candidate links
+file.
+
+The entities are queried in batches, in the VALUES block of a SPARQL
+query, with a few queries running at a time. Responses are cached on
+disk for some days, so that the script can be run again without
+querying the endpoint.
+
+Usage:
+  python wikidata_websites.py
+
+For instructions use:
+  python wikidata_websites.py --help
+
+Este script obtém os sites oficiais dos municípios a partir do Wikidata,
+usando as entidades do Wikidata registradas no pacote de dados
+geográficos, e os adiciona ao arquivo de links candidatos.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+from frictionless import Package
+
+from settings import USER_AGENT, DEFAULT_TIMEOUT
+from storage.candidates import CandidateStore
+
+GEO_FOLDER = '../../../data/auxiliary/geographic'
+CACHE_FOLDER = '../../../data/download-cache/wikidata'
+OUTPUT_FOLDER = '../../../data/unverified'
+OUTPUT_FILE = 'municipality-website-candidate-links.csv'
+QUERY_FILE = 'official-websites.sparql'
+ENDPOINT = 'https://query.wikidata.org/sparql'
+ENTITY_PREFIX = 'http://www.wikidata.org/entity/'
+SOURCE_NAME = 'wikidata'
+BATCH_SIZE = 250
+MAX_SIMULTANEOUS = 4 # the public endpoint allows 5 queries at a time
+MAX_AGE = 7 # days
+MAX_RETRIES = 3
+
+# link type of the websites found through each property
+LINK_TYPES = {
+    'P856': 'prefeitura', # official website
+    'P1581': 'link', # official blog
+    'P194/P856': 'camara', # official website of the legislative body
+}
+
+def get_entities(geo_folder: str = GEO_FOLDER) -> Dict[str, dict]:
+    """Reads the Wikidata entities of the municipalities.
+
+    Args:
+        geo_folder (str): Path to the geographic data package.
+
+    Returns:
+        Dict[str, dict]: The code, name and uf of each municipality, by
+            Wikidata id (e.g. "Q953086").
+    """
+    package = Package(os.path.join(geo_folder, 'datapackage.json'))
+    mun = package.get_resource('municipality').to_pandas()
+    mun = mun[mun.wikidata.fillna('').str.startswith(ENTITY_PREFIX)]
+    return {
+        row.wikidata[len(ENTITY_PREFIX):]: {
+            'code': row.code, 'name': row.name, 'uf': row.uf}
+        for row in mun.itertuples()
+    }
+
+def build_query(template: str, entity_ids: List[str]) -> str:
+    """Fills in the entities of a batch in the query.
+
+    Args:
+        template (str): The SPARQL query, with %ITEMS% in the VALUES block.
+        entity_ids (List[str]): The Wikidata ids of the batch.
+
+    Returns:
+        str: The query.
+    """
+    return template.replace(
+        '%ITEMS%', ' '.join(f'wd:{entity_id}' for entity_id in entity_ids))
+
+def run_query(query: str, endpoint: str = ENDPOINT,
+    cache_folder: Optional[str] = CACHE_FOLDER, max_age: float = MAX_AGE,
+    session: Optional[requests.Session] = None) -> List[dict]:
+    """Runs a SPARQL query, unless its results are in the cache and are
+    not older than max_age days.
+
+    Args:
+        query (str): The SPARQL query.
+        endpoint (str): The url of the SPARQL endpoint.
+        cache_folder (str): The folder where to cache results, or None
+            to disable the cache.
+        max_age (float): Maximum age of cached results, in days.
+        session (requests.Session): Optional session to reuse.
+
+    Returns:
+        List[dict]: The result bindings, as dicts from variable name to
+            value.
+    """
+    cache_file = None
+    if cache_folder:
+        pathlib.Path(cache_folder).mkdir(parents=True, exist_ok=True)
+        cache_file = os.path.join(cache_folder, hashlib.sha1(
+            f'{endpoint}\n{query}'.encode('utf-8')).hexdigest() + '.json')
+        if os.path.exists(cache_file) and \
+                time.time() - os.path.getmtime(cache_file) < max_age * 86400:
+            with open(cache_file, 'r', encoding='utf-8') as file:
+                return json.load(file)
+
+    for attempt in range(MAX_RETRIES + 1):
+        response = (session or requests).post(
+            endpoint,
+            data={'query': query},
+            headers={
+                'user-agent': USER_AGENT,
+                'accept': 'application/sparql-results+json',
+            },
+            timeout=DEFAULT_TIMEOUT * 3
+        )
+        if response.status_code not in (429, 503) or attempt == MAX_RETRIES:
+            break
+        delay = int(response.headers.get('retry-after', '') or 2 ** attempt)
+        logging.info('Endpoint busy, retrying in %d seconds...', delay)
+        time.sleep(delay)
+    if response.status_code != 200:
+        raise ValueError(
+            f'Query to {endpoint} failed with status code {response.status_code}'
+            )
+    results = [
+        {name: value['value'] for name, value in binding.items()}
+        for binding in response.json()['results']['bindings']
+    ]
+    if cache_file:
+        temporary = cache_file + '.part'
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump(results, file)
+        os.replace(temporary, cache_file)
+    return results
+
+def harvest(entities: Dict[str, dict], endpoint: str = ENDPOINT,
+    batch_size: int = BATCH_SIZE, max_simultaneous: int = MAX_SIMULTANEOUS,
+    cache_folder: Optional[str] = CACHE_FOLDER, max_age: float = MAX_AGE) \
+        -> List[dict]:
+    """Queries the official websites of the municipalities in batches,
+    a few batches at a time.
+
+    Args:
+        entities (Dict[str, dict]): The municipalities, as output by
+            get_entities.
+        endpoint (str): The url of the SPARQL endpoint.
+        batch_size (int): Number of entities per query.
+        max_simultaneous (int): Maximum number of simultaneous queries.
+        cache_folder (str): The folder where to cache results.
+        max_age (float): Maximum age of cached results, in days.
+
+    Returns:
+        List[dict]: The links found, with the keys code, link, link_type,
+            name, uf and property.
+    """
+    with open(os.path.join(os.path.dirname(__file__), QUERY_FILE), 'r') as file:
+        template = file.read()
+    entity_ids = sorted(entities)
+    queries = [
+        build_query(template, entity_ids[start:start + batch_size])
+        for start in range(0, len(entity_ids), batch_size)
+    ]
+
+    session = requests.Session()
+    def query(text):
+        try:
+            return run_query(text, endpoint, cache_folder, max_age, session)
+        except (requests.exceptions.RequestException, ValueError) as error:
+            logging.warning('Unable to query batch: %s', error)
+            return []
+
+    links = []
+    logging.info('Querying %d entities in %d batches...',
+        len(entity_ids), len(queries))
+    with ThreadPoolExecutor(max_workers=max_simultaneous) as executor:
+        for results in executor.map(query, queries):
+            for result in results:
+                entity_id = result['item'][len(ENTITY_PREFIX):]
+                if entity_id not in entities:
+                    continue
+                links.append({
+                    **entities[entity_id],
+                    'link': result['website'],
+                    'link_type': LINK_TYPES.get(result['property'], 'link'),
+                    'property': result['property'],
+                })
+    logging.info('Found %d links in Wikidata.', len(links))
+    return links
+
+def store_links(links: List[dict], output_folder: str = OUTPUT_FOLDER,
+    output_file: str = OUTPUT_FILE) -> int:
+    """Adds the links to the candidate links file, recording the property
+    through which each one was found as its source, e.g. "wikidata:P856".
+
+    Args:
+        links (List[dict]): The links, as output by harvest.
+        output_folder (str): The folder of the candidate links file.
+        output_file (str): The name of the candidate links file.
+
+    Returns:
+        int: The number of new links.
+    """
+    pathlib.Path(output_folder).mkdir(parents=True, exist_ok=True)
+    with CandidateStore(os.path.join(output_folder, output_file)) as store:
+        return sum(
+            store.add(link, f'{SOURCE_NAME}:{link["property"]}')
+            for link in links
+        )
+
+def parse_cli() -> dict:
+    """Parses the command line interface.
+
+    Returns:
+        dict: A dict containing the values for endpoint, batch_size,
+            max_simultaneous and max_age.
+    """
+    parser = argparse.ArgumentParser(
+        description='Gets the official websites of municipalities from '
+            'Wikidata.'
+    )
+    parser.add_argument('-e', '--endpoint',
+        help='url of the SPARQL endpoint',
+        default=ENDPOINT,
+    )
+    parser.add_argument('-b', '--batch-size',
+        metavar='int', type=int,
+        help='number of municipalities per query',
+        default=BATCH_SIZE,
+    )
+    parser.add_argument('-p', '--processes',
+        metavar='int', type=int,
+        help='number of simultaneous queries',
+        default=MAX_SIMULTANEOUS,
+    )
+    parser.add_argument('--max-age',
+        metavar='days', type=float,
+        help='reuse cached results up to this many days old (0 to refresh)',
+        default=MAX_AGE,
+    )
+    args = parser.parse_args()
+    return {
+        'endpoint': args.endpoint,
+        'batch_size': args.batch_size,
+        'max_simultaneous': args.processes,
+        'max_age': args.max_age,
+    }
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_cli()
+    found_links = harvest(get_entities(), **options)
+    added = store_links(found_links)
+    logging.info('Added %d new links to "%s".', added,
+        os.path.join(OUTPUT_FOLDER, OUTPUT_FILE))
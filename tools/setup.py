@@ -16,6 +16,10 @@ INSTALL_REQUIRES = [
     'beautifulsoup4==4.11.1',
     'frictionless==4.40.3',
     'Unidecode==1.3.4',
+    'xlrd==2.0.1',
+    'openpyxl==3.0.10',
+    'pyarrow==9.0.0',
+    'PyYAML==6.0',
 ]
 
 setup(
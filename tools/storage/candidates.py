@@ -0,0 +1,352 @@
+"""Store of candidate links to municipality websites.
+
+All harvesters (DBPedia, Wikidata, Interlegis, ...) write their links to
+the same candidate links file. The store keys the links by normalized
+url, so that the same site found by several sources or written slightly
+differently (http or https, with or without "www." or a trailing slash)
+is recorded only once. Each link keeps the sources that produced it and
+when it was first and last seen.
+
+The file is read once, in a single pass, into a hash index. Links added
+afterwards are checked against the index and, as long as no existing
+link had to be updated, appended to the end of the file instead of
+rewriting it.
+
+For verification, the file is streamed in chunks with compact types and
+the links of each municipality are handed out as soon as all of them
+have been read, so memory does not grow with the size of the file.
+
+Armazenamento dos links candidatos a sites de municípios, com a
+procedência de cada link e sem duplicatas.
+"""
+
+import csv
+import logging
+import os
+import pathlib
+import urllib.parse
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import pandas as pd
+
+from storage.writer import DATE_FORMAT, write_csv
+
+CANDIDATES_FILE = '../../data/unverified/municipality-website-candidate-links.csv'
+CANDIDATE_COLUMNS = ['code', 'link', 'link_type', 'name', 'uf',
+    'sources', 'first_seen', 'last_seen']
+SOURCE_SEPARATOR = '|'
+BATCH_SIZE = 500
+CHUNK_SIZE = 100000 # rows read at a time when streaming the file
+# the columns needed to verify the links, with compact types
+READ_DTYPES = {
+    'code': 'Int32',
+    'link': 'object',
+    'link_type': 'category',
+    'name': 'object',
+    'uf': 'category',
+}
+
+def normalize_url(url: str) -> str:
+    """Normalizes a url for comparison: the scheme, the "www." prefix,
+    default ports, the fragment and trailing slashes are ignored and the
+    host name is lowercased.
+
+    Args:
+        url (str): The url.
+
+    Returns:
+        str: The normalized url.
+    """
+    url = url.strip()
+    if '://' not in url:
+        url = f'http://{url}'
+    parts = urllib.parse.urlsplit(url)
+    host = (parts.hostname or '').rstrip('.')
+    if host.startswith('www.'):
+        host = host[len('www.'):]
+    port = f':{parts.port}' if parts.port not in (None, 80, 443) else ''
+    path = parts.path.rstrip('/')
+    query = f'?{parts.query}' if parts.query else ''
+    return f'{host}{port}{path}{query}'
+
+def _text(value) -> str:
+    """Converts a value to its text in the file: codes without decimals
+    and missing values as empty strings.
+    """
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+class CandidateStore:
+    """The candidate links file, indexed by normalized url.
+
+    Can be used as a context manager, which flushes the pending changes
+    on exit.
+
+    Args:
+        path (str): Path to the candidate links CSV file. It is created
+            if it does not exist.
+        now (datetime): The time to record as seen for the links added.
+            Defaults to the current time.
+    """
+    def __init__(self, path: str = CANDIDATES_FILE,
+        now: Optional[datetime] = None):
+        self.path = path
+        self.now = (now or datetime.now(timezone.utc)).strftime(DATE_FORMAT)
+        self.rows: List[Dict[str, str]] = []
+        self.index: Dict[str, int] = {}
+        self.pending = 0 # rows at the end not yet written
+        self.changed = False # whether any written row has changed
+        self._load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __contains__(self, link: str) -> bool:
+        return normalize_url(link) in self.index
+
+    def _load(self):
+        """Reads the file into the index. Files written before the store
+        existed lack the provenance columns and may contain repeated
+        links, so they are rewritten on the next flush.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8', newline='') as file:
+            reader = csv.DictReader(file)
+            if reader.fieldnames != CANDIDATE_COLUMNS:
+                self.changed = True
+            for row in reader:
+                row = {column: row.get(column) or '' for column in CANDIDATE_COLUMNS}
+                if self._merge(row, row['sources']):
+                    continue
+                self.index[normalize_url(row['link'])] = len(self.rows)
+                self.rows.append(row)
+        logging.info('Read %d candidate links from "%s".', len(self.rows), self.path)
+
+    def _merge(self, row: Dict[str, str], sources: str) -> bool:
+        """Merges a row into the existing row with the same normalized
+        url, if there is one.
+
+        Returns:
+            bool: True if there was an existing row.
+        """
+        position = self.index.get(normalize_url(row['link']))
+        if position is None:
+            return False
+        existing = self.rows[position]
+        before = dict(existing)
+        for column in ['code', 'link_type', 'name', 'uf']:
+            existing[column] = existing[column] or row[column]
+        known_sources = existing['sources'].split(SOURCE_SEPARATOR) \
+            if existing['sources'] else []
+        for source in sources.split(SOURCE_SEPARATOR) if sources else []:
+            if source not in known_sources:
+                known_sources.append(source)
+        existing['sources'] = SOURCE_SEPARATOR.join(known_sources)
+        existing['first_seen'] = min(filter(None,
+            [existing['first_seen'], row['first_seen']]), default='')
+        existing['last_seen'] = max(existing['last_seen'], row['last_seen'])
+        if existing != before and position < len(self.rows) - self.pending:
+            self.changed = True
+        return True
+
+    def add(self, link: dict, source: str) -> bool:
+        """Adds a link to the store, or records that an existing link was
+        seen again.
+
+        Args:
+            link (dict): The link, with the keys link and, optionally,
+                code, link_type, name and uf.
+            source (str): The name of the source that produced the link.
+
+        Returns:
+            bool: True if the link is new.
+        """
+        row = {column: _text(link.get(column)) for column in CANDIDATE_COLUMNS}
+        if not row['link']:
+            return False
+        row.update(sources=source, first_seen=self.now, last_seen=self.now)
+        if self._merge(row, source):
+            return False
+        self.index[normalize_url(row['link'])] = len(self.rows)
+        self.rows.append(row)
+        self.pending += 1
+        return True
+
+    def add_all(self, links: Iterable[dict], source: str,
+        batch_size: int = BATCH_SIZE) -> int:
+        """Adds several links, appending the new ones to the file every
+        batch_size links. Once a link already written has changed, the
+        whole file has to be rewritten, which is left to the final flush.
+
+        Args:
+            links (Iterable[dict]): The links, as for add.
+            source (str): The name of the source that produced them.
+            batch_size (int): Number of new links to write at a time.
+
+        Returns:
+            int: The number of new links.
+        """
+        added = 0
+        for link in links:
+            if self.add(link, source):
+                added += 1
+                if self.pending >= batch_size and not self.changed:
+                    self.flush()
+        logging.info('Added %d new candidate links from %s.', added, source)
+        return added
+
+    def flush(self):
+        """Writes the pending changes to the file: new links are appended
+        or, if existing links changed, the file is rewritten atomically.
+        """
+        if self.changed or not os.path.exists(self.path):
+            write_csv(self.to_dataframe(), self.path)
+        elif self.pending:
+            with open(self.path, 'a', encoding='utf-8', newline='') as file:
+                writer = csv.DictWriter(file, fieldnames=CANDIDATE_COLUMNS,
+                    lineterminator='\n')
+                writer.writerows(self.rows[len(self.rows) - self.pending:])
+                file.flush()
+                os.fsync(file.fileno())
+        self.pending = 0
+        self.changed = False
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Gets all the links as a Pandas dataframe of strings.
+
+        Returns:
+            pd.DataFrame: The candidate links.
+        """
+        return pd.DataFrame(self.rows, columns=CANDIDATE_COLUMNS, dtype=str)
+
+def store_candidates(links: Iterable[dict], source: str,
+    path: str = CANDIDATES_FILE) -> int:
+    """Adds links to the candidate links file.
+
+    Args:
+        links (Iterable[dict]): The links, as for CandidateStore.add.
+        source (str): The name of the source that produced them.
+        path (str): Path to the candidate links CSV file.
+
+    Returns:
+        int: The number of new links.
+    """
+    pathlib.Path(os.path.dirname(os.path.abspath(path))).mkdir(
+        parents=True, exist_ok=True)
+    with CandidateStore(path) as store:
+        return store.add_all(links, source)
+
+def in_shard(codes: pd.Series, shard: Optional[Tuple[int, int]]) -> pd.Series:
+    """Tells which municipality codes belong to a shard. A municipality
+    is always in the same shard, whatever the other municipalities in
+    the candidate set are.
+
+    Args:
+        codes (pd.Series): The IBGE municipality codes.
+        shard (Tuple[int, int]): The shard number and the number of
+            shards, or None for all the municipalities.
+
+    Returns:
+        pd.Series: A boolean series aligned with codes.
+    """
+    if shard is None:
+        return pd.Series(True, index=codes.index)
+    number, count = shard
+    return codes % count == number - 1
+
+def read_chunks(path: str = CANDIDATES_FILE,
+    columns: Sequence[str] = tuple(READ_DTYPES),
+    chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """Streams the candidate links file in chunks, with compact types.
+    Links without a municipality code are skipped.
+
+    Args:
+        path (str): Path to the candidate links CSV file.
+        columns (Sequence[str]): The columns to read.
+        chunk_size (int): Number of rows per chunk.
+
+    Yields:
+        pd.DataFrame: The next chunk.
+    """
+    with pd.read_csv(path, usecols=list(columns),
+            dtype={column: READ_DTYPES[column] for column in columns},
+            chunksize=chunk_size) as reader:
+        for chunk in reader:
+            yield chunk[chunk.code.notna()]
+
+def count_city_links(path: str = CANDIDATES_FILE,
+    states: Optional[Sequence[str]] = None,
+    shard: Optional[Tuple[int, int]] = None,
+    chunk_size: int = CHUNK_SIZE) -> pd.Series:
+    """Counts the candidate links of each municipality, reading only the
+    code and state columns.
+
+    Args:
+        path (str): Path to the candidate links CSV file.
+        states (Sequence[str]): Optional state abbreviations to count the
+            municipalities of.
+        shard (Tuple[int, int]): Optional shard number and number of
+            shards to count the municipalities of.
+        chunk_size (int): Number of rows read at a time.
+
+    Returns:
+        pd.Series: The number of links of each municipality, indexed by
+            code, in the order the municipalities first appear.
+    """
+    counts: Dict[int, int] = {} # in the order of first appearance
+    for chunk in read_chunks(path, ['code', 'uf'], chunk_size):
+        if states:
+            chunk = chunk[chunk.uf.isin(states)]
+        chunk = chunk[in_shard(chunk.code, shard)]
+        chunk_counts = chunk.code.value_counts()
+        for code in chunk.code.unique():
+            counts[int(code)] = counts.get(int(code), 0) + int(chunk_counts[code])
+    return pd.Series(counts, dtype='int64')
+
+def iter_city_links(path: str, counts: pd.Series,
+    states: Optional[Sequence[str]] = None,
+    chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple[int, pd.DataFrame]]:
+    """Streams the candidate links of the given municipalities, one
+    municipality at a time. A municipality is handed out as soon as all
+    its links have been read, so only the municipalities whose links are
+    spread further apart in the file are held in memory at once.
+
+    Args:
+        path (str): Path to the candidate links CSV file.
+        counts (pd.Series): The number of links of each municipality to
+            read, as returned by count_city_links.
+        states (Sequence[str]): The state abbreviations the counts were
+            made for, if any, as only the links of those states count.
+        chunk_size (int): Number of rows read at a time.
+
+    Yields:
+        Tuple[int, pd.DataFrame]: The code and the candidate links of
+            each municipality.
+    """
+    buffer = None # links read of the municipalities not yet handed out
+    for chunk in read_chunks(path, chunk_size=chunk_size):
+        if states:
+            chunk = chunk[chunk.uf.isin(states)]
+        chunk = chunk[chunk.code.isin(counts.index)]
+        if buffer is not None and len(buffer):
+            chunk = pd.concat([buffer, chunk], ignore_index=True)
+            for column in ['link_type', 'uf']: # categories differ by chunk
+                chunk[column] = chunk[column].astype('category')
+        read = chunk.code.value_counts()
+        complete = read.index[read.to_numpy() ==
+            counts.reindex(read.index).to_numpy()]
+        done = chunk.code.isin(complete)
+        for code, links in chunk[done].groupby('code', sort=False):
+            yield int(code), links
+        buffer = chunk[~done]
@@ -0,0 +1,394 @@
+"""SQLite catalogue of candidate links, verified websites, portals and
+geographic data.
+
+The data package CSV files remain the source of truth: the catalogue is
+filled by importing them and written back by exporting them. Dates are
+kept as the text of the files, so that exporting the tables without
+changes gives the same files, byte for byte. In between,
+the verification and harvest scripts can use it to look up the rows of a
+single municipality, state or url through indexes and to insert or
+update rows without loading or rewriting whole tables.
+
+Usage:
+  python catalogue.py import catalogue.sqlite
+  python catalogue.py export catalogue.sqlite
+
+Catálogo SQLite dos links candidatos, sites verificados, portais e dados
+geográficos.
+"""
+
+import argparse
+import csv
+import logging
+import os
+import sqlite3
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+from frictionless import Package
+
+from storage.writer import format_datetime, write_csv, write_resource
+
+DATA_PACKAGES = [
+    '../../data/valid/datapackage.json',
+    '../../data/auxiliary/geographic/datapackage.json',
+]
+CANDIDATES_FILE = '../../data/unverified/municipality-website-candidate-links.csv'
+
+# names of the catalogue tables for each resource
+TABLES = {
+    'brazilian-municipality-and-state-websites': 'websites',
+    'brazilian-transparency-and-open-data-portals': 'portals',
+    'municipality': 'municipality',
+    'uf': 'uf',
+}
+INDEXES = {
+    'websites': [['municipality_code'], ['state_code', 'branch'], ['url']],
+    'portals': [['municipality_code'], ['state_code', 'branch'], ['url']],
+    'municipality': [['code'], ['uf', 'name']],
+    'uf': [['abbr']],
+    'candidates': [['code'], ['link']],
+}
+SQL_TYPES = {'integer': 'INTEGER', 'number': 'REAL'}
+
+def quote(identifier: str) -> str:
+    """Quotes an SQL identifier, as some column names contain hyphens.
+
+    Args:
+        identifier (str): The table or column name.
+
+    Returns:
+        str: The quoted identifier.
+    """
+    return '"' + identifier.replace('"', '""') + '"'
+
+def sql_value(value: Any) -> Any:
+    """Converts a value to a type that SQLite can store: timestamps to
+    text as they are written in the CSV files (see
+    storage.writer.format_datetime), numpy scalars to Python values and
+    missing values to NULL.
+
+    Args:
+        value (Any): The value.
+
+    Returns:
+        Any: The converted value.
+    """
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if isinstance(value, datetime): # includes pd.Timestamp
+        return format_datetime(value)
+    if hasattr(value, 'item'): # numpy scalar
+        return value.item()
+    return value
+
+class Catalogue:
+    """A connection to a catalogue database.
+
+    Args:
+        path (str): Path to the SQLite database file. It is created if
+            it does not exist.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Commits pending changes and closes the connection."""
+        self.connection.commit()
+        self.connection.close()
+
+    def has_table(self, table: str) -> bool:
+        """Checks whether a table exists in the catalogue.
+
+        Args:
+            table (str): The table name.
+
+        Returns:
+            bool: True if the table exists.
+        """
+        return self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
+            (table,)
+        ).fetchone() is not None
+
+    def columns(self, table: str) -> List[str]:
+        """Gets the column names of a table, in order.
+
+        Args:
+            table (str): The table name.
+
+        Returns:
+            List[str]: The column names.
+        """
+        return [row['name'] for row in
+            self.connection.execute(f'PRAGMA table_info({quote(table)})')]
+
+    def _create_table(self, table: str, columns: Dict[str, str]):
+        """Creates (or recreates) a table and its indexes.
+
+        Args:
+            table (str): The table name.
+            columns (Dict[str, str]): The SQL type of each column, in order.
+        """
+        self.connection.execute(f'DROP TABLE IF EXISTS {quote(table)}')
+        definition = ', '.join(f'{quote(name)} {sql_type}'
+            for name, sql_type in columns.items())
+        self.connection.execute(f'CREATE TABLE {quote(table)} ({definition})')
+        for index_columns in INDEXES.get(table, []):
+            index_name = f'{table}_{"_".join(index_columns)}'
+            self.connection.execute(
+                f'CREATE INDEX {quote(index_name)} ON {quote(table)} '
+                f'({", ".join(quote(column) for column in index_columns)})')
+
+    def _load_csv(self, table: str, csv_path: str, columns: Dict[str, str]):
+        """Loads the rows of a CSV file into a table, replacing its
+        contents. Empty strings become NULL and integer columns are
+        stored as integers.
+        """
+        self._create_table(table, columns)
+        integers = [name for name, sql_type in columns.items()
+            if sql_type == 'INTEGER']
+        placeholders = ', '.join('?' for _ in columns)
+        with open(csv_path, 'r', encoding='utf-8', newline='') as file:
+            reader = csv.DictReader(file)
+            def rows():
+                for row in reader:
+                    values = {name: (row.get(name) or None) for name in columns}
+                    for name in integers:
+                        if values[name] is not None:
+                            values[name] = int(float(values[name]))
+                    yield tuple(values.values())
+            self.connection.executemany(
+                f'INSERT INTO {quote(table)} VALUES ({placeholders})', rows())
+        self.connection.commit()
+        count = self.connection.execute(
+            f'SELECT COUNT(*) FROM {quote(table)}').fetchone()[0]
+        logging.info('Imported %d rows from "%s" into %s.', count, csv_path, table)
+
+    def import_package(self, data_package_path: str):
+        """Imports all known resources of a data package.
+
+        Args:
+            data_package_path (str): Path to the datapackage.json file.
+        """
+        package = Package(data_package_path)
+        for resource in package.resources:
+            table = TABLES.get(resource.name)
+            if table is None:
+                continue
+            self._load_csv(table, resource.fullpath, {
+                field.name: SQL_TYPES.get(field.type, 'TEXT')
+                for field in resource.schema.fields
+            })
+
+    def import_candidates(self, csv_path: str):
+        """Imports the candidate links file.
+
+        Args:
+            csv_path (str): Path to the candidate links CSV file.
+        """
+        with open(csv_path, 'r', encoding='utf-8', newline='') as file:
+            header = next(csv.reader(file))
+        self._load_csv('candidates', csv_path, {
+            name: 'INTEGER' if name == 'code' else 'TEXT' for name in header
+        })
+
+    def read_table(self, table: str, order_by: Optional[List[str]] = None) \
+            -> pd.DataFrame:
+        """Reads a whole table as a Pandas dataframe.
+
+        Args:
+            table (str): The table name.
+            order_by (List[str]): Optional columns to sort by. Otherwise
+                rows keep their insertion order.
+
+        Returns:
+            pd.DataFrame: The table contents.
+        """
+        order = ', '.join(quote(column) for column in order_by) \
+            if order_by else 'rowid'
+        return pd.read_sql_query(
+            f'SELECT * FROM {quote(table)} ORDER BY {order}', self.connection)
+
+    def export_resource(self, data_package_path: str, resource_name: str,
+        sort_by: Optional[List[str]] = None):
+        """Writes a table back to the CSV file of its resource.
+
+        Args:
+            data_package_path (str): Path to the datapackage.json file.
+            resource_name (str): The name of the resource.
+            sort_by (List[str]): Optional columns to sort by.
+
+        Returns:
+            WriteResult: What was done to the file.
+        """
+        table = self.read_table(TABLES[resource_name])
+        return write_resource(table, data_package_path, resource_name,
+            sort_by=sort_by)
+
+    def export_candidates(self, csv_path: str):
+        """Writes the candidates table back to the candidate links file.
+
+        Args:
+            csv_path (str): Path to the candidate links CSV file.
+
+        Returns:
+            WriteResult: What was done to the file.
+        """
+        table = self.read_table('candidates')
+        table['code'] = table['code'].astype('Int64')
+        return write_csv(table, csv_path)
+
+    def candidate_codes(self, states: Optional[List[str]] = None) -> List[int]:
+        """Lists the municipality codes that have candidate links.
+
+        Args:
+            states (List[str]): Optional state abbreviations to list the
+                municipalities of.
+
+        Returns:
+            List[int]: The codes.
+        """
+        query = 'SELECT DISTINCT code FROM candidates WHERE code IS NOT NULL'
+        if states:
+            query += f' AND uf IN ({", ".join("?" * len(states))})'
+        return [row[0] for row in
+            self.connection.execute(query, tuple(states or ()))]
+
+    def candidate_links(self, code: int) -> pd.DataFrame:
+        """Gets the candidate links of a municipality.
+
+        Args:
+            code (int): The IBGE municipality code.
+
+        Returns:
+            pd.DataFrame: The candidate links, in the same format as the
+                candidate links file.
+        """
+        return pd.read_sql_query(
+            'SELECT * FROM candidates WHERE code = ?', self.connection,
+            params=(int(code),))
+
+    def find(self, table: str, **conditions) -> List[dict]:
+        """Finds the rows of a table matching all the given column values,
+        e.g. find('websites', municipality_code=1200013, branch='executive').
+
+        Args:
+            table (str): The table name.
+            **conditions: The column values to match. None matches NULL.
+
+        Returns:
+            List[dict]: The matching rows, including their rowid.
+        """
+        where = ' AND '.join(
+            f'{quote(column)} IS ?' for column in conditions) or '1'
+        return [dict(row) for row in self.connection.execute(
+            f'SELECT rowid, * FROM {quote(table)} WHERE {where} ORDER BY rowid',
+            tuple(conditions.values()))]
+
+    def upsert(self, table: str, row: dict, key: List[str],
+        update_columns: Optional[List[str]] = None) -> str:
+        """Updates the first row matching the key values of the given row
+        or, if there is none, inserts it.
+
+        Args:
+            table (str): The table name.
+            row (dict): The row values.
+            key (List[str]): The columns used to look for an existing row.
+            update_columns (List[str]): The columns to update on an
+                existing row. Defaults to all the columns in row.
+
+        Returns:
+            str: Either 'updated' or 'inserted'.
+        """
+        columns = self.columns(table)
+        row = {column: sql_value(value) for column, value in row.items()
+            if column in columns}
+        existing = self.find(table, **{column: row.get(column) for column in key})
+        if existing:
+            update_columns = [column for column in (update_columns or row)
+                if column in row]
+            assignments = ', '.join(f'{quote(column)} = ?'
+                for column in update_columns)
+            self.connection.execute(
+                f'UPDATE {quote(table)} SET {assignments} WHERE rowid = ?',
+                tuple(row[column] for column in update_columns) +
+                    (existing[0]['rowid'],))
+            return 'updated'
+        self.connection.execute(
+            f'INSERT INTO {quote(table)} '
+            f'({", ".join(quote(column) for column in row)}) '
+            f'VALUES ({", ".join("?" for _ in row)})',
+            tuple(row.values()))
+        return 'inserted'
+
+    def deduplicate(self, table: str, column: str):
+        """Removes rows with repeated values in a column, keeping the last
+        one inserted.
+
+        Args:
+            table (str): The table name.
+            column (str): The column that must not have repeated values.
+        """
+        self.connection.execute(
+            f'DELETE FROM {quote(table)} WHERE rowid NOT IN '
+            f'(SELECT MAX(rowid) FROM {quote(table)} GROUP BY {quote(column)})')
+        self.connection.commit()
+
+def parse_cli() -> dict:
+    """Parses the command line interface.
+
+    Returns:
+        dict: A dict containing the values for action, database,
+            data_package_paths and candidates_file.
+    """
+    parser = argparse.ArgumentParser(
+        description='Imports the data package CSV files into a SQLite '
+            'catalogue or exports them back.')
+    parser.add_argument('action', choices=['import', 'export'])
+    parser.add_argument('database', help='path to the SQLite database file')
+    parser.add_argument('-c', '--candidates',
+        help='candidate links CSV file',
+        default=CANDIDATES_FILE,
+    )
+    parser.add_argument('packages',
+        help='paths to datapackage.json files',
+        nargs='*',
+        default=DATA_PACKAGES,
+    )
+    args = parser.parse_args()
+    return {
+        'action': args.action,
+        'database': args.database,
+        'data_package_paths': args.packages,
+        'candidates_file': args.candidates,
+    }
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_cli()
+    with Catalogue(options['database']) as catalogue:
+        for package_path in options['data_package_paths']:
+            if options['action'] == 'import':
+                catalogue.import_package(package_path)
+            else:
+                for resource in Package(package_path).resources:
+                    if resource.name in TABLES and \
+                            catalogue.has_table(TABLES[resource.name]):
+                        catalogue.export_resource(package_path, resource.name)
+        if os.path.exists(options['candidates_file']) or \
+                options['action'] == 'export':
+            if options['action'] == 'import':
+                catalogue.import_candidates(options['candidates_file'])
+            elif catalogue.has_table('candidates'):
+                catalogue.export_candidates(options['candidates_file'])
@@ -0,0 +1,510 @@
+"""History of the link health checks, for uptime analytics.
+
+The websites resource keeps only the time each link was last verified.
+This module keeps a record of every check instead: the url, when it was
+checked, the status code (0 if there was no response), the latency, the
+final url after redirects and how the page was classified. The history
+is append-only and stored in Arrow files, compressed with zstd and
+partitioned by month, each run adding a part file to the folder of its
+month. Urls are dictionary
+encoded: the checks refer to them by a 32 bit id, kept in a separate
+dictionary file along with the state and municipality of each url, and
+times are stored as integer seconds, so a check takes a few bytes and
+years of daily checks of every link fit in some tens of megabytes.
+
+Compacting a month merges its part files into one, sorted by url and
+time, which compresses better and is faster to read. Queries read only
+the months in the period asked for.
+
+Only one process should append to a history at a time.
+
+Usage:
+  python health.py uptime [--since 2022-01-01] [--until 2022-12-31] [--by url]
+  python health.py latency [--by url]
+  python health.py flapping [--changes 4]
+  python health.py compact
+
+Histórico das verificações de disponibilidade dos links, para análise
+do tempo em que estiveram no ar, latência e instabilidade por UF.
+"""
+
+import argparse
+import glob
+import logging
+import os
+import pathlib
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+
+HEALTH_FOLDER = '../../data/health'
+URLS_FILE = 'urls.arrow'
+COMPACT_FILE = 'checks.arrow'
+PERCENTILES = (0.5, 0.9, 0.99)
+LATENCY_BUCKET = 0.02 # relative width of the buckets of latency
+MAX_LATENCY = 2**17 # milliseconds, longer latencies are counted as this
+FLAPPING_CHANGES = 4 # changes between up and down in the period
+CHECK_SCHEMA = pa.schema([
+    ('url_id', pa.uint32()),
+    ('time', pa.uint32()), # seconds since the epoch, UTC
+    ('status', pa.uint16()), # 0 if there was no response
+    ('latency_ms', pa.uint32()),
+    ('final_url_id', pa.uint32()), # null if not redirected
+    ('classification', pa.dictionary(pa.int8(), pa.string())),
+])
+URL_SCHEMA = pa.schema([
+    ('url_id', pa.uint32()),
+    ('url', pa.string()),
+    ('state_code', pa.dictionary(pa.int8(), pa.string())),
+    ('municipality_code', pa.int32()),
+])
+
+def to_seconds(moment) -> int:
+    """Converts a datetime, naive ones being UTC, or a date string to
+    integer seconds since the epoch.
+
+    Args:
+        moment: The datetime or string.
+
+    Returns:
+        int: The seconds since the epoch.
+    """
+    timestamp = pd.Timestamp(moment)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize('UTC')
+    return int(timestamp.timestamp())
+
+def month_of(seconds: int) -> str:
+    """Gets the partition of a time.
+
+    Args:
+        seconds (int): Seconds since the epoch.
+
+    Returns:
+        str: The month, e.g. "2022-07".
+    """
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).strftime('%Y-%m')
+
+def is_up(status: np.ndarray) -> np.ndarray:
+    """Tells which checks found the link up, i.e. got a successful
+    response after following the redirects.
+
+    Args:
+        status (np.ndarray): The status codes of the checks.
+
+    Returns:
+        np.ndarray: True for the checks that found the link up.
+    """
+    return (status >= 200) & (status < 300)
+
+class HealthHistory:
+    """The health check history kept in a folder.
+
+    Args:
+        folder (str): The folder of the history, created if needed.
+    """
+    def __init__(self, folder: str = HEALTH_FOLDER):
+        self.folder = folder
+        pathlib.Path(folder).mkdir(parents=True, exist_ok=True)
+        path = os.path.join(folder, URLS_FILE)
+        if os.path.exists(path):
+            self.urls = feather.read_table(path) \
+                .to_pandas(types_mapper={pa.int32(): pd.Int32Dtype()}.get) \
+                .astype({'state_code': object, 'municipality_code': object})
+        else:
+            self.urls = pd.DataFrame({
+                'url_id': pd.Series(dtype='uint32'),
+                'url': pd.Series(dtype=object),
+                'state_code': pd.Series(dtype=object),
+                'municipality_code': pd.Series(dtype=object),
+            })
+        self.ids = dict(zip(self.urls.url, self.urls.url_id))
+
+    def _url_ids(self, checks: pd.DataFrame) -> pd.DataFrame:
+        """Assigns ids to the urls of some checks, adding the new urls to
+        the dictionary and updating the state and municipality of the
+        known ones.
+
+        Returns:
+            pd.DataFrame: The checks with url_id and final_url_id columns.
+        """
+        urls = pd.concat([checks.url, checks.final_url.dropna()]).unique()
+        new_urls = [url for url in urls if url not in self.ids]
+        next_id = len(self.ids)
+        for url_id, url in enumerate(new_urls, start=next_id):
+            self.ids[url] = url_id
+        checks = checks.assign(
+            url_id=checks.url.map(self.ids),
+            final_url_id=checks.final_url.map(self.ids))
+        # the final url of a check is kept only if it was redirected
+        checks.loc[checks.final_url_id == checks.url_id, 'final_url_id'] = None
+
+        new_rows = pd.DataFrame({
+            'url_id': np.arange(next_id, next_id + len(new_urls)),
+            'url': new_urls})
+        urls = pd.concat([self.urls, new_rows], ignore_index=True)
+        latest = checks.drop_duplicates('url_id', keep='last') \
+            .set_index('url_id')
+        for column in ('state_code', 'municipality_code'):
+            known = urls.url_id.map(latest[column])
+            urls[column] = known.where(known.notna(), urls[column])
+        self.urls = urls.astype({'url_id': 'uint32', 'state_code': object,
+            'municipality_code': object})
+        return checks
+
+    def _write_urls(self):
+        """Writes the url dictionary atomically."""
+        path = os.path.join(self.folder, URLS_FILE)
+        table = pa.table([
+            pa.array(self.urls.url_id, pa.uint32()),
+            pa.array(self.urls.url, pa.string()),
+            pa.array(self.urls.state_code, pa.string(), from_pandas=True)
+                .dictionary_encode().cast(URL_SCHEMA.field('state_code').type),
+            pa.array(self.urls.municipality_code, pa.int32(), from_pandas=True),
+        ], schema=URL_SCHEMA)
+        feather.write_feather(table, path + '.part', compression='zstd')
+        os.replace(path + '.part', path)
+
+    def append(self, checks: Iterable[dict]) -> int:
+        """Adds checks to the history, in a new part file for each month.
+
+        Args:
+            checks (Iterable[dict]): The checks, with keys url, time
+                (datetime), status, latency (seconds), final_url and
+                classification, and optionally state_code and
+                municipality_code.
+
+        Returns:
+            int: The number of checks added.
+        """
+        checks = pd.DataFrame(list(checks), columns=['url', 'time', 'status',
+            'latency', 'final_url', 'classification', 'state_code',
+            'municipality_code'])
+        if checks.empty:
+            return 0
+        checks = self._url_ids(checks)
+        # the dictionary is written first, so no part refers to a url
+        # that is not in it
+        self._write_urls()
+        times = pd.to_datetime(checks.time, utc=True) # naive ones are UTC
+        seconds = times.astype('int64') // 10**9
+        table = pa.table([
+            pa.array(checks.url_id, pa.uint32()),
+            pa.array(seconds, pa.uint32()),
+            pa.array(checks.status.fillna(0), pa.uint16()),
+            pa.array((checks.latency.astype('float64') * 1000).round(),
+                from_pandas=True).cast(pa.uint32()),
+            pa.array(checks.final_url_id.astype('float64'),
+                from_pandas=True).cast(pa.uint32()),
+            pa.array(checks.classification, pa.string(), from_pandas=True)
+                .dictionary_encode()
+                .cast(CHECK_SCHEMA.field('classification').type),
+        ], schema=CHECK_SCHEMA)
+        months = times.dt.strftime('%Y-%m').to_numpy()
+        part_name = f'part-{datetime.now(timezone.utc):%Y%m%d%H%M%S%f}-' \
+            f'{os.getpid()}.arrow'
+        for month in sorted(set(months)):
+            folder = os.path.join(self.folder, month)
+            pathlib.Path(folder).mkdir(exist_ok=True)
+            path = os.path.join(folder, part_name)
+            feather.write_feather(table.filter(pa.array(months == month)),
+                path + '.part', compression='zstd')
+            os.replace(path + '.part', path)
+        logging.info('Added %d checks to the health history.', len(checks))
+        return len(checks)
+
+    def months(self) -> List[str]:
+        """Lists the months in the history.
+
+        Returns:
+            List[str]: The months, e.g. ["2022-06", "2022-07"].
+        """
+        return sorted({os.path.basename(os.path.dirname(path))
+            for path in glob.glob(os.path.join(self.folder, '*-*', '*.arrow'))})
+
+    def month_files(self, month: str) -> List[str]:
+        """Lists the files of a month: the compacted file, if any, and
+        the parts added since.
+
+        Args:
+            month (str): The month, e.g. "2022-07".
+
+        Returns:
+            List[str]: The paths to the files.
+        """
+        return sorted(glob.glob(os.path.join(self.folder, month, '*.arrow')))
+
+    def compact(self, months: Optional[Sequence[str]] = None) -> int:
+        """Merges the files of each month into one, sorted by url and
+        time.
+
+        Args:
+            months (Sequence[str]): The months to compact, by default all
+                with more than one file.
+
+        Returns:
+            int: The number of months compacted.
+        """
+        compacted = 0
+        for month in months or self.months():
+            paths = self.month_files(month)
+            if len(paths) < 2:
+                continue
+            table = pa.concat_tables(feather.read_table(path) for path in paths)
+            table = table.sort_by([('url_id', 'ascending'),
+                ('time', 'ascending')])
+            path = os.path.join(self.folder, month, COMPACT_FILE)
+            feather.write_feather(table, path + '.part', compression='zstd')
+            os.replace(path + '.part', path)
+            for part_path in paths:
+                if part_path != path:
+                    os.remove(part_path)
+            logging.info('Compacted %d files of %s: %d checks.',
+                len(paths), month, table.num_rows)
+            compacted += 1
+        return compacted
+
+    def _read_table(self, since=None, until=None,
+        columns: Optional[List[str]] = None) -> pa.Table:
+        """Reads the checks made in a period. See read."""
+        start = to_seconds(since) if since is not None else 0
+        end = to_seconds(until) if until is not None else 2**32 - 1
+        if until is not None and len(str(until)) <= 10: # a date
+            end += 24 * 3600 - 1
+        columns = list(dict.fromkeys(['url_id', 'time'] +
+            (columns or CHECK_SCHEMA.names)))
+        table = pa.concat_tables(
+            [feather.read_table(path, columns=columns)
+                for month in self.months()
+                if month_of(start) <= month <= month_of(end)
+                for path in self.month_files(month)] or
+            [CHECK_SCHEMA.empty_table().select(columns)])
+        if since is not None or until is not None:
+            table = table.filter(pc.and_(
+                pc.greater_equal(table['time'], pa.scalar(start, pa.uint32())),
+                pc.less_equal(table['time'], pa.scalar(end, pa.uint32()))))
+        return table
+
+    def read(self, since=None, until=None,
+        columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Reads the checks made in a period, with the state of each url.
+
+        Args:
+            since: Optional start of the period (datetime or string).
+            until: Optional end of the period, inclusive.
+            columns (List[str]): The columns of the checks to read, by
+                default all.
+
+        Returns:
+            pd.DataFrame: The checks, month by month. Within a month they
+                are sorted by url and time if it was compacted.
+        """
+        checks = self._read_table(since, until, columns).to_pandas()
+        # the url ids are the positions of the urls in the dictionary
+        states = pd.Categorical(self.urls.state_code)
+        checks['state_code'] = pd.Categorical.from_codes(
+            states.codes[checks.url_id.to_numpy()], states.categories)
+        return checks
+
+    def _groups(self, url_ids: np.ndarray, by: str) \
+        -> Tuple[np.ndarray, np.ndarray]:
+        """Numbers the groups of the checks of some urls, by state or by
+        url.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The group number of each check
+                and the label of each group, None for the urls without a
+                state.
+        """
+        if by == 'url':
+            return url_ids, self.urls.url.to_numpy()
+        states = pd.Categorical(self.urls[by])
+        codes = states.codes.astype(np.int64)
+        codes[codes < 0] = len(states.categories)
+        return codes[url_ids], np.append(states.categories.to_numpy(), None)
+
+    def uptime(self, since=None, until=None, by: str = 'state_code') \
+        -> pd.DataFrame:
+        """Computes the share of checks that found the links up.
+
+        Args:
+            since: Optional start of the period.
+            until: Optional end of the period, inclusive.
+            by (str): Either "state_code" or "url".
+
+        Returns:
+            pd.DataFrame: The number of checks and the uptime, in percent,
+                of each group.
+        """
+        table = self._read_table(since, until, ['status'])
+        groups, labels = self._groups(table['url_id'].to_numpy(), by)
+        total = np.bincount(groups, minlength=len(labels))
+        up = np.bincount(groups, weights=is_up(table['status'].to_numpy()),
+            minlength=len(labels))
+        present = (total > 0) & pd.notna(labels)
+        result = pd.DataFrame({
+            'checks': total[present],
+            'uptime': up[present] / total[present] * 100,
+        }, index=pd.Index(labels[present], name=by))
+        return result.sort_values('uptime', kind='mergesort')
+
+    def latency(self, since=None, until=None, by: str = 'state_code',
+        percentiles: Sequence[float] = PERCENTILES) -> pd.DataFrame:
+        """Computes percentiles of the latency of the successful checks.
+        The latencies are counted in buckets LATENCY_BUCKET wide, relative
+        to their value, and each percentile is the upper bound of the
+        bucket it falls in.
+
+        Args:
+            since: Optional start of the period.
+            until: Optional end of the period, inclusive.
+            by (str): Either "state_code" or "url".
+            percentiles (Sequence[float]): The percentiles, between 0
+                and 1.
+
+        Returns:
+            pd.DataFrame: The latency percentiles, in milliseconds, one
+                column for each, of each group.
+        """
+        table = self._read_table(since, until, ['status', 'latency_ms'])
+        # the checks that found the link up got a response in some time
+        up = is_up(table['status'].to_numpy())
+        groups, labels = self._groups(table['url_id'].to_numpy()[up], by)
+        latency = np.minimum(
+            table['latency_ms'].fill_null(0).to_numpy()[up], MAX_LATENCY)
+        bucket_of = np.ceil(np.log1p(np.arange(MAX_LATENCY + 1)) /
+            np.log1p(LATENCY_BUCKET)).astype(np.int64)
+        bucket_count = int(bucket_of[-1]) + 1
+        cumulative = np.bincount(groups * bucket_count + bucket_of[latency],
+            minlength=len(labels) * bucket_count) \
+            .reshape(len(labels), bucket_count).cumsum(axis=1)
+        total = cumulative[:, -1]
+        present = (total > 0) & pd.notna(labels)
+        result = pd.DataFrame(index=pd.Index(labels[present], name=by))
+        for percentile in percentiles:
+            # the nearest rank, and the bucket it is in
+            rank = np.maximum(np.ceil(percentile * total[present]), 1)
+            bucket = (cumulative[present] < rank[:, None]).sum(axis=1)
+            result[f'p{round(percentile * 100):g}'] = np.round(
+                np.expm1(bucket * np.log1p(LATENCY_BUCKET)))
+        return result
+
+    def flapping(self, since=None, until=None,
+        min_changes: int = FLAPPING_CHANGES) -> pd.DataFrame:
+        """Finds the links that went up and down repeatedly.
+
+        Args:
+            since: Optional start of the period.
+            until: Optional end of the period, inclusive.
+            min_changes (int): Minimum number of changes between up and
+                down for a link to be flapping.
+
+        Returns:
+            pd.DataFrame: The flapping links, with their state, number
+                of checks and of changes, sorted by state and changes.
+        """
+        table = self._read_table(since, until, ['status'])
+        # the checks of each url are in time order in the files, and the
+        # stable sort takes advantage of the months already sorted by url
+        order = np.argsort(table['url_id'].to_numpy(), kind='stable')
+        url_ids = table['url_id'].to_numpy()[order]
+        up = is_up(table['status'].to_numpy()[order])
+        changed = np.zeros(len(url_ids), dtype=bool)
+        changed[1:] = (up[1:] != up[:-1]) & (url_ids[1:] == url_ids[:-1])
+        changes = np.bincount(url_ids, weights=changed, minlength=len(self.urls))
+        flapping = np.flatnonzero(changes >= min_changes)
+        result = pd.DataFrame({
+            'state_code': self.urls.state_code.to_numpy()[flapping],
+            'url': self.urls.url.to_numpy()[flapping],
+            'checks': np.bincount(url_ids, minlength=len(self.urls))[flapping],
+            'changes': changes[flapping].astype(int),
+        })
+        return result.sort_values(['state_code', 'changes'],
+            ascending=[True, False], kind='mergesort').reset_index(drop=True)
+
+    def flapping_by_state(self, since=None, until=None,
+        min_changes: int = FLAPPING_CHANGES) -> pd.Series:
+        """Counts the flapping links of each state.
+
+        Args:
+            since: Optional start of the period.
+            until: Optional end of the period, inclusive.
+            min_changes (int): Minimum number of changes between up and
+                down for a link to be flapping.
+
+        Returns:
+            pd.Series: The number of flapping links of each state.
+        """
+        return self.flapping(since, until, min_changes) \
+            .groupby('state_code').size().sort_values(ascending=False)
+
+def parse_cli() -> dict:
+    """Parses the command line interface.
+
+    Returns:
+        dict: A dict containing the values for action, folder, since,
+            until, by and min_changes.
+    """
+    parser = argparse.ArgumentParser(
+        description='Queries and compacts the history of link health checks.')
+    parser.add_argument('action',
+        choices=['uptime', 'latency', 'flapping', 'compact'])
+    parser.add_argument('-f', '--folder',
+        help=f'folder of the history (default {HEALTH_FOLDER})',
+        default=HEALTH_FOLDER,
+    )
+    parser.add_argument('--since',
+        metavar='YYYY-MM-DD',
+        help='start of the period',
+        default=None,
+    )
+    parser.add_argument('--until',
+        metavar='YYYY-MM-DD',
+        help='end of the period, inclusive',
+        default=None,
+    )
+    parser.add_argument('--by',
+        choices=['state', 'url'],
+        help='group the uptime and latency by state or url (default: state)',
+        default='state',
+    )
+    parser.add_argument('--changes',
+        metavar='int', type=int,
+        help=('minimum changes between up and down for a link to be '
+            f'flapping (default {FLAPPING_CHANGES})'),
+        default=FLAPPING_CHANGES,
+    )
+    args = parser.parse_args()
+    return {
+        'action': args.action,
+        'folder': args.folder,
+        'since': args.since,
+        'until': args.until,
+        'by': 'state_code' if args.by == 'state' else 'url',
+        'min_changes': args.changes,
+    }
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_cli()
+    history = HealthHistory(options['folder'])
+    pd.set_option('display.max_rows', None)
+    pd.set_option('display.width', None)
+    if options['action'] == 'compact':
+        history.compact()
+    elif options['action'] == 'uptime':
+        print(history.uptime(options['since'], options['until'],
+            options['by']).round(2))
+    elif options['action'] == 'latency':
+        print(history.latency(options['since'], options['until'],
+            options['by']))
+    else:
+        print(history.flapping(options['since'], options['until'],
+            options['min_changes']).to_string(index=False))
+        print(history.flapping_by_state(options['since'], options['until'],
+            options['min_changes']))
@@ -0,0 +1,245 @@
+"""Columnar binary mirrors of the data package resources.
+
+The CSV files remain the source of truth. This module exports each
+resource to an uncompressed Arrow IPC file, which can be memory mapped
+and loaded without copying or parsing, and optionally to a Parquet file
+for distribution. Columns get compact types derived from the schema:
+categories for state codes and enumerated fields, 32 bit integers for
+codes and UTC timestamps for datetimes. Each mirror records the hash of
+the CSV file it was made from, so stale mirrors are detected and
+exported again.
+
+Usage:
+  python mirror.py [datapackage.json ...]
+
+Espelhos binários colunares dos recursos dos pacotes de dados, para
+carregamento rápido.
+"""
+
+import argparse
+import logging
+import os
+import pathlib
+from typing import List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from frictionless import Package
+
+from harvest.download import file_hash
+
+MIRROR_FOLDER = '../../data/mirror'
+DATA_PACKAGES = [
+    '../../data/valid/datapackage.json',
+    '../../data/auxiliary/geographic/datapackage.json',
+]
+CATEGORICAL_FIELDS = {'state_code', 'uf', 'sphere', 'branch', 'type', 'link_type'}
+SOURCE_HASH_KEY = b'source_sha256'
+
+def mirror_path(mirror_folder: str, resource_name: str,
+    extension: str = 'arrow') -> str:
+    """Gets the path of the mirror file of a resource.
+
+    Args:
+        mirror_folder (str): The folder containing the mirrors.
+        resource_name (str): The name of the resource.
+        extension (str): Either 'arrow' or 'parquet'.
+
+    Returns:
+        str: The path to the mirror file.
+    """
+    return os.path.join(mirror_folder, f'{resource_name}.{extension}')
+
+def read_typed_csv(resource) -> pd.DataFrame:
+    """Reads the CSV file of a resource with compact column types
+    derived from its schema.
+
+    Args:
+        resource (frictionless.Resource): The resource.
+
+    Returns:
+        pd.DataFrame: The typed dataframe.
+    """
+    schema = resource.schema
+    table = pd.read_csv(
+        resource.fullpath,
+        dtype=str,
+        keep_default_na=False,
+        na_values=schema.missing_values or [''],
+    )
+    for field in schema.fields:
+        column = table[field.name]
+        if field.type == 'integer':
+            maximum = field.constraints.get('maximum')
+            dtype = 'Int32' if maximum is not None and maximum < 2**31 \
+                else 'Int64'
+            table[field.name] = pd.to_numeric(column).astype(dtype)
+        elif field.type == 'number':
+            table[field.name] = pd.to_numeric(column)
+        elif field.type == 'datetime':
+            table[field.name] = pd.to_datetime(column, utc=True)
+        elif field.name in CATEGORICAL_FIELDS or 'enum' in field.constraints:
+            table[field.name] = column.astype('category')
+        else:
+            table[field.name] = column.astype('string')
+    return table
+
+def export_resource(resource, mirror_folder: str = MIRROR_FOLDER,
+    parquet: bool = False) -> str:
+    """Exports a resource to an Arrow IPC file (and optionally a Parquet
+    file), recording the hash of the source CSV file.
+
+    Args:
+        resource (frictionless.Resource): The resource.
+        mirror_folder (str): The folder where to write the mirrors.
+        parquet (bool): Whether to also write a Parquet file.
+
+    Returns:
+        str: The path to the Arrow file.
+    """
+    pathlib.Path(mirror_folder).mkdir(parents=True, exist_ok=True)
+    table = pa.Table.from_pandas(read_typed_csv(resource), preserve_index=False)
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        SOURCE_HASH_KEY: file_hash(resource.fullpath).encode('ascii'),
+    })
+
+    path = mirror_path(mirror_folder, resource.name)
+    temporary = path + '.part'
+    with pa.OSFile(temporary, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(temporary, path)
+    if parquet:
+        pq.write_table(table, mirror_path(mirror_folder, resource.name, 'parquet'))
+    logging.info('Exported %d rows of "%s" to "%s".',
+        table.num_rows, resource.name, path)
+    return path
+
+def export_package(data_package_path: str, mirror_folder: str = MIRROR_FOLDER,
+    parquet: bool = False, only_stale: bool = True) -> List[str]:
+    """Exports all resources of a data package.
+
+    Args:
+        data_package_path (str): Path to the datapackage.json file.
+        mirror_folder (str): The folder where to write the mirrors.
+        parquet (bool): Whether to also write Parquet files.
+        only_stale (bool): Whether to skip resources whose mirror is up
+            to date.
+
+    Returns:
+        List[str]: The paths to the Arrow files.
+    """
+    package = Package(data_package_path)
+    paths = []
+    for resource in package.resources:
+        path = mirror_path(mirror_folder, resource.name)
+        if only_stale and is_fresh(path, resource.fullpath):
+            paths.append(path)
+            continue
+        paths.append(export_resource(resource, mirror_folder, parquet))
+    return paths
+
+def is_fresh(path: str, source_path: str) -> bool:
+    """Checks whether a mirror was made from the current version of its
+    source CSV file.
+
+    Args:
+        path (str): Path to the Arrow file.
+        source_path (str): Path to the CSV file.
+
+    Returns:
+        bool: True if the mirror is up to date.
+    """
+    if not os.path.exists(path):
+        return False
+    with pa.memory_map(path, 'r') as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+    return metadata.get(SOURCE_HASH_KEY) == \
+        file_hash(source_path).encode('ascii')
+
+def load_table(resource_name: str, mirror_folder: str = MIRROR_FOLDER,
+    data_package_path: Optional[str] = None) -> pa.Table:
+    """Loads a resource from its Arrow mirror. The file is memory mapped,
+    so the columns are not copied into memory until they are used.
+
+    Args:
+        resource_name (str): The name of the resource.
+        mirror_folder (str): The folder containing the mirrors.
+        data_package_path (str): Optional path to the datapackage.json
+            file. If given, the mirror is exported again if it is
+            missing or stale.
+
+    Returns:
+        pa.Table: The resource data.
+    """
+    path = mirror_path(mirror_folder, resource_name)
+    if data_package_path:
+        resource = Package(data_package_path).get_resource(resource_name)
+        if not is_fresh(path, resource.fullpath):
+            export_resource(resource, mirror_folder)
+    source = pa.memory_map(path, 'r')
+    return pa.ipc.open_file(source).read_all()
+
+def load_dataframe(resource_name: str, mirror_folder: str = MIRROR_FOLDER,
+    data_package_path: Optional[str] = None) -> pd.DataFrame:
+    """Loads a resource from its Arrow mirror as a Pandas dataframe,
+    keeping the compact column types.
+
+    Args:
+        resource_name (str): The name of the resource.
+        mirror_folder (str): The folder containing the mirrors.
+        data_package_path (str): Optional path to the datapackage.json
+            file, to export the mirror again if it is missing or stale.
+
+    Returns:
+        pd.DataFrame: The resource data.
+    """
+    return load_table(resource_name, mirror_folder, data_package_path) \
+        .to_pandas(types_mapper={
+            pa.string(): pd.StringDtype(),
+            pa.int32(): pd.Int32Dtype(),
+            pa.int64(): pd.Int64Dtype(),
+        }.get)
+
+def parse_cli() -> dict:
+    """Parses the command line interface.
+
+    Returns:
+        dict: A dict containing the values for data_package_paths,
+            mirror_folder, parquet and only_stale.
+    """
+    parser = argparse.ArgumentParser(
+        description='Exports data package resources to Arrow (and Parquet) '
+            'files for fast loading.')
+    parser.add_argument('packages',
+        help='paths to datapackage.json files',
+        nargs='*',
+        default=DATA_PACKAGES,
+    )
+    parser.add_argument('-o', '--output',
+        help='folder where to write the mirrors',
+        default=MIRROR_FOLDER,
+    )
+    parser.add_argument('--parquet',
+        help='also write Parquet files',
+        action='store_true',
+    )
+    parser.add_argument('-f', '--force',
+        help='export even the resources whose mirror is up to date',
+        action='store_true',
+    )
+    args = parser.parse_args()
+    return {
+        'data_package_paths': args.packages,
+        'mirror_folder': args.output,
+        'parquet': args.parquet,
+        'only_stale': not args.force,
+    }
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_cli()
+    for package_path in options.pop('data_package_paths'):
+        export_package(package_path, **options)
@@ -0,0 +1,169 @@
+"""Keyed upsert of rows into a data package resource.
+
+New rows are matched to existing rows by a hash of their key columns,
+computed for all rows at once, so merging a dataset costs a single pass
+over both tables. Rows whose key is not found are inserted, rows whose
+key is found once are updated and rows whose key is ambiguous (repeated
+in the new data, or matching several existing rows) are reported as
+conflicts and left out.
+
+Inserção ou atualização de linhas de um recurso a partir de uma chave.
+"""
+
+import logging
+from typing import List, NamedTuple
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_numeric_dtype
+
+class UpsertResult(NamedTuple):
+    """The result of an upsert operation."""
+    table: pd.DataFrame
+    inserted: int
+    updated: int
+    conflicts: pd.DataFrame
+
+def key_hashes(table: pd.DataFrame, key: List[str]) -> pd.Series:
+    """Computes a hash of the key columns for each row.
+
+    Numeric columns are normalized to nullable integers before hashing,
+    so that e.g. 1200013 and 1200013.0 have the same hash, and missing
+    values (as in the municipality code of state and federal portals)
+    have a hash of their own that matches other missing values.
+
+    Args:
+        table (pd.DataFrame): The dataframe.
+        key (List[str]): The names of the key columns.
+
+    Returns:
+        pd.Series: A series of uint64 hashes, aligned with the table.
+    """
+    normalized = pd.DataFrame({
+        column: (
+            table[column].astype('Int64') if is_numeric_dtype(table[column])
+            else table[column]
+        ).astype('string').fillna('')
+        for column in key
+    }, index=table.index)
+    return pd.util.hash_pandas_object(normalized, index=False)
+
+def cast_like(values: pd.Series, other: pd.Series) -> pd.Series:
+    """Casts values to the dtype of another series, e.g. new values read
+    as objects to the nullable integers of the existing column, keeping
+    them as they are if they cannot be cast.
+
+    Args:
+        values (pd.Series): The values to cast.
+        other (pd.Series): The series with the dtype to cast to.
+
+    Returns:
+        pd.Series: The values, cast if possible.
+    """
+    try:
+        return values.astype(other.dtype)
+    except (TypeError, ValueError):
+        return values
+
+def differs(values: pd.Series, other: pd.Series) -> pd.Series:
+    """Compares two aligned series, whatever their dtypes, where a
+    missing value (None, NaN, NaT or pd.NA) equals another missing value
+    and differs from any other value.
+
+    Args:
+        values (pd.Series): The first series.
+        other (pd.Series): The second series, with the same index.
+
+    Returns:
+        pd.Series: A boolean series, True where the values differ.
+    """
+    missing, other_missing = values.isna(), other.isna()
+    present = ~(missing | other_missing)
+    result = missing != other_missing
+    # missing values are left out, so the comparison of objects is safe
+    result[present] = (values[present].astype(object).to_numpy() !=
+        other[present].astype(object).to_numpy())
+    return result
+
+def _flatten(table: pd.DataFrame) -> pd.DataFrame:
+    """Turns named index levels (e.g. the primary key set as index by
+    frictionless) back into columns and resets the index.
+    """
+    return table.reset_index(drop=not any(table.index.names))
+
+def upsert(existing: pd.DataFrame, new: pd.DataFrame, key: List[str],
+    on_conflict: str = 'report') -> UpsertResult:
+    """Inserts new rows and updates existing rows, matching them by key.
+
+    As in DataFrame.update, only the non missing values of the new rows
+    replace the existing values. Columns of the new data that are not in
+    the existing table are ignored.
+
+    Args:
+        existing (pd.DataFrame): The existing data.
+        new (pd.DataFrame): The data to insert or update.
+        key (List[str]): The names of the key columns.
+        on_conflict (str): Either 'report', to leave out and return the
+            conflicting rows, or 'raise', to raise a ValueError.
+
+    Returns:
+        UpsertResult: The resulting table, the number of inserted and
+            updated rows and the conflicting rows of the new data, with
+            a column explaining the reason for the conflict.
+    """
+    existing = _flatten(existing)
+    new = _flatten(new)
+    existing_hashes = key_hashes(existing, key)
+    new_hashes = key_hashes(new, key)
+
+    # keys that appear more than once cannot be matched unambiguously
+    ambiguous_existing = existing_hashes.duplicated(keep=False)
+    unique_rows = np.flatnonzero(~ambiguous_existing.to_numpy())
+    matches = pd.Index(existing_hashes.to_numpy()[unique_rows]) \
+        .get_indexer(new_hashes)
+    # positions of the matching rows in the existing table, -1 if none
+    positions = np.where(matches >= 0, unique_rows[matches], -1)
+    reasons = pd.Series(pd.NA, index=new.index, dtype='string')
+    reasons[new_hashes.isin(existing_hashes[ambiguous_existing])] = \
+        'key matches several existing rows'
+    reasons[new_hashes.duplicated(keep=False)] = 'key repeated in new data'
+    conflicts = new.loc[reasons.notna()].assign(reason=reasons.dropna())
+    if len(conflicts):
+        if on_conflict == 'raise':
+            raise ValueError(
+                f'{len(conflicts)} conflicting rows for key {key}:\n{conflicts}')
+        logging.warning('Leaving out %d conflicting rows for key %s.',
+            len(conflicts), key)
+
+    valid = reasons.isna().to_numpy()
+    to_update = valid & (positions >= 0)
+    to_insert = valid & (positions < 0)
+
+    # update matched rows, column by column, keeping existing values
+    # where the new value is missing
+    updated_rows = pd.Series(False, index=existing.index)
+    target = existing.index[positions[to_update]]
+    columns = [column for column in new.columns
+        if column in existing.columns and column not in key]
+    for column in columns:
+        current = existing.loc[target, column]
+        values = new.loc[to_update, column].set_axis(target)
+        values = cast_like(values.where(values.notna(), current), current)
+        changed = differs(values, current)
+        updated_rows.loc[target] |= changed
+        if changed.any():
+            existing[column] = (
+                values.combine_first(existing[column])
+                .reindex(existing.index)
+            )
+
+    inserted = new.loc[to_insert, [c for c in new.columns if c in existing.columns]]
+    table = pd.concat([existing, inserted], ignore_index=True) \
+        if len(inserted) else existing
+
+    return UpsertResult(
+        table=table,
+        inserted=len(inserted),
+        updated=int(updated_rows.sum()),
+        conflicts=conflicts,
+    )
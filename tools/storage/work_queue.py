@@ -0,0 +1,203 @@
+"""A work queue shared by workers on one machine.
+
+Work is split into units that workers lease for a limited time. A worker
+that finishes a unit records its result; a unit whose lease expires,
+because its worker died or was stopped, becomes available to the other
+workers again. The queue is a SQLite database in write-ahead logging
+mode, a local stand-in for a queue server: it needs no server, but the
+file must be on a local disk of the machine all the workers run on. WAL
+relies on memory shared by the processes of one host, and the locking of
+network file systems (NFS, SMB) is not reliable, so the file must not be
+shared among machines.
+
+Fila de trabalho compartilhada por processos em uma máquina.
+"""
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+LEASE_TIME = 600 # seconds
+
+def _json_default(value: Any) -> Any:
+    """Converts the values json does not know: timestamps to ISO 8601
+    text and numpy scalars to Python values.
+    """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f'{type(value)} is not JSON serializable')
+
+def worker_name() -> str:
+    """Gets a name that identifies the current process among all the
+    workers.
+
+    Returns:
+        str: The host name and process id.
+    """
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+class WorkQueue:
+    """A connection to a work queue.
+
+    Args:
+        path (str): Path to the SQLite database file. It is created if
+            it does not exist.
+        lease_time (float): Time, in seconds, a worker has to finish a
+            unit before it is given to another worker.
+    """
+    def __init__(self, path: str, lease_time: float = LEASE_TIME):
+        self.path = path
+        self.lease_time = lease_time
+        # autocommit mode, transactions are started explicitly
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS units (
+            id INTEGER PRIMARY KEY,
+            payload TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            owner TEXT,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            result TEXT
+        )''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS units_state '
+            'ON units (state, lease_expires)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Closes the connection."""
+        self.connection.close()
+
+    def put(self, payloads: Iterable[Any]) -> int:
+        """Adds units of work to the queue.
+
+        Args:
+            payloads (Iterable[Any]): The data of each unit, serializable
+                as JSON.
+
+        Returns:
+            int: The number of units added.
+        """
+        rows = [(json.dumps(payload, default=_json_default),)
+            for payload in payloads]
+        self.connection.execute('BEGIN IMMEDIATE')
+        self.connection.executemany('INSERT INTO units (payload) VALUES (?)', rows)
+        self.connection.execute('COMMIT')
+        return len(rows)
+
+    def clear(self):
+        """Removes all units from the queue."""
+        self.connection.execute('DELETE FROM units')
+
+    def claim(self, owner: str) -> Optional[Tuple[int, Any]]:
+        """Leases the next available unit: a pending one or one whose
+        lease has expired.
+
+        Args:
+            owner (str): The name of the worker.
+
+        Returns:
+            Tuple[int, Any]: The id and payload of the unit, or None if
+                there is no unit available.
+        """
+        now = time.time()
+        self.connection.execute('BEGIN IMMEDIATE') # one claim at a time
+        try:
+            row = self.connection.execute('''SELECT id, payload, state FROM units
+                WHERE state = 'pending'
+                    OR (state = 'leased' AND lease_expires < ?)
+                ORDER BY id LIMIT 1''', (now,)).fetchone()
+            if row is None:
+                return None
+            unit_id, payload, state = row
+            if state == 'leased':
+                logging.warning('Lease of unit %d expired, claiming it again.',
+                    unit_id)
+            self.connection.execute('''UPDATE units
+                SET state = 'leased', owner = ?, lease_expires = ?,
+                    attempts = attempts + 1
+                WHERE id = ?''', (owner, now + self.lease_time, unit_id))
+            return unit_id, json.loads(payload)
+        finally:
+            self.connection.execute('COMMIT')
+
+    def renew(self, unit_id: int, owner: str) -> bool:
+        """Extends the lease of a unit that is taking long.
+
+        Args:
+            unit_id (int): The id of the unit.
+            owner (str): The name of the worker.
+
+        Returns:
+            bool: False if the worker no longer holds the lease.
+        """
+        cursor = self.connection.execute('''UPDATE units SET lease_expires = ?
+            WHERE id = ? AND owner = ? AND state = 'leased' ''',
+            (time.time() + self.lease_time, unit_id, owner))
+        return cursor.rowcount == 1
+
+    def complete(self, unit_id: int, owner: str, result: Any) -> bool:
+        """Records the result of a unit. Results of workers whose lease
+        has been taken over by another worker are discarded.
+
+        Args:
+            unit_id (int): The id of the unit.
+            owner (str): The name of the worker.
+            result (Any): The result, serializable as JSON.
+
+        Returns:
+            bool: True if the result was recorded.
+        """
+        cursor = self.connection.execute('''UPDATE units
+            SET state = 'done', result = ?, lease_expires = NULL
+            WHERE id = ? AND owner = ? AND state = 'leased' ''',
+            (json.dumps(result, default=_json_default), unit_id, owner))
+        return cursor.rowcount == 1
+
+    def release(self, unit_id: int, owner: str):
+        """Gives up a unit, making it available to other workers.
+
+        Args:
+            unit_id (int): The id of the unit.
+            owner (str): The name of the worker.
+        """
+        self.connection.execute('''UPDATE units
+            SET state = 'pending', owner = NULL, lease_expires = NULL
+            WHERE id = ? AND owner = ? AND state = 'leased' ''',
+            (unit_id, owner))
+
+    def results(self) -> Iterator[Any]:
+        """Reads the results of the finished units.
+
+        Yields:
+            Any: The result of each unit, in the order they were added.
+        """
+        for (result,) in self.connection.execute(
+                "SELECT result FROM units WHERE state = 'done' ORDER BY id"):
+            yield json.loads(result)
+
+    def counts(self) -> Dict[str, int]:
+        """Counts the units in each state.
+
+        Returns:
+            Dict[str, int]: The number of pending, leased, expired and done
+                units.
+        """
+        counts = {'pending': 0, 'leased': 0, 'expired': 0, 'done': 0}
+        for state, expired, count in self.connection.execute('''
+                SELECT state, COALESCE(lease_expires < ?, 0), COUNT(*)
+                FROM units GROUP BY 1, 2''', (time.time(),)):
+            counts['expired' if state == 'leased' and expired else state] += count
+        return counts
@@ -0,0 +1,209 @@
+"""Writing of the data package CSV files.
+
+The CSV files are tracked in git, so they are written in a deterministic
+way (column order from the schema, integers without decimals, dates
+written back as they were read and a stable sort) that keeps diffs down
+to the rows that actually changed. A file is never left half written: it
+is written to a temporary file that is then renamed over the original,
+and not touched at all if its contents do not change.
+
+Escrita dos arquivos CSV dos pacotes de dados, de forma atômica e
+determinística.
+"""
+
+import difflib
+import logging
+import os
+import pathlib
+import tempfile
+from datetime import datetime
+from typing import List, NamedTuple, Optional, Tuple
+
+import pandas as pd
+from frictionless import Package
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ' # for new timestamps, in UTC
+
+class WriteResult(NamedTuple):
+    """The result of writing a CSV file."""
+    path: str
+    action: str # 'unchanged' or 'replaced'
+    changed_rows: List[Tuple[int, int]] # ranges of changed data rows
+
+def format_datetime(value) -> Optional[str]:
+    """Formats a datetime value in ISO 8601, as in the data package CSV
+    files, without changing what it says: values with a time zone are
+    written in UTC with a Z, values without one are written without it,
+    and fractions of a second are kept. Text, e.g. a value read from a
+    file and not changed, is kept as it is.
+
+    Args:
+        value: The datetime, text or missing value.
+
+    Returns:
+        str: The formatted value, or None if it is missing.
+    """
+    if isinstance(value, str):
+        return value
+    if value is None or pd.isna(value):
+        return None
+    value = pd.Timestamp(value)
+    suffix = ''
+    if value.tzinfo is not None:
+        value, suffix = value.tz_convert('UTC'), 'Z'
+    text = value.strftime('%Y-%m-%dT%H:%M:%S')
+    if value.microsecond:
+        text += f'.{value.microsecond:06d}'.rstrip('0')
+    return text + suffix
+
+def format_csv(table: pd.DataFrame, date_format: Optional[str] = None,
+    sort_by: Optional[List[str]] = None) -> str:
+    """Renders a dataframe as CSV text in a deterministic way.
+
+    Args:
+        table (pd.DataFrame): The dataframe.
+        date_format (str): Optional format for datetime columns. By
+            default they are written with format_datetime.
+        sort_by (List[str]): Optional columns to sort by. The sort is
+            stable, so rows that compare equal keep their order.
+
+    Returns:
+        str: The CSV text.
+    """
+    if sort_by:
+        table = table.sort_values(by=sort_by, kind='mergesort')
+    if date_format is None:
+        table = table.copy()
+        for column in table.columns:
+            values = table[column]
+            if pd.api.types.is_datetime64_any_dtype(values) or (
+                    values.dtype == object and values.map(
+                        lambda value: isinstance(value, datetime)).any()):
+                table[column] = values.map(format_datetime)
+    return table.to_csv(index=False, date_format=date_format)
+
+def changed_row_ranges(old_lines: List[str], new_lines: List[str]) \
+        -> List[Tuple[int, int]]:
+    """Finds which rows of the new file differ from the old one.
+
+    Args:
+        old_lines (List[str]): Lines of the old file.
+        new_lines (List[str]): Lines of the new file.
+
+    Returns:
+        List[Tuple[int, int]]: The ranges (start, end, end excluded) of
+            changed rows in the new file, counting the header as row 0.
+    """
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    return [
+        (start, end)
+        for tag, _, _, start, end in matcher.get_opcodes()
+        if tag != 'equal' and end > start
+    ]
+
+def _replace(path: str, contents: bytes):
+    """Writes the contents to a temporary file in the same folder and
+    renames it over the file at path.
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    descriptor, temporary = tempfile.mkstemp(
+        dir=folder, prefix=f'.{os.path.basename(path)}.', suffix='.part')
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(contents)
+            file.flush()
+            os.fsync(file.fileno())
+        if os.path.exists(path): # keep the original permissions
+            os.chmod(temporary, os.stat(path).st_mode)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+def write_csv(table: pd.DataFrame, path: str,
+    date_format: Optional[str] = None,
+    sort_by: Optional[List[str]] = None) -> WriteResult:
+    """Writes a dataframe to a CSV file, touching the file only if its
+    contents change, and then replacing it at once.
+
+    Args:
+        table (pd.DataFrame): The dataframe.
+        path (str): Path to the CSV file.
+        date_format (str): Optional format for datetime columns, as in
+            format_csv.
+        sort_by (List[str]): Optional columns to sort by.
+
+    Returns:
+        WriteResult: What was done to the file.
+    """
+    pathlib.Path(os.path.dirname(os.path.abspath(path))).mkdir(
+        parents=True, exist_ok=True)
+    contents = format_csv(table, date_format, sort_by).encode('utf-8')
+    try:
+        with open(path, 'rb') as file:
+            existing = file.read()
+    except FileNotFoundError:
+        existing = None
+
+    if existing == contents:
+        logging.info('"%s" is unchanged.', path)
+        return WriteResult(path, 'unchanged', [])
+
+    _replace(path, contents)
+    # the changed rows are only computed for the log
+    result = WriteResult(path, 'replaced', changed_row_ranges(
+        existing.decode('utf-8').splitlines() if existing else [],
+        contents.decode('utf-8').splitlines()
+    ))
+    logging.info('Wrote "%s" (%s): %d rows in %d changed ranges.',
+        path, result.action,
+        sum(end - start for start, end in result.changed_rows),
+        len(result.changed_rows))
+    return result
+
+def conform_to_schema(table: pd.DataFrame, fields: List) -> pd.DataFrame:
+    """Orders the columns as in the schema and stores integer fields as
+    nullable integers, so that they are not written with decimals, and
+    datetime fields as text, with format_datetime, so that the values
+    are written back as they were read. Fields missing from the
+    dataframe are left empty.
+
+    Args:
+        table (pd.DataFrame): The dataframe.
+        fields (List): The schema fields (frictionless Field objects).
+
+    Returns:
+        pd.DataFrame: The conformed dataframe.
+    """
+    if any(table.index.names):
+        table = table.reset_index()
+    table = table.reindex(columns=[field.name for field in fields])
+    for field in fields:
+        if field.type == 'integer':
+            table[field.name] = pd.to_numeric(table[field.name]).astype('Int64')
+        elif field.type == 'datetime':
+            table[field.name] = table[field.name].map(format_datetime)
+    return table
+
+def write_resource(table: pd.DataFrame, data_package_path: str,
+    resource_name: str, date_format: Optional[str] = None,
+    sort_by: Optional[List[str]] = None) -> WriteResult:
+    """Writes a dataframe to the CSV file of a data package resource,
+    conforming it to the resource schema.
+
+    Args:
+        table (pd.DataFrame): The dataframe.
+        data_package_path (str): Path to the datapackage.json file.
+        resource_name (str): The name of the resource.
+        date_format (str): Optional format for datetime columns, as in
+            format_csv.
+        sort_by (List[str]): Optional columns to sort by.
+
+    Returns:
+        WriteResult: What was done to the file.
+    """
+    package = Package(data_package_path)
+    resource = package.get_resource(resource_name)
+    table = conform_to_schema(table, resource.schema.fields)
+    return write_csv(table, resource.fullpath, date_format, sort_by)
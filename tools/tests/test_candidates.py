@@ -0,0 +1,55 @@
+"""Tests for storage.candidates."""
+
+from datetime import datetime, timezone
+
+from storage import candidates
+from storage.candidates import (CandidateStore, count_city_links,
+    iter_city_links)
+
+CSV = ('code,name,uf,link,link_type\n'
+    '1200013,Acrelândia,AC,http://acrelandia.ac.gov.br/,prefeitura\n'
+    '1200013,Acrelândia,RO,http://acrelandia.ro.gov.br/,\n'
+    '1200054,Assis Brasil,AC,http://assisbrasil.ac.gov.br/,prefeitura\n'
+    '1200013,Acrelândia,,http://camara.acrelandia.br/,camara\n'
+    '1100015,Alta Floresta,RO,http://altafloresta.ro.gov.br/,prefeitura\n')
+
+def test_cities_with_links_of_other_states_are_yielded(tmp_path):
+    """Links whose state is wrong or missing are left out, as counted,
+    and do not hold back their municipality."""
+    path = tmp_path / 'candidates.csv'
+    path.write_text(CSV, encoding='utf-8')
+    counts = count_city_links(str(path), ['AC'])
+    assert counts.to_dict() == {1200013: 1, 1200054: 1}
+    cities = {code: links.link.tolist() for code, links in
+        iter_city_links(str(path), counts, ['AC'], chunk_size=2)}
+    assert cities == {1200013: ['http://acrelandia.ac.gov.br/'],
+        1200054: ['http://assisbrasil.ac.gov.br/']}
+    assert len(list(iter_city_links(str(path), count_city_links(str(path))))) == 3
+
+def test_changed_file_is_rewritten_once(tmp_path, monkeypatch):
+    """New links are appended in batches until a link already written
+    changes, and then the file is rewritten only once, at the end."""
+    path = str(tmp_path / 'candidates.csv')
+    rewrites = []
+    write_csv = candidates.write_csv
+    monkeypatch.setattr(candidates, 'write_csv',
+        lambda table, path: rewrites.append(len(table)) or
+            write_csv(table, path))
+    now = datetime(2024, 1, 2, tzinfo=timezone.utc)
+    with CandidateStore(path, now) as store:
+        store.add_all([{'link': f'http://{number}.ac.gov.br/'}
+            for number in range(3)], 'first', batch_size=2)
+    assert rewrites == [2] # the file did not exist
+    with CandidateStore(path, now) as store:
+        store.add_all([{'link': f'http://{number}.ac.gov.br/'}
+            for number in range(3, 7)], 'second', batch_size=2)
+        assert rewrites == [2]
+        store.add_all([{'link': 'http://0.ac.gov.br/', 'code': 1200013}] +
+            [{'link': f'http://{number}.ac.gov.br/'}
+                for number in range(7, 13)], 'third', batch_size=2)
+        assert rewrites == [2]
+    assert rewrites == [2, 13]
+    table = CandidateStore(path).to_dataframe()
+    assert len(table) == 13
+    assert table.code[0] == '1200013'
+    assert table.sources[0] == 'first|third'
@@ -0,0 +1,56 @@
+"""Tests for storage.catalogue."""
+
+import json
+from datetime import datetime, timezone
+
+from storage.catalogue import Catalogue
+
+RESOURCE = 'brazilian-transparency-and-open-data-portals'
+CSV = ('state_code,municipality_code,sphere,branch,url,datasets,'
+    'last-verified-manual\n'
+    ',,federal,judiciary,https://dadosabertos.tse.jus.br/,,2022-07-25T18:56:26\n'
+    'MA,2105104,municipal,executive,http://icatu.ma/,12,2022-11-20T15:14:18.56\n'
+    'PA,1504059,municipal,executive,http://maedorio.pa/,,2023-02-27T00:05:16Z\n')
+
+def write_package(folder) -> str:
+    """Writes a data package with a portals resource to a folder."""
+    (folder / 'portals.csv').write_text(CSV, encoding='utf-8')
+    fields = [{'name': name, 'type': field_type} for name, field_type in [
+        ('state_code', 'string'), ('municipality_code', 'integer'),
+        ('sphere', 'string'), ('branch', 'string'), ('url', 'string'),
+        ('datasets', 'integer'), ('last-verified-manual', 'datetime')]]
+    package_path = folder / 'datapackage.json'
+    package_path.write_text(json.dumps({'name': 'test', 'resources': [{
+        'name': RESOURCE, 'path': 'portals.csv', 'profile': 'tabular-data-resource',
+        'schema': {'fields': fields}}]}), encoding='utf-8')
+    return str(package_path)
+
+def test_export_without_changes_is_byte_identical(tmp_path):
+    """Importing and exporting gives the same file."""
+    package_path = write_package(tmp_path)
+    with Catalogue(str(tmp_path / 'catalogue.sqlite')) as catalogue:
+        catalogue.import_package(package_path)
+        assert catalogue.export_resource(package_path, RESOURCE).action == \
+            'unchanged'
+    assert (tmp_path / 'portals.csv').read_text(encoding='utf-8') == CSV
+
+def test_upserted_times_keep_their_time_zone(tmp_path):
+    """New naive times are not labelled UTC, aware ones are."""
+    package_path = write_package(tmp_path)
+    with Catalogue(str(tmp_path / 'catalogue.sqlite')) as catalogue:
+        catalogue.import_package(package_path)
+        catalogue.upsert('portals', {'state_code': 'MA',
+            'municipality_code': 2105104, 'sphere': 'municipal',
+            'branch': 'executive',
+            'last-verified-manual': datetime(2024, 1, 2, 3, 4, 5)},
+            key=['municipality_code', 'branch'])
+        catalogue.upsert('portals', {'state_code': 'PA',
+            'municipality_code': 1504059, 'sphere': 'municipal',
+            'branch': 'executive', 'last-verified-manual':
+                datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)},
+            key=['municipality_code', 'branch'])
+        catalogue.export_resource(package_path, RESOURCE)
+    lines = (tmp_path / 'portals.csv').read_text(encoding='utf-8').splitlines()
+    assert lines[1].endswith(',2022-07-25T18:56:26')
+    assert lines[2].endswith(',12,2024-01-02T03:04:05')
+    assert lines[3].endswith(',,2024-01-02T03:04:05Z')
@@ -0,0 +1,24 @@
+"""Tests for crawling.charset."""
+
+from crawling import charset
+
+def test_ascii_page_does_not_set_the_host_encoding():
+    """A Latin-1 page is not decoded as UTF-8 after an ASCII page of the
+    same host."""
+    charset._detected.clear()
+    headers = {'content-type': 'text/html'}
+    text = 'Prefeitura Municipal de São João, informações e notícias. ' * 20
+    assert charset.decode(b'<html>ascii only</html>', headers,
+        'http://example.gov.br/') == '<html>ascii only</html>'
+    latin = f'<html>{text}</html>'.encode('latin-1')
+    assert charset.decode(latin, headers,
+        'http://example.gov.br/noticias') == f'<html>{text}</html>'
+
+def test_utf8_page_after_latin1_page():
+    """A UTF-8 page is decoded as UTF-8 whatever the host had before."""
+    charset._detected.clear()
+    headers = {'content-type': 'text/html'}
+    text = 'Câmara Municipal de Vitória, sessões e licitações. ' * 20
+    charset.decode(text.encode('latin-1'), headers, 'http://example.gov.br/a')
+    assert charset.decode(text.encode('utf-8'), headers,
+        'http://example.gov.br/b') == text
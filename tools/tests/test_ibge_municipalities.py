@@ -0,0 +1,74 @@
+"""Tests for harvest.ibge.ibge_municipalities."""
+
+import pandas as pd
+
+from harvest.ibge.ibge_municipalities import (apply_diff,
+    diff_municipalities, record_changes)
+
+WIKIDATA = 'http://www.wikidata.org/entity/'
+
+def existing_municipalities() -> pd.DataFrame:
+    """The municipality table, with the URI columns of other sources."""
+    return pd.DataFrame({
+        'uf': ['AC', 'AC', 'GO'],
+        'name': ['Acrelândia', 'Assis Brasil', 'Tocantinópolis'],
+        'code': [1200013, 1200054, 1721208],
+        'wikidata': [WIKIDATA + 'Q953086', WIKIDATA + 'Q1754403',
+            WIKIDATA + 'Q1803160'],
+    })
+
+def dtb() -> pd.DataFrame:
+    """A newer territorial division: one municipality renamed and moved,
+    one removed and one added."""
+    return pd.DataFrame({
+        'uf': ['AC', 'TO', 'AC'],
+        'code': [1200013, 1721208, 1200104],
+        'name': ['Acrelândia', 'Tocantinópolis', 'Brasiléia'],
+    })
+
+def test_diff_finds_renamed_added_and_removed():
+    """Each kind of change is found once."""
+    diff = diff_municipalities(existing_municipalities(), dtb())
+    assert diff[['change', 'code']].values.tolist() == [
+        ['added', 1200104], ['removed', 1200054], ['renamed', 1721208]]
+    renamed = diff.loc[diff.change == 'renamed'].iloc[0]
+    assert (renamed.old_uf, renamed.uf) == ('GO', 'TO')
+    assert pd.isna(diff.loc[diff.change == 'added', 'old_name'].iloc[0])
+    assert diff.loc[diff.change == 'removed', 'old_name'].iloc[0] == \
+        'Assis Brasil'
+
+def test_no_changes():
+    """The same list compared to itself has no changes."""
+    assert diff_municipalities(existing_municipalities(),
+        existing_municipalities()).empty
+
+def test_apply_diff_keeps_other_columns():
+    """The remaining municipalities keep their URIs, the removed one is
+    gone and the new one is added without them."""
+    table = existing_municipalities()
+    updated = apply_diff(table, diff_municipalities(table, dtb()))
+    assert list(updated.columns) == list(table.columns)
+    rows = updated.set_index('code')
+    assert sorted(rows.index) == [1200013, 1200104, 1721208]
+    assert rows.loc[1721208, 'uf'] == 'TO'
+    assert rows.loc[1721208, 'wikidata'] == WIKIDATA + 'Q1803160'
+    assert rows.loc[1200013, 'wikidata'] == WIKIDATA + 'Q953086'
+    assert rows.loc[1200104, 'name'] == 'Brasiléia'
+    assert pd.isna(rows.loc[1200104, 'wikidata'])
+
+def test_record_changes_appends(tmp_path):
+    """New changes are added after the ones already recorded."""
+    path = tmp_path / 'municipality-changes.csv'
+    changes = diff_municipalities(existing_municipalities(), dtb())
+    changes.insert(0, 'year', 2022)
+    record_changes(changes, str(path))
+    record_changes(changes.iloc[:0], str(path))
+    record_changes(changes.iloc[[0]].assign(year=2023), str(path))
+    lines = path.read_text(encoding='utf-8').splitlines()
+    assert lines[0] == 'year,change,code,uf,name,old_uf,old_name'
+    assert lines[1:] == [
+        '2022,added,1200104,AC,Brasiléia,,',
+        '2022,removed,1200054,,,AC,Assis Brasil',
+        '2022,renamed,1721208,TO,Tocantinópolis,GO,Tocantinópolis',
+        '2023,added,1200104,AC,Brasiléia,,',
+    ]
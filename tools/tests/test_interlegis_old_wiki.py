@@ -0,0 +1,42 @@
+"""Tests for harvest.interlegis.interlegis_old_wiki."""
+
+from harvest.interlegis.interlegis_old_wiki import parse_portals
+
+PAGE = """
+<html><body>
+<ul><li><a href="http://wiki.interlegis.leg.br/">Início</a></li></ul>
+<div id="wikipage">
+  <h1 id="Camaras">Câmaras</h1>
+  <ul>
+    <li><a href="https://web.archive.org/web/2019/http://www.acrelandia.ac.leg.br/">Acrelândia - AC</a></li>
+    <li><a href="http://www.interlegis.leg.br/">Interlegis</a></li>
+  </ul>
+  <h1 id="Prefeituras">Prefeituras</h1>
+  <ul>
+    <li><a href="http://www.bujari.ac.gov.br/">Bujari - AC</a></li>
+    <li><a href="http://www.capixaba.com.br/">Capixaba - AC</a></li>
+  </ul>
+  <h2 id="Veja">Veja também</h2>
+  <ul>
+    <li><a href="http://www.senado.leg.br/">Senado Federal</a></li>
+    <li><a href="http://trac.edgewall.org/">Trac</a></li>
+  </ul>
+</div>
+</body></html>
+"""
+
+def test_parse_portals_sections():
+    """City halls come only from the list right after their heading, and
+    city councils only from state hostnames."""
+    portals = parse_portals(PAGE.encode('utf-8'))
+    assert [(portal['link_type'], portal['name'], portal['link'],
+            portal['uf']) for portal in portals] == [
+        ('camara', 'Acrelândia', 'http://www.acrelandia.ac.leg.br/', 'AC'),
+        ('prefeitura', 'Bujari', 'http://www.bujari.ac.gov.br/', 'AC'),
+        ('prefeitura', 'Capixaba', 'http://www.capixaba.com.br/', None),
+    ]
+
+def test_parse_portals_without_wiki():
+    """A page without the wiki content has no portals."""
+    assert parse_portals(b'<html><body><ul><li><a href="http://a.ac.gov.br/">'
+        b'A</a></li></ul></body></html>') == []
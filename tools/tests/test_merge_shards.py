@@ -0,0 +1,72 @@
+"""Tests for validation.merge_shards."""
+
+import json
+
+from validation.merge_shards import merge_shards
+
+FIELDS = [('state_code', 'string'), ('municipality_code', 'integer'),
+    ('municipality', 'string'), ('sphere', 'string'), ('branch', 'string'),
+    ('url', 'string'), ('notes', 'string'), ('last-verified-auto', 'datetime'),
+    ('last-verified-manual', 'datetime')]
+HEADER = ('state_code,municipality_code,municipality,sphere,branch,url,'
+    'last-verified-auto,simhash,template\n')
+
+def write_package(folder) -> str:
+    """Writes a data package with a websites resource to a folder."""
+    (folder / 'websites.csv').write_text(
+        ','.join(name for name, _ in FIELDS) + '\n'
+        'AC,1200013,Acrelândia,municipal,executive,http://old.ac.gov.br/,,'
+        '2022-08-22T04:20:09Z,\n'
+        'AC,1200054,Assis Brasil,municipal,executive,'
+        'http://assisbrasil.ac.gov.br/,,2022-08-22T04:20:13Z,\n',
+        encoding='utf-8')
+    package_path = folder / 'datapackage.json'
+    package_path.write_text(json.dumps({'name': 'test', 'resources': [{
+        'name': 'brazilian-municipality-and-state-websites',
+        'path': 'websites.csv', 'profile': 'tabular-data-resource',
+        'schema': {'fields': [{'name': name, 'type': field_type}
+            for name, field_type in FIELDS]}}]}), encoding='utf-8')
+    return str(package_path)
+
+def write_shard(path, rows):
+    """Writes a partial output."""
+    path.write_text(HEADER + ''.join(
+        f'AC,{code},City,municipal,executive,{url},{time},,\n'
+        for code, url, time in rows), encoding='utf-8')
+    return str(path)
+
+def test_repeats_in_a_shard_keep_the_last(tmp_path):
+    """Two links of a municipality in one shard are not a conflict."""
+    package_path = write_package(tmp_path)
+    shard = write_shard(tmp_path / 'shard-1.csv', [
+        (1200013, 'http://a.ac.gov.br/', '2023-01-02T00:00:00Z'),
+        (1200013, 'http://b.ac.gov.br/', '2023-01-01T00:00:00Z')])
+    conflicts = tmp_path / 'conflicts.csv'
+    table = merge_shards([shard], package_path, str(conflicts),
+        str(tmp_path / 'review.csv'))
+    assert dict(zip(table.municipality_code, table.url)) == {
+        1200013: 'http://a.ac.gov.br/',
+        1200054: 'http://assisbrasil.ac.gov.br/'}
+    assert not conflicts.exists()
+
+def test_shards_that_disagree_are_conflicts(tmp_path):
+    """Different links of a municipality in different shards are left
+    out and reported."""
+    package_path = write_package(tmp_path)
+    shards = [
+        write_shard(tmp_path / 'shard-1.csv', [
+            (1200013, 'http://a.ac.gov.br/', '2023-01-01T00:00:00Z')]),
+        write_shard(tmp_path / 'shard-2.csv', [
+            (1200013, 'http://b.ac.gov.br/', '2023-01-01T00:00:00Z'),
+            (1200054, 'http://new.assisbrasil.ac.gov.br/',
+                '2023-01-01T00:00:00Z')]),
+    ]
+    conflicts = tmp_path / 'conflicts.csv'
+    table = merge_shards(shards, package_path, str(conflicts),
+        str(tmp_path / 'review.csv'))
+    assert dict(zip(table.municipality_code, table.url)) == {
+        1200013: 'http://old.ac.gov.br/',
+        1200054: 'http://new.assisbrasil.ac.gov.br/'}
+    lines = conflicts.read_text(encoding='utf-8').splitlines()
+    assert len(lines) == 3
+    assert all(line.endswith('shards disagree on the url') for line in lines[1:])
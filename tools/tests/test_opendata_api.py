@@ -0,0 +1,45 @@
+"""Tests for validation.opendata_api."""
+
+import json
+
+import pandas as pd
+
+from validation import opendata_api
+
+HEADER = ('state_code,municipality_code,municipality,sphere,branch,url,type,'
+    'api,datasets,api-response-time,last-verified-api\n')
+FIELDS = [('state_code', 'string'), ('municipality_code', 'integer'),
+    ('municipality', 'string'), ('sphere', 'string'), ('branch', 'string'),
+    ('url', 'string'), ('type', 'string'), ('api', 'string'),
+    ('datasets', 'integer'), ('api-response-time', 'number'),
+    ('last-verified-api', 'datetime')]
+
+def test_probed_portals_replace_all_api_columns(tmp_path, monkeypatch):
+    """A portal whose API no longer answers loses its old counts, and
+    portals not probed keep theirs."""
+    (tmp_path / 'portals.csv').write_text(HEADER +
+        'AC,1200013,Acrelândia,municipal,executive,http://a.ac.gov.br/,'
+        'PEDAG,ckan,12,0.5,2023-01-01T00:00:00Z\n'
+        'AC,1200054,Assis Brasil,municipal,executive,http://b.ac.gov.br/,'
+        'SPT,ckan,3,0.2,2023-01-01T00:00:00\n', encoding='utf-8')
+    package_path = tmp_path / 'datapackage.json'
+    package_path.write_text(json.dumps({'name': 'test', 'resources': [{
+        'name': opendata_api.PORTAL_RESOURCE_NAME, 'path': 'portals.csv',
+        'profile': 'tabular-data-resource',
+        'schema': {'fields': [{'name': name, 'type': field_type}
+            for name, field_type in FIELDS]}}]}), encoding='utf-8')
+    monkeypatch.setattr(opendata_api, 'probe_portals',
+        lambda urls, *args: pd.DataFrame([{'url': url, 'api': 'none',
+            'datasets': None, 'api-response-time': None,
+            'last-verified-api': '2024-02-03T04:05:06Z'} for url in urls]))
+    opendata_api.update_portals(str(package_path), cache_file=None)
+    lines = (tmp_path / 'portals.csv').read_text(encoding='utf-8').splitlines()
+    assert lines[1].endswith(',PEDAG,none,,,2024-02-03T04:05:06Z')
+    assert lines[2].endswith(',SPT,ckan,3,0.2,2023-01-01T00:00:00')
+
+def test_check_time_is_utc():
+    """The time of a check is written with its time zone."""
+    result = opendata_api.probe_portal('http://127.0.0.1:9/',
+        opendata_api.new_session(1), timeout=1)
+    assert result['api'] == 'none'
+    assert result['last-verified-api'].endswith('Z')
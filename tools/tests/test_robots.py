@@ -0,0 +1,64 @@
+"""Tests for crawling.robots."""
+
+import requests
+
+from crawling import robots
+from crawling.politeness import HostScheduler
+
+def test_unreachable_site_is_not_allowed(monkeypatch):
+    """A site that cannot be reached for its robots.txt file is neither
+    allowed nor requested again."""
+    requested = []
+    def fetch_robots(origin):
+        requested.append(origin)
+        return 0, ''
+    monkeypatch.setattr(robots, 'fetch_robots', fetch_robots)
+    cache = robots.RobotsCache()
+    assert not cache.allowed('http://dead.example.gov.br/')
+    assert not cache.reachable('http://dead.example.gov.br/page')
+    assert requested == ['http://dead.example.gov.br']
+
+def test_rules_and_crawl_delay(monkeypatch, tmp_path):
+    """The rules of a reachable site apply, and so does its crawl-delay."""
+    monkeypatch.setattr(robots, 'fetch_robots', lambda origin: (200,
+        'User-agent: *\nDisallow: /private/\nCrawl-delay: 3\n'))
+    cache = robots.RobotsCache(str(tmp_path / 'robots.sqlite'))
+    scheduler = HostScheduler(min_delay=0)
+    assert cache.allowed('http://example.gov.br/', scheduler)
+    assert cache.reachable('http://example.gov.br/')
+    assert not cache.allowed('http://example.gov.br/private/page')
+    assert scheduler.delay_of('example.gov.br') == 3
+
+def test_missing_file_allows_everything(monkeypatch):
+    """A robots.txt file that does not exist allows everything."""
+    monkeypatch.setattr(robots, 'fetch_robots', lambda origin: (404, ''))
+    assert robots.RobotsCache().allowed('http://example.gov.br/any')
+
+def test_crawl_delay_is_shared_by_processes(monkeypatch, tmp_path):
+    """Caches on the same database, as in the processes of a pool, space
+    their requests to a site by its crawl-delay."""
+    monkeypatch.setattr(robots, 'fetch_robots',
+        lambda origin: (200, 'User-agent: *\nCrawl-delay: 3\n'))
+    monkeypatch.setattr(robots.time, 'time', lambda: 1000.0)
+    waits = []
+    monkeypatch.setattr(robots.time, 'sleep', waits.append)
+    path = str(tmp_path / 'robots.sqlite')
+    first, second = robots.RobotsCache(path), robots.RobotsCache(path)
+    first.wait_turn('http://example.gov.br/a')
+    second.wait_turn('http://example.gov.br/b')
+    first.wait_turn('http://example.gov.br/c')
+    second.wait_turn('http://other.gov.br/')
+    assert waits == [3.0, 6.0] # the first request to a site does not wait
+
+def test_unreadable_file_is_taken_as_missing(monkeypatch):
+    """A robots.txt request that fails other than by connection, e.g. in
+    a redirect loop, allows everything; a timeout is unreachable."""
+    def get(url, **kwargs):
+        raise requests.exceptions.TooManyRedirects()
+    monkeypatch.setattr(robots.requests, 'get', get)
+    assert robots.fetch_robots('http://loop.example.gov.br') == (404, '')
+    assert robots.RobotsCache().allowed('http://loop.example.gov.br/')
+    def get(url, **kwargs):
+        raise requests.exceptions.ConnectTimeout()
+    monkeypatch.setattr(robots.requests, 'get', get)
+    assert robots.fetch_robots('http://slow.example.gov.br') == (0, '')
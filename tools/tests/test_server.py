@@ -0,0 +1,103 @@
+"""Tests for api.server."""
+
+import json
+from http import HTTPStatus
+
+import pytest
+
+from api.index import DatasetIndex, RESOURCES
+from api.server import route
+
+ROWS = {
+    'websites': (
+        ['state_code', 'municipality_code', 'sphere', 'branch', 'url'],
+        [
+            ['SP', '3550308', 'municipal', 'executive',
+                'https://www.capital.sp.gov.br/'],
+            ['SP', '', 'state', 'executive', 'https://www.sp.gov.br/'],
+        ],
+    ),
+    'portals': (
+        ['state_code', 'municipality_code', 'sphere', 'branch', 'url', 'type'],
+        [['SP', '3550308', 'municipal', 'executive',
+            'http://dados.prefeitura.sp.gov.br/', 'Dados Abertos']],
+    ),
+    'municipalities': (
+        ['code', 'name', 'uf'],
+        [
+            ['3550308', 'São Paulo', 'SP'],
+            ['3548708', 'São Bernardo do Campo', 'SP'],
+            ['2927408', 'Salvador', 'BA'],
+        ],
+    ),
+    'states': (
+        ['code', 'name', 'abbr'],
+        [['35', 'São Paulo', 'SP'], ['29', 'Bahia', 'BA']],
+    ),
+}
+INTEGERS = {'municipality_code', 'code'}
+
+@pytest.fixture
+def index(tmp_path) -> DatasetIndex:
+    """An index over a small data package with every resource."""
+    resources = []
+    for name, (columns, rows) in ROWS.items():
+        path = tmp_path / f'{name}.csv'
+        path.write_text('\n'.join(','.join(row) for row in [columns] + rows),
+            encoding='utf-8')
+        resources.append({
+            'name': RESOURCES[name],
+            'path': path.name,
+            'schema': {'fields': [{'name': column,
+                'type': 'integer' if column in INTEGERS else 'string'}
+                for column in columns]},
+        })
+    package = tmp_path / 'datapackage.json'
+    package.write_text(json.dumps({'resources': resources}), encoding='utf-8')
+    return DatasetIndex([str(package)])
+
+def test_search_by_name(index):
+    """Whole names come first, the state filters and limit cuts."""
+    status, found = route(index, '/municipalities', {'q': 'sao paulo'})
+    assert status == HTTPStatus.OK
+    assert [row['code'] for row in found] == [3550308]
+    status, found = route(index, '/municipalities', {'q': 's', 'limit': '2'})
+    assert status == HTTPStatus.OK
+    assert len(found) == 2
+    status, found = route(index, '/municipalities', {'q': 's', 'uf': 'ba'})
+    assert [row['name'] for row in found] == ['Salvador']
+
+@pytest.mark.parametrize('limit', ['0', '-1', 'ten'])
+def test_search_rejects_invalid_limit(index, limit):
+    """A limit that is not a positive integer is a bad request."""
+    status, answer = route(index, '/municipalities',
+        {'q': 'sao', 'limit': limit})
+    assert status == HTTPStatus.BAD_REQUEST
+    assert answer == {'error': 'Invalid limit'}
+
+def test_lookup(index):
+    """A municipality or state comes with its websites and portals."""
+    status, found = route(index, '/municipalities/3550308', {})
+    assert status == HTTPStatus.OK
+    assert found['name'] == 'São Paulo'
+    assert [row['url'] for row in found['websites']] == \
+        ['https://www.capital.sp.gov.br/']
+    assert len(found['portals']) == 1
+    status, found = route(index, '/states/sp', {})
+    assert status == HTTPStatus.OK
+    assert len(found['websites']) == 2
+    assert route(index, '/municipalities/9999999', {})[0] == \
+        HTTPStatus.NOT_FOUND
+    assert route(index, '/municipalities/abc', {})[0] == HTTPStatus.NOT_FOUND
+
+def test_bad_filter(index):
+    """Unknown columns, wrong types and unindexed filters are rejected."""
+    for params in ({'color': 'blue'}, {'municipality_code': 'abc'},
+            {'url': 'https://www.sp.gov.br/'}):
+        status, answer = route(index, '/websites', dict(params))
+        assert status == HTTPStatus.BAD_REQUEST
+        assert 'error' in answer
+    status, found = route(index, '/websites',
+        {'state_code': 'sp', 'sphere': 'state'})
+    assert status == HTTPStatus.OK
+    assert [row['url'] for row in found] == ['https://www.sp.gov.br/']
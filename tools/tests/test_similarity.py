@@ -0,0 +1,25 @@
+"""Tests for validation.similarity."""
+
+from validation.similarity import page_text, parking_template
+
+NEWS = ('Prefeitura Municipal de Itapipoca. Notícias: a secretaria de saúde '
+    'inicia a campanha de vacinação nas escolas do município. ') * 40
+
+def test_spam_keywords_in_the_news_are_not_spam():
+    """A city page that mentions the keywords a few times is not spam."""
+    text = page_text('<html><title>Prefeitura</title><body>'
+        f'{NEWS}<p>Câmara debate as apostas esportivas e o bet365.</p>'
+        f'<p>Procon alerta para o jogo do tigrinho.</p>{NEWS}</body></html>')
+    assert parking_template(text) is None
+
+def test_spam_page():
+    """A page made of the keywords is spam."""
+    text = page_text('<html><title>Cassino online</title><body>' +
+        '<p>Jogue no melhor cassino online, com apostas esportivas, '
+        'bônus no bet365 e no fortune tiger.</p>' * 10 + '</body></html>')
+    assert parking_template(text) == 'casino spam'
+
+def test_parking_phrases_match_once():
+    """A single parking phrase is enough."""
+    text = page_text(f'<body>{NEWS}<h1>This domain is for sale</h1></body>')
+    assert parking_template(text) == 'domain for sale'
@@ -0,0 +1,90 @@
+"""Tests for storage.upsert."""
+
+import pandas as pd
+import pytest
+
+from storage.upsert import differs, upsert
+
+KEY = ['state_code', 'municipality_code', 'sphere', 'branch']
+
+def existing_portals() -> pd.DataFrame:
+    """Portals as read by frictionless, with nullable columns."""
+    return pd.DataFrame({
+        'state_code': ['AC', 'AC', None],
+        'municipality_code': pd.array([1200013, 1200054, pd.NA], dtype='Int64'),
+        'sphere': ['municipal', 'municipal', 'federal'],
+        'branch': ['executive', 'executive', 'judiciary'],
+        'url': ['http://a.ac.gov.br/', 'http://b.ac.gov.br/', 'http://stj.jus.br/'],
+        'datasets': pd.array([pd.NA, 10, pd.NA], dtype='Int64'),
+        'last-verified-auto': pd.to_datetime(
+            [None, '2022-08-22T04:21:32', None]),
+    })
+
+def test_update_with_missing_and_nullable_values():
+    """New values read as objects, with pd.NA, update nullable columns."""
+    new = pd.DataFrame({
+        'state_code': ['AC', 'AC', None],
+        'municipality_code': [1200013.0, 1200054.0, None],
+        'sphere': ['municipal', 'municipal', 'federal'],
+        'branch': ['executive', 'executive', 'judiciary'],
+        'url': ['http://a.ac.gov.br/', 'http://b.ac.gov.br/', 'http://stj.jus.br/'],
+        'datasets': pd.Series([5, pd.NA, pd.NA], dtype=object),
+        'last-verified-auto': pd.Series([pd.NA, pd.NA, pd.NA], dtype=object),
+    })
+    result = upsert(existing_portals(), new, KEY)
+    assert result.inserted == 0
+    assert result.updated == 1
+    assert result.conflicts.empty
+    assert result.table['datasets'].dtype == 'Int64'
+    assert result.table['datasets'].tolist()[:2] == [5, 10]
+    assert result.table['last-verified-auto'].isna().tolist() == \
+        [True, False, True]
+
+def test_unchanged_rows_are_not_counted():
+    """Upserting the existing rows again changes nothing."""
+    existing = existing_portals()
+    result = upsert(existing, existing.copy(), KEY)
+    assert (result.inserted, result.updated) == (0, 0)
+    pd.testing.assert_frame_equal(result.table, existing)
+
+def test_insert_and_conflicts():
+    """Unknown keys are inserted and repeated keys are reported."""
+    new = pd.DataFrame({
+        'state_code': ['RO', 'RR', 'RR'],
+        'municipality_code': pd.array([1100015, 1400050, 1400050], dtype='Int64'),
+        'sphere': ['municipal'] * 3,
+        'branch': ['executive'] * 3,
+        'url': ['http://c.ro.gov.br/', 'http://d.rr.gov.br/', 'http://e.rr.gov.br/'],
+    })
+    result = upsert(existing_portals(), new, KEY)
+    assert result.inserted == 1
+    assert result.conflicts.reason.tolist() == ['key repeated in new data'] * 2
+    with pytest.raises(ValueError):
+        upsert(existing_portals(), new, KEY, on_conflict='raise')
+
+def test_differs_treats_missing_values_as_equal():
+    """Missing values of any kind equal each other and nothing else."""
+    values = pd.Series([None, pd.NA, 1, 2, float('nan')], dtype=object)
+    other = pd.Series(pd.array([pd.NA, pd.NA, 1, 3, 4], dtype='Int64'))
+    assert differs(values, other).tolist() == [False, False, False, True, True]
+
+def test_update_after_ambiguous_existing_rows():
+    """Rows after an ambiguous key in the existing table are matched to
+    the right rows."""
+    existing = pd.DataFrame({
+        'state_code': [None, None, 'AL', 'BA'],
+        'municipality_code': pd.array([pd.NA, pd.NA, 2704302, 2904605],
+            dtype='Int64'),
+        'sphere': ['federal', 'federal', 'municipal', 'municipal'],
+        'branch': ['judiciary', 'judiciary', 'executive', 'executive'],
+        'municipality': [None, None, 'Maceió', 'Brumado'],
+        'url': ['http://stj.jus.br/', 'http://tse.jus.br/',
+            'http://maceio.al.gov.br/', 'http://brumado.ba.gov.br/'],
+    })
+    new = existing.iloc[[3]].assign(url='http://new.brumado.ba.gov.br/')
+    result = upsert(existing, new, KEY)
+    assert result.updated == 1
+    assert result.table.url.tolist() == ['http://stj.jus.br/',
+        'http://tse.jus.br/', 'http://maceio.al.gov.br/',
+        'http://new.brumado.ba.gov.br/']
+    assert result.table.municipality.tolist()[2:] == ['Maceió', 'Brumado']
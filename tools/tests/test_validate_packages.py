@@ -0,0 +1,32 @@
+"""Tests for validation.validate_packages."""
+
+import json
+
+from validation.validate_packages import relax_schema, validate_resource
+
+def test_relax_schema_keeps_unchecked_constraints():
+    """Only the constraints checked with pandas are removed."""
+    descriptor = {'schema': {'fields': [
+        {'name': 'code', 'type': 'string', 'constraints': {
+            'required': True, 'unique': True, 'pattern': '[A-Z]{2}'}},
+        {'name': 'url', 'type': 'string', 'format': 'uri',
+            'constraints': {'required': True}},
+    ]}}
+    fields = relax_schema(descriptor)['schema']['fields']
+    assert fields[0]['constraints'] == {'unique': True, 'pattern': '[A-Z]{2}'}
+    assert fields[1] == {'name': 'url', 'type': 'string', 'format': 'default'}
+    assert descriptor['schema']['fields'][0]['constraints']['required']
+
+def test_unique_and_pattern_are_checked(tmp_path):
+    """Repeated and malformed values are reported by frictionless."""
+    (tmp_path / 'states.csv').write_text('code\nAC\nAC\nal\n', encoding='utf-8')
+    package_path = tmp_path / 'datapackage.json'
+    package_path.write_text(json.dumps({'name': 'test', 'resources': [{
+        'name': 'states', 'path': 'states.csv',
+        'profile': 'tabular-data-resource',
+        'schema': {'fields': [{'name': 'code', 'type': 'string',
+            'constraints': {'required': True, 'unique': True,
+                'pattern': '[A-Z]{2}'}}]}}]}), encoding='utf-8')
+    result = validate_resource((str(package_path), 'states'))
+    assert not result['valid']
+    assert [error[0] for error in result['errors']] == [3, 4]
@@ -0,0 +1,85 @@
+"""Tests for harvest.wikidata.wikidata_websites, against a local stand-in
+of the SPARQL endpoint."""
+
+import json
+import re
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from harvest.wikidata import wikidata_websites
+
+WEBSITES = {
+    'Q1': [('P856', 'http://acrelandia.ac.gov.br/')],
+    'Q2': [('P856', 'http://assisbrasil.ac.gov.br/'),
+        ('P194/P856', 'http://camara.assisbrasil.ac.gov.br/')],
+    'Q3': [('P1581', 'http://blog.brasileia.ac.gov.br/')],
+}
+
+class Endpoint(BaseHTTPRequestHandler):
+    """Answers the queries with the websites of the entities in their
+    VALUES block, after asking the first client to retry."""
+    queries = []
+    busy = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['content-length']))
+        query = urllib.parse.parse_qs(body.decode('utf-8'))['query'][0]
+        if Endpoint.busy:
+            Endpoint.busy = False
+            self.send_response(429)
+            self.send_header('retry-after', '0')
+            self.end_headers()
+            return
+        values = re.search(r'VALUES \?item \{([^}]*)\}', query).group(1)
+        entity_ids = re.findall(r'wd:(Q\d+)', values)
+        Endpoint.queries.append(entity_ids)
+        bindings = [{
+            'item': {'type': 'uri',
+                'value': wikidata_websites.ENTITY_PREFIX + entity_id},
+            'property': {'type': 'literal', 'value': prop},
+            'website': {'type': 'uri', 'value': website},
+        } for entity_id in entity_ids
+            for prop, website in WEBSITES.get(entity_id, [])]
+        content = json.dumps({'results': {'bindings': bindings}}).encode()
+        self.send_response(200)
+        self.send_header('content-type', 'application/sparql-results+json')
+        self.send_header('content-length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def endpoint():
+    """Serves the stand-in endpoint on a free local port."""
+    Endpoint.queries, Endpoint.busy = [], True
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Endpoint)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/sparql'
+    server.shutdown()
+    server.server_close()
+
+def test_harvest_in_batches_with_retry(endpoint, tmp_path):
+    """All entities are queried in batches, a busy endpoint is asked
+    again and the results are cached."""
+    entities = {entity_id: {'code': code, 'name': name, 'uf': 'AC'}
+        for entity_id, code, name in [('Q1', 1200013, 'Acrelândia'),
+            ('Q2', 1200054, 'Assis Brasil'), ('Q3', 1200104, 'Brasiléia')]}
+    links = wikidata_websites.harvest(entities, endpoint, batch_size=2,
+        max_simultaneous=1, cache_folder=str(tmp_path))
+    assert Endpoint.queries == [['Q1', 'Q2'], ['Q3']]
+    assert sorted((link['code'], link['link_type'], link['link'])
+        for link in links) == [
+        (1200013, 'prefeitura', 'http://acrelandia.ac.gov.br/'),
+        (1200054, 'camara', 'http://camara.assisbrasil.ac.gov.br/'),
+        (1200054, 'prefeitura', 'http://assisbrasil.ac.gov.br/'),
+        (1200104, 'link', 'http://blog.brasileia.ac.gov.br/'),
+    ]
+    assert wikidata_websites.harvest(entities, endpoint, batch_size=2,
+        max_simultaneous=1, cache_folder=str(tmp_path)) == links
+    assert len(Endpoint.queries) == 2 # answered from the cache
@@ -0,0 +1,37 @@
+"""Tests for storage.writer."""
+
+from datetime import datetime, timezone
+
+import pandas as pd
+
+from storage.writer import format_datetime, write_csv
+
+def test_format_datetime_keeps_what_the_value_says():
+    """Naive times are not labelled UTC and fractions are kept."""
+    assert format_datetime(datetime(2022, 11, 20, 15, 14, 18, 560000)) == \
+        '2022-11-20T15:14:18.56'
+    assert format_datetime(datetime(2022, 12, 29, 8, 12, 56)) == \
+        '2022-12-29T08:12:56'
+    assert format_datetime(datetime(2023, 2, 27, 0, 5, 16,
+        tzinfo=timezone.utc)) == '2023-02-27T00:05:16Z'
+    assert format_datetime(pd.Timestamp('2023-02-27T00:05:16-03:00')) == \
+        '2023-02-27T03:05:16Z'
+    assert format_datetime('2022-07-16T02:52:00') == '2022-07-16T02:52:00'
+    assert format_datetime(None) is None
+    assert format_datetime(pd.NaT) is None
+
+def test_write_csv_round_trip(tmp_path):
+    """Mixed naive and aware times are written back unchanged."""
+    path = tmp_path / 'table.csv'
+    table = pd.DataFrame({
+        'name': ['a', 'b', 'c'],
+        'time': [datetime(2022, 11, 20, 15, 14, 18, 560000),
+            datetime(2023, 2, 27, 0, 5, 16, tzinfo=timezone.utc), None],
+    })
+    assert write_csv(table, str(path)).action == 'replaced'
+    assert path.read_text(encoding='utf-8') == ('name,time\n'
+        'a,2022-11-20T15:14:18.56\n'
+        'b,2023-02-27T00:05:16Z\n'
+        'c,\n')
+    assert write_csv(table, str(path)).action == 'unchanged'
+    assert not list(tmp_path.glob('.*.part'))
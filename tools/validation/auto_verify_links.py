@@ -17,30 +17,57 @@ e câmaras municipais.
 import argparse
 from datetime import datetime
 from functools import partial
+from itertools import islice
 import logging
 import multiprocessing
 import os
-from typing import Sequence, List
+import random
+from typing import Callable, Iterable, Iterator, Optional, List, Tuple
 
 import pandas as pd
 from tqdm import tqdm
 
+from frictionless import Package
+
 from validation.verify_links import (healthy_link, get_title_and_type,
-    get_candidate_links, get_output_to_be_merged, store_csv)
+    select_candidate_cities, get_output_to_be_merged, store_csv, parse_shard,
+    WEBSITE_RESOURCE_NAME)
+from validation.fingerprint import identify_response
+from validation.similarity import (response_similarity, split_for_review,
+    SIMILARITY_COLUMNS)
+from crawling import robots, warc
+from storage.candidates import in_shard, iter_city_links
+from storage.catalogue import Catalogue
+from storage.health import HealthHistory
+from storage.upsert import upsert
+from storage.writer import conform_to_schema, write_csv
 
 INPUT_FOLDER = '../../data/unverified'
 INPUT_FILE = 'municipality-website-candidate-links.csv'
 MAX_SIMULTANEOUS = 10
 MAX_QUANTITY = 0
 OUTPUT_FOLDER = '../../data/valid'
+SHARD_FOLDER = '../../data/download-cache/shards'
+REVIEW_FILE = '../../data/unverified/municipality-website-review-links.csv'
+WARC_FOLDER = '../../data/download-cache/warc'
+ROBOTS_CACHE = '../../data/download-cache/robots.sqlite'
+HEALTH_FOLDER = '../../data/health'
+CANDIDATE_COLUMNS = ['code', 'link', 'link_type', 'name', 'uf']
+CHANGED_COLUMNS = ['sphere', 'branch', 'url', 'last-verified-auto']
+VERIFIED_COLUMNS = CANDIDATE_COLUMNS + ['last_checked'] + SIMILARITY_COLUMNS
+REVIEW_COLUMNS = ['state_code', 'municipality_code', 'municipality', 'sphere',
+    'branch', 'url', 'last-verified-auto', 'cluster', 'reason']
 
-def verify_city_links(candidates: pd.DataFrame, code: int) -> List[dict]:
+def verify_city_links(candidates: pd.DataFrame, code: int,
+    checks: Optional[List[dict]] = None) -> List[dict]:
     """Verify links for a city with a given code.
 
     Args:
         candidates (pd.DataFrame): The dataframe slice with the link
             candidates to verify.
         code (int): The IBGE municipality code associated with the link.
+        checks (List[dict]): Optional list to add a record of each check
+            to, for the health history.
 
     Returns:
         List(dict): A list of dictionaries containing information about
@@ -49,12 +76,23 @@ def verify_city_links(candidates: pd.DataFrame, code: int) -> List[dict]:
     verified_links = []
     city_links = candidates[candidates.code == code]
     for link in city_links.link.unique():
-        working_link = healthy_link(link)
+        recorded = len(checks) if checks is not None else 0
+        working_link = healthy_link(link, checks)
+        classification = None
         if working_link:
+            # a vendor platform is recorded, but does not rule the site
+            # out: many city halls are hosted on them (e.g. atende.net)
+            fingerprint = identify_response(working_link)
+            if fingerprint:
+                logging.info('Platform of %s is %s (%s).', working_link.url,
+                    fingerprint.platform, ', '.join(fingerprint.evidence))
             _, link_type = get_title_and_type(
                 working_link,
                 candidates[candidates.link==link]
             )
+            similarity = response_similarity(working_link)
+            classification = 'parked' if similarity['template'] \
+                else link_type or (fingerprint and fingerprint.portal_type)
             if link_type is not None:
                 verified_link = {
                     'code': code,
@@ -62,17 +100,76 @@ def verify_city_links(candidates: pd.DataFrame, code: int) -> List[dict]:
                     'link_type': link_type,
                     'name': city_links.name.iloc[0],
                     'uf': city_links.uf.iloc[0],
-                    'last_checked': datetime.utcnow()
+                    'last_checked': warc.capture_date(working_link) or
+                        datetime.utcnow().replace(microsecond=0),
+                    # to find parked and shared pages across the crawl
+                    **similarity,
                 }
                 verified_links.append(verified_link)
+        for check in (checks or [])[recorded:]:
+            check.update(classification=classification,
+                state_code=city_links.uf.iloc[0], municipality_code=code)
     return verified_links
 
+def verify_work_item(item: Tuple[int, pd.DataFrame],
+    checks: Optional[List[dict]] = None) -> List[dict]:
+    """Verify the links of a city handed out by the candidate links
+    reader.
+
+    Args:
+        item (Tuple[int, pd.DataFrame]): The IBGE municipality code and
+            the candidate links of the city.
+        checks (List[dict]): Optional list to add a record of each check
+            to, for the health history.
+
+    Returns:
+        List(dict): A list of dictionaries containing information about
+            the detected link.
+    """
+    code, candidates = item
+    return verify_city_links(candidates, code, checks)
+
+def verify_catalogue_city_links(database: str, code: int,
+    checks: Optional[List[dict]] = None) -> List[dict]:
+    """Verify links for a city with a given code, looking up its
+    candidate links in the catalogue.
+
+    Args:
+        database (str): Path to the catalogue database file.
+        code (int): The IBGE municipality code associated with the link.
+        checks (List[dict]): Optional list to add a record of each check
+            to, for the health history.
+
+    Returns:
+        List(dict): A list of dictionaries containing information about
+            the detected link.
+    """
+    with Catalogue(database) as catalogue:
+        return verify_city_links(catalogue.candidate_links(code), code, checks)
+
+def verify_with_checks(verify: Callable, item) -> Tuple[List[dict], List[dict]]:
+    """Verify the links of a city, keeping a record of each check, so
+    that the processes of a pool return the checks along with the
+    verified links.
+
+    Args:
+        verify (Callable): The function to verify the city with.
+        item: The city, as the function takes it.
+
+    Returns:
+        Tuple[List[dict], List[dict]]: The verified links and the checks.
+    """
+    checks = []
+    return verify(item, checks=checks), checks
+
 def parse_cli() -> dict:
     """Parses the command line interface.
 
     Returns:
         dict: A dict containing the values for input_folder, input_file,
-            data_package_path, max_quantity, max_simultaneous
+            data_package_path, max_quantity, max_simultaneous, database,
+            states, shard, partial_folder, warc_folder, replay,
+            robots_cache and health_folder
     """
     parser = argparse.ArgumentParser(
         description='''Crawls candidate URLs for municipalities websites and checks
@@ -100,6 +197,54 @@ def parse_cli() -> dict:
         help='number of processes (parallel downloads) to use',
         default=8,
     )
+    parser.add_argument('-d', '--database',
+        help=('SQLite catalogue to read candidates from and record results '
+            'in (imported from the CSV files if needed)'),
+        default=None,
+    )
+    parser.add_argument('-s', '--states',
+        metavar='UF', nargs='+',
+        help='only verify the municipalities of these states (e.g. -s AC RO)',
+        default=None,
+    )
+    parser.add_argument('--shard',
+        metavar='i/n', type=parse_shard,
+        help=('only verify the i-th of n shards of the municipalities, '
+            'e.g. 1/4 ... 4/4 on four machines'),
+        default=None,
+    )
+    parser.add_argument('--partial',
+        metavar='folder', nargs='?', const=SHARD_FOLDER,
+        help=('write the verified links to a partial output in this folder '
+            f'(default {SHARD_FOLDER}), to be combined with merge_shards.py, '
+            'instead of updating the websites resource'),
+        default=None,
+    )
+    archive = parser.add_mutually_exclusive_group()
+    archive.add_argument('--warc',
+        metavar='folder', nargs='?', const=WARC_FOLDER,
+        help=('capture the responses in WARC files in this folder '
+            f'(default {WARC_FOLDER})'),
+        default=None,
+    )
+    archive.add_argument('--replay',
+        metavar='path', nargs='+',
+        help=('classify the responses captured in these WARC files or '
+            'folders, without network access'),
+        default=None,
+    )
+    parser.add_argument('--robots-cache',
+        metavar='path',
+        help=('SQLite file in which the robots.txt files of the sites are '
+            f'kept and shared with other processes (default {ROBOTS_CACHE})'),
+        default=ROBOTS_CACHE,
+    )
+    parser.add_argument('--health-history',
+        metavar='folder',
+        help=('folder of the history of link health checks, to which the '
+            f'checks are added (default {HEALTH_FOLDER}); empty for none'),
+        default=HEALTH_FOLDER,
+    )
     params = {}
     args = parser.parse_args()
     if args.input:
@@ -126,10 +271,103 @@ def parse_cli() -> dict:
         params['max_simultaneous'] = args.processes
     else: # use default value
         params['max_simultaneous'] = MAX_SIMULTANEOUS
+    params['database'] = args.database
+    params['states'] = [state.upper() for state in args.states] \
+        if args.states else None
+    params['shard'] = args.shard
+    params['partial_folder'] = args.partial
+    params['warc_folder'] = args.warc
+    params['replay'] = args.replay
+    params['robots_cache'] = args.robots_cache
+    params['health_folder'] = args.health_history or None
     return params
 
+def merge_verified_links(table: pd.DataFrame,
+    new_links: pd.DataFrame) -> pd.DataFrame:
+    """Merges the verified links into the websites table. The first
+    existing row for the same municipality and branch is updated, or a
+    new row is added if there is none.
+
+    Args:
+        table (pd.DataFrame): The websites table.
+        new_links (pd.DataFrame): The verified links, with the column
+            names of the websites table.
+
+    Returns:
+        pd.DataFrame: The updated websites table.
+    """
+    logging.info('Updating values...')
+    for _, result in new_links.iterrows():
+        # get existing data in file to be updated
+        existing_data = table.loc[
+                (table.municipality_code == result['municipality_code']) &
+                (table.branch == result['branch'])
+            ]
+        if len(existing_data) > 0:
+            index = existing_data.index[0]
+            row = existing_data.loc[[index,]]
+            for key in CHANGED_COLUMNS:
+                row.loc[index, key] = result[key] # update the values
+            print('\n Old: ', table.loc[index, CHANGED_COLUMNS])
+            print('\n New: ', row.loc[index, CHANGED_COLUMNS])
+            table.loc[index, CHANGED_COLUMNS] = row.loc[index, CHANGED_COLUMNS]
+        else:
+            print(f'\n Adding at position {len(table)}: ', result)
+            index = len(table)
+            for key in result.keys():
+                table.loc[index, key] = result[key]
+        # enforce correct data types
+        table['municipality_code'] = table['municipality_code'].astype('Int64')
+        table['last-verified-auto'] = pd.to_datetime(
+            table['last-verified-auto'], utc=True)
+
+    # remove duplicate entries,
+    # take into account only url column,
+    # keep last entry to preserve the last-verified-auto timestamp
+    table.drop_duplicates(subset='url', keep='last', inplace=True)
+    return table
+
+def merge_verified_links_into_catalogue(catalogue: Catalogue,
+    new_links: pd.DataFrame, data_package_path: str) -> pd.DataFrame:
+    """Merges the verified links into the websites table of the
+    catalogue, in the same way as merge_verified_links, but looking up
+    each municipality and branch through the catalogue indexes.
+
+    Args:
+        catalogue (Catalogue): The catalogue.
+        new_links (pd.DataFrame): The verified links, with the column
+            names of the websites table.
+        data_package_path (str): Path to the datapackage.json file, to
+            import the websites table from if the catalogue has none.
+
+    Returns:
+        pd.DataFrame: The updated websites table.
+    """
+    if not catalogue.has_table('websites'):
+        catalogue.import_package(data_package_path)
+    logging.info('Updating values in catalogue "%s"...', catalogue.path)
+    for result in new_links.to_dict('records'):
+        action = catalogue.upsert('websites', result,
+            key=['municipality_code', 'branch'],
+            update_columns=CHANGED_COLUMNS)
+        logging.info('%s %s: %s', action.capitalize(),
+            result['municipality'], result['url'])
+    catalogue.deduplicate('websites', 'url')
+    table = catalogue.read_table('websites')
+    table['municipality_code'] = table['municipality_code'].astype('Int64')
+    table['last-verified-auto'] = pd.to_datetime(
+        table['last-verified-auto'], utc=True)
+    return table
+
 def auto_verify(input_folder: str, input_file: str, data_package_path: str,
-        max_quantity: int, max_simultaneous: int) -> pd.DataFrame:
+        max_quantity: int, max_simultaneous: int,
+        database: str = None, states: Optional[List[str]] = None,
+        shard: Optional[Tuple[int, int]] = None,
+        partial_folder: Optional[str] = None,
+        warc_folder: Optional[str] = None,
+        replay: Optional[List[str]] = None,
+        robots_cache: str = ROBOTS_CACHE,
+        health_folder: Optional[str] = HEALTH_FOLDER) -> pd.DataFrame:
     """Automatically verifies links and try to infer the link type for
     each.
 
@@ -144,88 +382,217 @@ def auto_verify(input_folder: str, input_file: str, data_package_path: str,
         max_quantity (int): Maximum quantity of links to check.
         max_simultaneous (int): Maximum quantity of simultaneous (in
             parallel) checks.
+        database (str): Optional path to a SQLite catalogue. If given,
+            the candidate links of each city are looked up in it and the
+            results are recorded in it.
+        robots_cache (str): Path to the SQLite file in which the
+            robots.txt files are shared by the processes.
+        health_folder (str): Optional folder of the health history to
+            add the checks to.
 
     Returns:
         pd.DataFrame: Pandas dataframe containing the verified links.
     """
-    candidates = get_candidate_links(
-        file_path=os.path.join(input_folder, input_file),
-        max_quantity=max_quantity)
-    codes = candidates.code.unique()
-    new_links = pd.DataFrame(columns=candidates.columns)
+    if database:
+        with Catalogue(database) as catalogue:
+            if not catalogue.has_table('candidates'):
+                catalogue.import_candidates(
+                    os.path.join(input_folder, input_file))
+            codes = catalogue.candidate_codes(states)
+        codes = [code for code, selected in
+            zip(codes, in_shard(pd.Series(codes, dtype='int64'), shard))
+            if selected]
+        random.shuffle(codes) # randomize sequence
+        if max_quantity:
+            codes = codes[:max_quantity]
+        verify = partial(verify_catalogue_city_links, database)
+        work_items = codes
+    else:
+        # only the counts of links by city are kept in memory, the links
+        # themselves are read as the cities are verified
+        file_path = os.path.join(input_folder, input_file)
+        counts = select_candidate_cities(file_path, max_quantity, states, shard)
+        codes = counts.index
+        verify = verify_work_item
+        work_items = iter_city_links(file_path, counts, states)
+    new_links = pd.DataFrame(columns=VERIFIED_COLUMNS)
     new_links['last_checked'] = pd.Series(dtype='datetime64[ns]')
 
-    def in_chunks(seq: Sequence, size: int) -> Sequence:
-        """Returns a Sequence spaced in chunks of arbitrary size.
+    def in_chunks(items: Iterable, size: int) -> Iterator[list]:
+        """Takes the items in chunks of arbitrary size, as they are
+        needed.
 
         Args:
-            seq (Sequence): The Sequence to separate in chunks.
+            items (Iterable): The items to separate in chunks.
             size (int): The chunk size.
 
         Returns:
-            Sequence: The Sequence of chunks resulting from the separation.
+            Iterator[list]: The chunks resulting from the separation.
         """
-        return (seq[pos:pos + size] for pos in range(0, len(seq), size))
+        iterator = iter(items)
+        return iter(lambda: list(islice(iterator, size)), [])
 
-    pool = multiprocessing.Pool(processes=max_simultaneous)
+    # the processes of the pool capture or replay the responses, and
+    # fetch the robots.txt file of each site only once among them
+    writer = warc.WarcWriter(warc_folder, 'verification') if warc_folder else None
+    archive = warc.WarcArchive(replay) if replay else None
+    pool = multiprocessing.Pool(processes=max_simultaneous,
+        initializer=configure_worker,
+        initargs=(writer, archive, robots.RobotsCache(robots_cache)))
 
+    checks = [] # for the health history, none if replaying
     with tqdm(total=len(codes)) as progress_bar:
         logging.info('Cralwing candidate URLs for %d cities...', len(codes))
-        for chunk in in_chunks(codes, max_simultaneous):
-            results = pool.map(partial(verify_city_links, candidates), chunk)
-            for result in results:
+        for chunk in in_chunks(work_items, max_simultaneous):
+            results = pool.map(partial(verify_with_checks, verify), chunk)
+            for result, city_checks in results:
                 for verified_link in result:
                     new_links.loc[len(new_links)] = verified_link
-            progress_bar.update(max_simultaneous)
+                checks.extend(city_checks)
+            progress_bar.update(len(chunk))
+
+    if health_folder and checks:
+        HealthHistory(health_folder).append(checks)
+
+    if partial_folder:
+        path = os.path.join(partial_folder, partial_file_name(states, shard))
+        return write_partial(new_links, path, data_package_path)
+    return merge_into_websites(new_links, data_package_path, database)
+
+def configure_worker(writer: Optional[warc.WarcWriter],
+    archive: Optional[warc.WarcArchive], robots_cache: robots.RobotsCache):
+    """Configures the crawling of a verification process.
+
+    Args:
+        writer (warc.WarcWriter): Optional writer to capture the
+            responses with.
+        archive (warc.WarcArchive): Optional archive to replay the
+            responses from.
+        robots_cache (robots.RobotsCache): The robots.txt cache.
+    """
+    warc.configure(writer, archive)
+    robots.configure(robots_cache)
+
+def partial_file_name(states: Optional[List[str]],
+    shard: Optional[Tuple[int, int]]) -> str:
+    """Names the partial output of a selection of municipalities, so that
+    running the same selection again replaces its previous output.
+
+    Args:
+        states (List[str]): The selected state abbreviations, if any.
+        shard (Tuple[int, int]): The selected shard, if any.
 
-    # read resource to be updated
-    table = get_output_to_be_merged(data_package_path)
+    Returns:
+        str: The file name.
+    """
+    parts = ['websites']
+    if states:
+        parts.append('-'.join(sorted(states)))
+    if shard:
+        parts.append(f'shard-{shard[0]}-of-{shard[1]}')
+    return '_'.join(parts) + '.csv'
+
+def write_partial(new_links: pd.DataFrame, path: str,
+    data_package_path: str) -> pd.DataFrame:
+    """Writes the verified links of a selection of municipalities to a
+    partial output, with the columns of the websites resource and the
+    similarity columns, so that parked and shared pages can be found
+    across all the partial outputs when they are merged.
+
+    Args:
+        new_links (pd.DataFrame): The verified links, as returned by
+            verify_city_links.
+        path (str): Path to the partial output CSV file.
+        data_package_path (str): Path to the datapackage.json file, for
+            the schema of the websites resource.
+
+    Returns:
+        pd.DataFrame: The rows written.
+    """
+    fields = Package(data_package_path).get_resource(
+        WEBSITE_RESOURCE_NAME).schema.fields
+    new_links = to_website_rows(new_links)
+    table = conform_to_schema(new_links, fields) \
+        .join(new_links.reindex(columns=SIMILARITY_COLUMNS))
+    write_csv(table, path,
+        sort_by=['municipality_code', 'branch', 'url'])
+    logging.info('Wrote %d verified links to "%s".', len(table), path)
+    return table
+
+def to_website_rows(new_links: pd.DataFrame) -> pd.DataFrame:
+    """Converts verified links to the columns and values of the websites
+    resource.
+
+    Args:
+        new_links (pd.DataFrame): The verified links, as returned by
+            verify_city_links.
 
+    Returns:
+        pd.DataFrame: The verified links as rows of the websites resource.
+    """
     # prepare column names
-    new_links.rename(columns={
+    new_links = new_links.rename(columns={
         'uf': 'state_code',
         'code': 'municipality_code',
         'name': 'municipality',
         'link_type': 'branch',
         'link': 'url',
         'last_checked': 'last-verified-auto'
-    }, inplace=True)
+    })
 
     # map values
     new_links.branch = new_links.branch.str.replace('prefeitura', 'executive')
     new_links.branch = new_links.branch.str.replace('camara', 'legislative')
     new_links['sphere'] = 'municipal'
+    return new_links
 
-    logging.info('Updating values...')
-    for _, result in new_links.iterrows():
-        # get existing data in file to be updated
-        existing_data = table.loc[
-                (table.municipality_code == result['municipality_code']) &
-                (table.branch == result['branch'])
-            ]
-        if len(existing_data) > 0:
-            index = existing_data.index[0]
-            row = existing_data.loc[[index,]]
-            changed_columns = ['sphere', 'branch', 'url', 'last-verified-auto']
-            for key in changed_columns:
-                row.loc[index, key] = result[key] # update the values
-            print('\n Old: ', table.loc[index, changed_columns])
-            print('\n New: ', row.loc[index, changed_columns])
-            table.loc[index, changed_columns] = row.loc[index, changed_columns]
-        else:
-            print(f'\n Adding at position {len(table)}: ', result)
-            index = len(table)
-            for key in result.keys():
-                table.loc[index, key] = result[key]
-        # enforce correct data types
-        table['municipality_code'] = table['municipality_code'].astype('Int64')
-        table['last-verified-auto'] = pd.to_datetime(
-            table['last-verified-auto'], utc=True)
+def store_for_review(review: pd.DataFrame, review_path: str = REVIEW_FILE):
+    """Adds the verified links that need review to the review file,
+    updating the ones already there.
 
-    # remove duplicate entries,
-    # take into account only url column,
-    # keep last entry to preserve the last-verified-auto timestamp
-    table.drop_duplicates(subset='url', keep='last', inplace=True)
+    Args:
+        review (pd.DataFrame): The links, as returned by split_for_review.
+        review_path (str): Path to the review file.
+    """
+    if review.empty:
+        return
+    review = review.reindex(columns=REVIEW_COLUMNS)
+    if os.path.exists(review_path):
+        review = upsert(pd.read_csv(review_path), review, key=['url'],
+            on_conflict='raise').table
+    review['municipality_code'] = review['municipality_code'].astype('Int64')
+    review['last-verified-auto'] = pd.to_datetime(
+        review['last-verified-auto'], utc=True)
+    write_csv(review[REVIEW_COLUMNS], review_path,
+        sort_by=['state_code', 'municipality', 'branch', 'url'])
+
+def merge_into_websites(new_links: pd.DataFrame, data_package_path: str,
+    database: str = None, review_path: str = REVIEW_FILE) -> pd.DataFrame:
+    """Merges verified links into the websites resource. Links to parked
+    pages or to pages shared by several municipalities are not merged,
+    but stored in the review file.
+
+    Args:
+        new_links (pd.DataFrame): The verified links, as returned by
+            verify_city_links.
+        data_package_path (str): Path to the datapackage.json file.
+        database (str): Optional path to a SQLite catalogue to merge the
+            links into, instead of the resource read from the CSV file.
+        review_path (str): Path to the review file.
+
+    Returns:
+        pd.DataFrame: The updated websites table.
+    """
+    new_links, review = split_for_review(to_website_rows(new_links))
+    store_for_review(review, review_path)
+    if database:
+        with Catalogue(database) as catalogue:
+            table = merge_verified_links_into_catalogue(
+                catalogue, new_links, data_package_path)
+    else:
+        # read resource to be updated
+        table = get_output_to_be_merged(data_package_path)
+        table = merge_verified_links(table, new_links)
     table.sort_values(
         by=['sphere', 'state_code', 'municipality', 'branch'],
         inplace=True)
@@ -237,4 +604,5 @@ if __name__ == '__main__':
     logging.getLogger().setLevel(logging.INFO)
     options = parse_cli()
     table = auto_verify(**options)
-    store_csv(table, options['data_package_path'])
+    if not options['partial_folder']:
+        store_csv(table, options['data_package_path'])
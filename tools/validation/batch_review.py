@@ -0,0 +1,403 @@
+"""Batch review of candidate links, for the manual verification.
+
+Instead of opening one browser tab per link and waiting for an answer on
+the terminal, the candidate links of many municipalities are fetched
+beforehand, in parallel, and listed on a single local page with their
+final url, status, title, predicted type, platform and warnings about
+parked pages and pages near identical to those of other municipalities
+(see similarity.py). The reviewer selects rows and decides on all of
+them at once with the keyboard. The decisions are sent back when the
+review is finished, to be recorded all at once.
+
+The page is served only on the local address, under a random path, so
+that the candidate sites opened during the review cannot send decisions.
+
+Revisão em lote de links candidatos, para a verificação manual: os links
+são acessados antes, em paralelo, e listados numa única página local
+onde o revisor decide sobre vários de uma vez pelo teclado.
+"""
+
+from datetime import datetime, timezone
+import json
+import logging
+import secrets
+import threading
+import webbrowser
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pool
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from crawling.robots import RobotsCache
+from validation.auto_verify_links import configure_worker
+from validation.verify_links import healthy_link, get_title_and_type
+from validation.fingerprint import identify_response
+from validation.similarity import response_similarity, review_reasons
+
+HOST = '127.0.0.1'
+PORT = 0 # any free port
+MAX_SIMULTANEOUS = 10
+BRANCHES = {'prefeitura': 'executive', 'camara': 'legislative'}
+DECISIONS = list(BRANCHES) + ['none']
+
+def prefetch_city_links(item: Tuple[int, pd.DataFrame]) -> List[dict]:
+    """Fetches the candidate links of a city and gathers what the
+    reviewer needs to decide on each of them.
+
+    Args:
+        item (Tuple[int, pd.DataFrame]): The IBGE municipality code and
+            the candidate links of the city.
+
+    Returns:
+        List[dict]: One dict for each link, with its final url, status
+            code, title, predicted type, platform and similarity columns.
+    """
+    code, candidates = item
+    city_links = candidates[candidates.code == code]
+    prefetched = []
+    for link in city_links.link.unique():
+        checks = []
+        response = healthy_link(link, checks)
+        entry = {
+            'code': int(code),
+            'name': city_links.name.iloc[0],
+            'uf': city_links.uf.iloc[0],
+            'link': link,
+            'final_url': checks[-1]['final_url'] if checks else None,
+            'status': checks[-1]['status'] if checks else None,
+            'title': None,
+            'link_type': None,
+            'platform': None,
+            'simhash': None,
+            'template': None,
+        }
+        if response:
+            entry['final_url'] = response.url
+            entry['status'] = response.status_code
+            entry['title'], entry['link_type'] = get_title_and_type(
+                response, candidates[candidates.link == link])
+            fingerprint = identify_response(response)
+            if fingerprint:
+                entry['platform'] = fingerprint.platform + (
+                    f' ({fingerprint.portal_type} portal)'
+                    if fingerprint.portal_type else '')
+            entry.update(response_similarity(response))
+        prefetched.append(entry)
+    return prefetched
+
+def prefetch(candidates: pd.DataFrame,
+    max_simultaneous: int = MAX_SIMULTANEOUS,
+    robots_cache: Optional[str] = None) -> List[dict]:
+    """Fetches all the candidate links in parallel, one city per task,
+    and warns about parked pages and pages shared by several
+    municipalities.
+
+    Args:
+        candidates (pd.DataFrame): The candidate links.
+        max_simultaneous (int): Number of processes to use.
+        robots_cache (str): Path to the SQLite file in which the
+            robots.txt files and the turns of the sites are shared by the
+            processes, or None to keep them in the memory of each one.
+
+    Returns:
+        List[dict]: The links to review, by state, municipality and link,
+            each with an id and, if any, a warning and the cluster of
+            near identical pages it belongs to.
+    """
+    items = [(code, city) for code, city in candidates.groupby('code')]
+    links = []
+    logging.info('Fetching the candidate links of %d cities...', len(items))
+    # fetch the robots.txt file of each site only once among them
+    with Pool(processes=max_simultaneous, initializer=configure_worker,
+            initargs=(None, None, RobotsCache(robots_cache))) as pool:
+        for count, city_links in enumerate(
+                pool.imap_unordered(prefetch_city_links, items), start=1):
+            links.extend(city_links)
+            if count % 50 == 0:
+                logging.info('Fetched %d of %d cities.', count, len(items))
+    if not links:
+        return []
+    table = pd.DataFrame(links)
+    table['url'] = table.final_url
+    reasons = review_reasons(table, code_column='code')
+    table['warning'], table['cluster'] = reasons.reason, reasons.cluster
+    table.sort_values(by=['uf', 'name', 'link'], inplace=True)
+    table.insert(0, 'id', range(len(table)))
+    table['status'] = table.status.astype('Int64')
+    table = table.drop(columns=['url', 'simhash']).astype(object)
+    return table.where(table.notna(), None).to_dict('records')
+
+def decided_links(links: List[dict], decisions: Dict[int, str]) -> List[dict]:
+    """Converts the decisions of the reviewer into verified links.
+
+    Args:
+        links (List[dict]): The links reviewed, as returned by prefetch.
+        decisions (Dict[int, str]): The decision on each link, by id:
+            "prefeitura", "camara" or "none". Links without a decision
+            are left out.
+
+    Returns:
+        List[dict]: The verified links, with the columns of the websites
+            resource and the time of the review in last-verified-manual.
+    """
+    reviewed = datetime.now(timezone.utc).replace(microsecond=0)
+    verified_links = []
+    for link in links:
+        branch = BRANCHES.get(decisions.get(link['id']))
+        if branch is None or link['status'] != 200:
+            continue
+        verified_links.append({
+            'state_code': link['uf'],
+            'municipality_code': link['code'],
+            'municipality': link['name'],
+            'sphere': 'municipal',
+            'branch': branch,
+            'url': link['final_url'], # update if redirected
+            'last-verified-manual': reviewed,
+        })
+    return verified_links
+
+PAGE = '''<!DOCTYPE html>
+<html lang="pt-BR">
+<head>
+<meta charset="utf-8">
+<title>Candidate links review</title>
+<style>
+body { font: 14px sans-serif; margin: 0; }
+header { position: sticky; top: 0; background: #eee; padding: 6px 10px;
+  border-bottom: 1px solid #ccc; }
+table { border-collapse: collapse; width: 100%; }
+td, th { padding: 3px 6px; border-bottom: 1px solid #ddd; text-align: left;
+  vertical-align: top; }
+td.url { max-width: 28em; overflow-wrap: anywhere; }
+tr.focus { outline: 2px solid #36c; }
+tr.selected { background: #def; }
+tr.prefeitura td.decision, tr.camara td.decision { color: #070; font-weight: bold; }
+tr.none td.decision { color: #a00; font-weight: bold; }
+tr.failed { color: #999; }
+td.warning { color: #b50; }
+kbd { border: 1px solid #999; border-radius: 3px; padding: 0 3px; }
+</style>
+</head>
+<body>
+<header>
+<kbd>j</kbd>/<kbd>k</kbd> move, <kbd>J</kbd>/<kbd>K</kbd> extend selection,
+<kbd>x</kbd> select, <kbd>*</kbd> select same warning, <kbd>A</kbd> select all,
+<kbd>Esc</kbd> clear &mdash;
+on the selection (or the current row): <kbd>a</kbd> accept predicted type,
+<kbd>p</kbd> prefeitura, <kbd>c</kbd> c&acirc;mara, <kbd>n</kbd> none,
+<kbd>u</kbd> undo &mdash; <kbd>o</kbd> open link, <kbd>W</kbd> write all
+decisions and finish.
+<span id="summary"></span>
+</header>
+<table>
+<thead><tr><th></th><th>UF</th><th>Municipality</th><th>Link</th><th>Final url</th>
+<th>Status</th><th>Title</th><th>Predicted</th><th>Platform</th><th>Warning</th>
+<th>Decision</th></tr></thead>
+<tbody id="links"></tbody>
+</table>
+<script>
+const TOKEN = "__TOKEN__";
+const COLUMNS = ["uf", "name", "link", "final_url", "status", "title",
+  "link_type", "platform", "warning"];
+let links = [], rows = [], focus = 0, anchor = 0, finished = false;
+const selected = new Set(), decisions = {};
+
+function cell(row, text, className) {
+  const td = row.insertCell();
+  td.textContent = text === null ? "" : text;
+  if (className) td.className = className;
+  return td;
+}
+
+function render() {
+  const body = document.getElementById("links");
+  for (const link of links) {
+    const row = body.insertRow();
+    cell(row, link.id + 1);
+    for (const column of COLUMNS) {
+      cell(row, column === "status" && !link.status ?
+        "unreachable" : link[column], column === "warning" ? "warning" :
+        column.endsWith("link") || column === "final_url" ? "url" : "");
+    }
+    cell(row, "", "decision");
+    row.addEventListener("click", () => move(rows.indexOf(row), false));
+    rows.push(row);
+  }
+  update();
+}
+
+function update() {
+  rows.forEach((row, position) => {
+    const id = links[position].id, decision = decisions[id] || "";
+    row.className = (links[position].status !== 200 ? "failed " : "") + decision;
+    row.classList.toggle("selected", selected.has(position));
+    row.classList.toggle("focus", position === focus);
+    row.lastChild.textContent = decision;
+  });
+  const count = Object.keys(decisions).length;
+  document.getElementById("summary").textContent =
+    ` — ${count} of ${links.length} decided, ${selected.size} selected`;
+}
+
+function move(position, extend) {
+  focus = Math.max(0, Math.min(rows.length - 1, position));
+  if (extend) {
+    selected.clear();
+    for (let p = Math.min(anchor, focus); p <= Math.max(anchor, focus); p++)
+      selected.add(p);
+  } else {
+    anchor = focus;
+  }
+  rows[focus].scrollIntoView({block: "nearest"});
+  update();
+}
+
+function targets() {
+  return selected.size ? [...selected] : [focus];
+}
+
+function decide(choice) {
+  for (const position of targets()) {
+    const link = links[position];
+    const decision = choice === "accept" ? link.link_type : choice;
+    if (decision === null || decision === undefined) delete decisions[link.id];
+    else decisions[link.id] = decision;
+  }
+  selected.clear();
+  move(focus + 1, false);
+}
+
+async function finish() {
+  const count = Object.keys(decisions).length;
+  if (!confirm(`Write ${count} decisions and finish the review?`)) return;
+  const response = await fetch(`/${TOKEN}/decisions`, {method: "POST",
+    headers: {"Content-Type": "application/json"},
+    body: JSON.stringify(decisions)});
+  finished = response.ok;
+  document.body.textContent = response.ok ?
+    `${count} decisions sent, this page can be closed.` :
+    `Error: ${await response.text()}`;
+}
+
+document.addEventListener("keydown", (event) => {
+  if (finished || event.ctrlKey || event.metaKey || event.altKey) return;
+  const actions = {
+    j: () => move(focus + 1, false), k: () => move(focus - 1, false),
+    ArrowDown: () => move(focus + 1, false), ArrowUp: () => move(focus - 1, false),
+    J: () => move(focus + 1, true), K: () => move(focus - 1, true),
+    x: () => { selected.has(focus) ? selected.delete(focus) : selected.add(focus);
+      update(); },
+    "*": () => { const group = (link) => link.cluster || link.warning;
+      const current = group(links[focus]);
+      rows.forEach((_, p) => { if (current && group(links[p]) === current)
+        selected.add(p); }); update(); },
+    A: () => { rows.forEach((_, p) => selected.add(p)); update(); },
+    Escape: () => { selected.clear(); update(); },
+    a: () => decide("accept"), p: () => decide("prefeitura"),
+    c: () => decide("camara"), n: () => decide("none"), u: () => decide(null),
+    o: () => window.open(links[focus].final_url || links[focus].link, "_blank",
+      "noopener"),
+    W: finish,
+  };
+  if (actions[event.key]) {
+    event.preventDefault();
+    actions[event.key]();
+  }
+});
+
+window.addEventListener("beforeunload", (event) => {
+  if (!finished && Object.keys(decisions).length) event.preventDefault();
+});
+
+fetch(`/${TOKEN}/links`).then((response) => response.json()).then((data) => {
+  links = data;
+  render();
+});
+</script>
+</body>
+</html>
+'''
+
+class ReviewHandler(BaseHTTPRequestHandler):
+    """Serves the review page and the links, and receives the decisions."""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def send(self, status: HTTPStatus, body: bytes, content_type: str):
+        """Sends a response."""
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """Sends the page or the links."""
+        token = self.server.token
+        if self.path in (f'/{token}', f'/{token}/'):
+            self.send(HTTPStatus.OK,
+                PAGE.replace('__TOKEN__', token).encode('utf-8'),
+                'text/html; charset=utf-8')
+        elif self.path == f'/{token}/links':
+            self.send(HTTPStatus.OK, json.dumps(self.server.links,
+                    ensure_ascii=False, default=str).encode('utf-8'),
+                'application/json; charset=utf-8')
+        else:
+            self.send(HTTPStatus.NOT_FOUND, b'Not found', 'text/plain')
+
+    def do_POST(self):
+        """Receives the decisions and stops the server."""
+        if self.path != f'/{self.server.token}/decisions' or \
+                self.headers.get('Content-Type') != 'application/json':
+            self.send(HTTPStatus.NOT_FOUND, b'Not found', 'text/plain')
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            decisions = {int(key): value for key, value in
+                json.loads(self.rfile.read(length)).items()}
+        except (ValueError, AttributeError):
+            self.send(HTTPStatus.BAD_REQUEST, b'Invalid decisions', 'text/plain')
+            return
+        if any(value not in DECISIONS for value in decisions.values()):
+            self.send(HTTPStatus.BAD_REQUEST, b'Invalid decisions', 'text/plain')
+            return
+        self.server.decisions = decisions
+        self.send(HTTPStatus.OK, b'OK', 'text/plain')
+        # shutdown waits for serve_forever, which runs in another thread
+        threading.Thread(target=self.server.shutdown).start()
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+def review(links: List[dict], host: str = HOST, port: int = PORT,
+    open_browser: bool = True) -> Optional[Dict[int, str]]:
+    """Serves the review page until the reviewer sends the decisions.
+
+    Args:
+        links (List[dict]): The links to review, as returned by prefetch.
+        host (str): The address to listen on.
+        port (int): The port to listen on, or 0 for any free port.
+        open_browser (bool): Whether to open the page in the web browser.
+
+    Returns:
+        Dict[int, str]: The decision on each link, by id, or None if the
+            review was interrupted.
+    """
+    with ThreadingHTTPServer((host, port), ReviewHandler) as server:
+        server.daemon_threads = True
+        server.token = secrets.token_urlsafe(16)
+        server.links = links
+        server.decisions = None
+        url = f'http://{host}:{server.server_address[1]}/{server.token}/'
+        print(f'Review {len(links)} links at {url}')
+        if open_browser:
+            webbrowser.open(url)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return server.decisions
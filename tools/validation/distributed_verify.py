@@ -0,0 +1,324 @@
+"""
+This script runs the automatic verification of the candidate links with
+several independent workers, sharing the work through a queue.
+
+First the candidate links are split into units of a few municipalities
+and put in the queue. Then any number of workers take units, verify them
+and record the results. Units whose worker stops before finishing are
+given to another worker after a while. Finally, the results are merged
+into the websites resource in a single step, and the checks made by all
+the workers are added to the health history.
+
+The queue is a SQLite file (see storage/work_queue.py), which must be on
+a local disk, with all the workers on the same machine: it must not be
+shared among machines through a network folder. To split a verification
+among machines, use the shards of auto_verify_links.py and
+merge_shards.py instead.
+
+Usage:
+  python distributed_verify.py enqueue queue.sqlite
+  python distributed_verify.py work queue.sqlite -p 10   (in each worker)
+  python distributed_verify.py status queue.sqlite
+  python distributed_verify.py merge queue.sqlite
+
+Este script executa a verificação automática dos links candidatos com
+vários trabalhadores independentes em uma máquina, dividindo o trabalho
+por meio de uma fila.
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from functools import partial
+from typing import Iterator, List, Optional, Tuple
+
+import pandas as pd
+
+from crawling import warc
+from crawling.robots import RobotsCache
+from storage.health import HealthHistory
+from storage.work_queue import WorkQueue, worker_name, LEASE_TIME
+from validation.auto_verify_links import (verify_work_item, verify_with_checks,
+    configure_worker, merge_into_websites, CANDIDATE_COLUMNS,
+    VERIFIED_COLUMNS, INPUT_FOLDER, INPUT_FILE, OUTPUT_FOLDER,
+    MAX_SIMULTANEOUS, ROBOTS_CACHE, WARC_FOLDER, HEALTH_FOLDER)
+from validation.verify_links import iter_candidate_links, store_csv
+
+UNIT_SIZE = 10 # municipalities per unit of work
+POLL_INTERVAL = 30 # seconds
+
+def enqueue(queue_path: str, candidates_file: str, unit_size: int = UNIT_SIZE,
+    max_quantity: int = 0) -> int:
+    """Splits the candidate links into units of work and puts them in the
+    queue, replacing any previous contents.
+
+    Args:
+        queue_path (str): Path to the queue database.
+        candidates_file (str): Path to the candidate links file.
+        unit_size (int): Number of municipalities per unit.
+        max_quantity (int): Maximum number of municipalities, 0 for all.
+
+    Returns:
+        int: The number of units.
+    """
+    cities = 0
+
+    def units() -> Iterator[dict]:
+        nonlocal cities
+        unit_codes, unit_candidates = [], []
+        for code, candidates in iter_candidate_links(candidates_file,
+                max_quantity):
+            cities += 1
+            unit_codes.append(code)
+            # the workers need no access to the candidate links file
+            unit_candidates.extend(candidates[CANDIDATE_COLUMNS]
+                .to_dict('records'))
+            if len(unit_codes) == unit_size:
+                yield {'codes': unit_codes, 'candidates': unit_candidates}
+                unit_codes, unit_candidates = [], []
+        if unit_codes:
+            yield {'codes': unit_codes, 'candidates': unit_candidates}
+
+    with WorkQueue(queue_path) as queue:
+        queue.clear()
+        count = queue.put(units())
+    logging.info('Queued %d municipalities in %d units.', cities, count)
+    return count
+
+def verify_unit(pool: multiprocessing.Pool, unit: dict) \
+        -> Tuple[List[dict], List[dict]]:
+    """Verifies the candidate links of a unit of work.
+
+    Args:
+        pool (multiprocessing.Pool): The processes to verify with.
+        unit (dict): The unit, as created by enqueue.
+
+    Returns:
+        Tuple[List[dict], List[dict]]: The verified links and the checks
+            made, for the health history.
+    """
+    candidates = pd.DataFrame(unit['candidates'], columns=CANDIDATE_COLUMNS)
+    cities = dict(tuple(candidates.groupby('code', sort=False)))
+    results = pool.map(partial(verify_with_checks, verify_work_item),
+        [(code, cities[code]) for code in unit['codes']])
+    return (
+        [verified_link for result, _ in results for verified_link in result],
+        [check for _, checks in results for check in checks],
+    )
+
+def renew_lease(queue_path: str, lease_time: float, unit_id: int, owner: str,
+    stop: threading.Event):
+    """Renews the lease of a unit every third of the lease time until
+    stopped, so that a unit that takes long (e.g. with many unreachable
+    sites) is not given to another worker while it is being verified. If
+    the worker dies, the renewals stop and the lease expires as usual.
+    Meant to run in a thread, with its own connection to the queue.
+
+    Args:
+        queue_path (str): Path to the queue database.
+        lease_time (float): Time, in seconds, of the lease.
+        unit_id (int): The id of the unit.
+        owner (str): The name of the worker.
+        stop (threading.Event): Set when the unit is finished.
+    """
+    with WorkQueue(queue_path, lease_time) as queue:
+        while not stop.wait(lease_time / 3):
+            if not queue.renew(unit_id, owner):
+                logging.warning('Could not renew the lease of unit %d.',
+                    unit_id)
+                return
+
+def work(queue_path: str, max_simultaneous: int = MAX_SIMULTANEOUS,
+    wait: bool = False, lease_time: float = LEASE_TIME,
+    robots_cache: str = ROBOTS_CACHE,
+    warc_folder: Optional[str] = None) -> int:
+    """Takes units from the queue and verifies them until there are none
+    left. The result of each unit holds its verified links and the checks
+    made, which are added to the health history when merging, as only
+    one process should append to it.
+
+    Args:
+        queue_path (str): Path to the queue database.
+        max_simultaneous (int): Number of processes to verify with.
+        wait (bool): Whether to keep waiting for units whose lease may
+            expire, until all are done.
+        lease_time (float): Time, in seconds, to finish a unit.
+        robots_cache (str): Path to the SQLite file in which the
+            robots.txt files are shared by the processes.
+        warc_folder (str): Optional folder to capture the responses in,
+            in WARC files.
+
+    Returns:
+        int: The number of units done by this worker.
+    """
+    owner = worker_name()
+    done = 0
+    writer = warc.WarcWriter(warc_folder, 'verification') if warc_folder else None
+    with WorkQueue(queue_path, lease_time) as queue, \
+            multiprocessing.Pool(processes=max_simultaneous,
+                initializer=configure_worker,
+                initargs=(writer, None, RobotsCache(robots_cache))) as pool:
+        while True:
+            claimed = queue.claim(owner)
+            if claimed is None:
+                counts = queue.counts()
+                if not wait or counts['pending'] + counts['leased'] + \
+                        counts['expired'] == 0:
+                    break
+                time.sleep(POLL_INTERVAL)
+                continue
+            unit_id, unit = claimed
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=renew_lease, daemon=True,
+                args=(queue_path, lease_time, unit_id, owner, stop))
+            heartbeat.start()
+            try:
+                try:
+                    verified_links, checks = verify_unit(pool, unit)
+                finally:
+                    stop.set()
+                    heartbeat.join()
+            except BaseException:
+                queue.release(unit_id, owner)
+                raise
+            if queue.complete(unit_id, owner,
+                    {'links': verified_links, 'checks': checks}):
+                done += 1
+                logging.info('%s finished unit %d: %d links verified.',
+                    owner, unit_id, len(verified_links))
+            else:
+                logging.warning('Lease of unit %d was lost, result discarded.',
+                    unit_id)
+    return done
+
+def merge(queue_path: str, data_package_path: str,
+    health_folder: Optional[str] = HEALTH_FOLDER) -> pd.DataFrame:
+    """Merges the results of all the finished units into the websites
+    resource, and adds their checks to the health history.
+
+    Args:
+        queue_path (str): Path to the queue database.
+        data_package_path (str): Path to the datapackage.json file.
+        health_folder (str): Optional folder of the health history to
+            add the checks to. Merging the same queue again adds them
+            again.
+
+    Returns:
+        pd.DataFrame: The updated websites table.
+    """
+    with WorkQueue(queue_path) as queue:
+        counts = queue.counts()
+        if counts['done'] < sum(counts.values()):
+            logging.warning('Merging only %d of %d units: %s.',
+                counts['done'], sum(counts.values()), counts)
+        verified_links, checks = [], []
+        for result in queue.results():
+            verified_links.extend(result['links'])
+            checks.extend(result['checks'])
+    if health_folder and checks:
+        HealthHistory(health_folder).append(checks)
+    new_links = pd.DataFrame(verified_links, columns=VERIFIED_COLUMNS)
+    new_links['last_checked'] = pd.to_datetime(new_links['last_checked'])
+    logging.info('Merging %d verified links...', len(new_links))
+    return merge_into_websites(new_links, data_package_path)
+
+def parse_cli() -> dict:
+    """Parses the command line interface.
+
+    Returns:
+        dict: A dict containing the action and its options.
+    """
+    parser = argparse.ArgumentParser(
+        description='Verifies candidate links with several workers on '
+            'one machine, sharing the work through a queue.')
+    parser.add_argument('action', choices=['enqueue', 'work', 'status', 'merge'])
+    parser.add_argument('queue',
+        help='path to the queue database file, on a local disk')
+    parser.add_argument('-i', '--input',
+        help='candidate links file (enqueue)',
+        default=os.path.join(INPUT_FOLDER, INPUT_FILE),
+    )
+    parser.add_argument('-o', '--output',
+        help='output data package folder (merge)',
+        default=OUTPUT_FOLDER,
+    )
+    parser.add_argument('-u', '--unit-size',
+        metavar='int', type=int,
+        help='municipalities per unit of work (enqueue)',
+        default=UNIT_SIZE,
+    )
+    parser.add_argument('-q', '--quantity',
+        metavar='int', type=int,
+        help='maximum quantity of municipalities to queue (enqueue)',
+        default=0,
+    )
+    parser.add_argument('-p', '--processes',
+        metavar='int', type=int,
+        help='number of processes (parallel downloads) to use (work)',
+        default=MAX_SIMULTANEOUS,
+    )
+    parser.add_argument('-l', '--lease',
+        metavar='seconds', type=float,
+        help=('time after which the unit of a worker that stopped renewing '
+            'its lease is given to another worker (work)'),
+        default=LEASE_TIME,
+    )
+    parser.add_argument('-w', '--wait',
+        help='keep waiting for units leased by other workers (work)',
+        action='store_true',
+    )
+    parser.add_argument('--warc',
+        metavar='folder', nargs='?', const=WARC_FOLDER,
+        help=('capture the responses in WARC files in this folder '
+            f'(work, default {WARC_FOLDER})'),
+        default=None,
+    )
+    parser.add_argument('--health-history',
+        metavar='folder',
+        help=('folder of the history of link health checks, to which the '
+            f'checks of all the units are added (merge, default '
+            f'{HEALTH_FOLDER}); empty for none'),
+        default=HEALTH_FOLDER,
+    )
+    parser.add_argument('--robots-cache',
+        metavar='path',
+        help=('SQLite file in which the robots.txt files of the sites are '
+            f'kept (work, default {ROBOTS_CACHE})'),
+        default=ROBOTS_CACHE,
+    )
+    args = parser.parse_args()
+    return {
+        'action': args.action,
+        'queue_path': args.queue,
+        'candidates_file': args.input,
+        'data_package_path': os.path.join(args.output, 'datapackage.json'),
+        'unit_size': args.unit_size,
+        'max_quantity': args.quantity,
+        'max_simultaneous': args.processes,
+        'lease_time': args.lease,
+        'wait': args.wait,
+        'robots_cache': args.robots_cache,
+        'warc_folder': args.warc,
+        'health_folder': args.health_history or None,
+    }
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_cli()
+    if options['action'] == 'enqueue':
+        enqueue(options['queue_path'], options['candidates_file'],
+            options['unit_size'], options['max_quantity'])
+    elif options['action'] == 'work':
+        work(options['queue_path'], options['max_simultaneous'],
+            options['wait'], options['lease_time'], options['robots_cache'],
+            options['warc_folder'])
+    elif options['action'] == 'status':
+        with WorkQueue(options['queue_path']) as status_queue:
+            print(status_queue.counts())
+    else:
+        table = merge(options['queue_path'], options['data_package_path'],
+            options['health_folder'])
+        store_csv(table, options['data_package_path'])
@@ -0,0 +1,287 @@
+"""
+Identifies the platform of a website or portal (e.g. the transparency
+portal products of the vendors that serve many municipalities, or open
+data platforms such as CKAN) from a page that has already been fetched:
+its response headers, generator meta tag, script and style sheet paths
+and url. No further requests are needed, so the verification and
+crawling scripts can classify the pages they fetch anyway.
+
+The signatures of each kind are compiled into a single regular
+expression, so each part of a page is searched once for all of them.
+
+Usage:
+  python fingerprint.py
+
+For instructions use:
+  python fingerprint.py --help
+
+Identifica a plataforma de um site ou portal a partir de uma página já
+obtida, sem requisições adicionais.
+"""
+
+import argparse
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+import pandas as pd
+import requests
+from frictionless import Package
+
+from crawling import warc
+from crawling.fetch import Page, fetch_page
+from crawling.politeness import HostScheduler
+
+DATA_PACKAGE_PATH = '../../data/valid/datapackage.json'
+PORTAL_RESOURCE_NAME = 'brazilian-transparency-and-open-data-portals'
+MAX_SIMULTANEOUS = 16
+KINDS = ['headers', 'generator', 'assets', 'url']
+
+class Fingerprint(NamedTuple):
+    """The platform identified for a page."""
+    platform: str
+    portal_type: Optional[str] # SPT, PTDAG or PEDAG; None if not a portal
+    evidence: List[str] # kinds of signature that matched
+
+# the patterns of each platform, by kind of signature: "headers" is
+# matched against "name: value" lines, "generator" against the content of
+# the generator meta tag, "assets" against script and style sheet urls
+# and "url" against the final url of the page; all lowercased
+SIGNATURES = [
+    {'platform': 'CKAN', 'portal_type': 'PEDAG',
+        'generator': r'\bckan\b', 'assets': r'/webassets/|/base/javascript/',
+        'url': r'/dataset(?:/|$)'},
+    {'platform': 'Socrata', 'portal_type': 'PEDAG',
+        'headers': r'^x-socrata-', 'assets': r'socrata'},
+    {'platform': 'OpenDataSoft', 'portal_type': 'PEDAG',
+        'assets': r'opendatasoft|/static/ods-', 'url': r'\.opendatasoft\.com'},
+    {'platform': 'DKAN', 'portal_type': 'PEDAG',
+        'assets': r'/dkan[_/]'},
+    {'platform': 'Betha', 'portal_type': 'SPT',
+        'assets': r'\bbetha\b', 'url': r'\.betha\.cloud|\bbetha\.com\.br'},
+    {'platform': 'IPM Atende.Net', 'portal_type': 'SPT',
+        'assets': r'atende\.net', 'url': r'\.atende\.net'},
+    {'platform': 'Fiorilli', 'portal_type': 'SPT',
+        'assets': r'fiorilli', 'url': r'fiorilli|/transparencia/(?:vertical|scpi)'},
+    {'platform': 'Elotech', 'portal_type': 'SPT',
+        'assets': r'elotech', 'url': r'elotech|/portaltransparencia/\d+'},
+    {'platform': 'Equiplano', 'portal_type': 'SPT',
+        'assets': r'equiplano', 'url': r'equiplano'},
+    {'platform': 'Assessor Público', 'portal_type': 'SPT',
+        'url': r'assessorpublico\.com\.br'},
+    {'platform': 'Portal Modelo', 'portal_type': None,
+        'generator': r'portal ?modelo', 'assets': r'portalmodelo'},
+    {'platform': 'Plone', 'portal_type': None,
+        'generator': r'\bplone\b', 'assets': r'\+\+resource\+\+|portal_javascripts'},
+    {'platform': 'WordPress', 'portal_type': None,
+        'generator': r'wordpress', 'assets': r'/wp-(?:content|includes)/'},
+    {'platform': 'Joomla', 'portal_type': None,
+        'generator': r'joomla', 'assets': r'/media/jui/|/components/com_'},
+    {'platform': 'Drupal', 'portal_type': None,
+        'headers': r'^x-drupal-|^x-generator: drupal', 'generator': r'drupal',
+        'assets': r'/sites/(?:default|all)/'},
+]
+
+re_generator = re.compile(
+    rb'<meta\s[^>]*name=["\']?generator["\']?[^>]*>', re.IGNORECASE)
+re_content = re.compile(rb'content=["\']([^"\']*)', re.IGNORECASE)
+re_asset = re.compile(
+    rb'<(?:script|link)\s[^>]*(?:src|href)=["\']([^"\']+)', re.IGNORECASE)
+
+def compile_signatures(signatures: List[dict]) -> Dict[str, re.Pattern]:
+    """Compiles the patterns of each kind of all the signatures into a
+    single regular expression with a named group per signature.
+
+    Args:
+        signatures (List[dict]): The signatures.
+
+    Returns:
+        Dict[str, re.Pattern]: The compiled expression of each kind.
+    """
+    return {
+        kind: re.compile('|'.join(
+            f'(?P<s{position}>{signature[kind]})'
+            for position, signature in enumerate(signatures)
+            if kind in signature
+        ), re.MULTILINE)
+        for kind in KINDS
+    }
+
+COMPILED_SIGNATURES = compile_signatures(SIGNATURES)
+
+def page_parts(url: str, headers: dict, content: bytes) -> Dict[str, str]:
+    """Extracts from a page the text that each kind of signature is
+    matched against.
+
+    Args:
+        url (str): The final url of the page.
+        headers (dict): The response headers.
+        content (bytes): The HTML of the page.
+
+    Returns:
+        Dict[str, str]: The lowercased text of each kind.
+    """
+    generators = [
+        match.group(1).decode('utf-8', 'replace')
+        for tag in re_generator.findall(content)
+        for match in [re_content.search(tag)] if match
+    ]
+    assets = [asset.decode('utf-8', 'replace')
+        for asset in re_asset.findall(content)]
+    return {
+        'headers': '\n'.join(f'{name}: {value}'
+            for name, value in headers.items()).lower(),
+        'generator': '\n'.join(generators).lower(),
+        'assets': '\n'.join(assets).lower(),
+        'url': (url or '').lower(),
+    }
+
+def identify(url: str, headers: dict, content: bytes) -> Optional[Fingerprint]:
+    """Identifies the platform of a page.
+
+    Args:
+        url (str): The final url of the page.
+        headers (dict): The response headers.
+        content (bytes): The HTML of the page.
+
+    Returns:
+        Fingerprint: The platform whose signatures matched the most kinds
+            of evidence (the first one listed, in case of a tie), or None
+            if no signature matched.
+    """
+    parts = page_parts(url, headers, content)
+    evidence: Dict[int, List[str]] = {}
+    for kind, expression in COMPILED_SIGNATURES.items():
+        if not expression.pattern or not parts[kind]:
+            continue
+        for match in expression.finditer(parts[kind]):
+            kinds = evidence.setdefault(int(match.lastgroup[1:]), [])
+            if kind not in kinds:
+                kinds.append(kind)
+    if not evidence:
+        return None
+    position = min(evidence, key=lambda position: (-len(evidence[position]), position))
+    signature = SIGNATURES[position]
+    return Fingerprint(
+        signature['platform'], signature['portal_type'], evidence[position])
+
+def identify_page(page: Page) -> Optional[Fingerprint]:
+    """Identifies the platform of a page fetched by the crawler.
+
+    Args:
+        page (Page): The page.
+
+    Returns:
+        Fingerprint: The platform, or None if not identified.
+    """
+    return identify(page.final_url, page.headers, page.content)
+
+def identify_response(response: requests.Response) -> Optional[Fingerprint]:
+    """Identifies the platform of a page fetched with requests.
+
+    Args:
+        response (requests.Response): The response.
+
+    Returns:
+        Fingerprint: The platform, or None if not identified.
+    """
+    return identify(response.url, response.headers, response.content)
+
+def identify_all(pages: Iterable[Page]) -> pd.DataFrame:
+    """Identifies the platforms of a batch of pages.
+
+    Args:
+        pages (Iterable[Page]): The pages.
+
+    Returns:
+        pd.DataFrame: The url, final_url, platform, portal_type and
+            evidence of each page.
+    """
+    rows = []
+    for page in pages:
+        fingerprint = identify_page(page)
+        rows.append({
+            'url': page.url,
+            'final_url': page.final_url,
+            'platform': fingerprint.platform if fingerprint else None,
+            'portal_type': fingerprint.portal_type if fingerprint else None,
+            'evidence': ' '.join(fingerprint.evidence) if fingerprint else None,
+        })
+    return pd.DataFrame(rows,
+        columns=['url', 'final_url', 'platform', 'portal_type', 'evidence'])
+
+def classify_portals(data_package_path: str = DATA_PACKAGE_PATH,
+    max_simultaneous: int = MAX_SIMULTANEOUS) -> pd.DataFrame:
+    """Fetches the home page of every portal in the portals resource and
+    identifies its platform.
+
+    Args:
+        data_package_path (str): Path to the valid data package.
+        max_simultaneous (int): Maximum number of simultaneous requests.
+
+    Returns:
+        pd.DataFrame: The url, recorded type, platform and detected type
+            of each portal.
+    """
+    package = Package(data_package_path)
+    portals = package.get_resource(PORTAL_RESOURCE_NAME).to_pandas()
+    if any(portals.index.names):
+        portals = portals.reset_index()
+    scheduler = HostScheduler()
+    urls = portals.url.dropna().unique().tolist()
+    with ThreadPoolExecutor(max_workers=max_simultaneous) as executor:
+        pages = [page for page in executor.map(
+            lambda url: fetch_page(url, scheduler), urls) if page]
+    logging.info('Fetched %d of %d portals.', len(pages), len(urls))
+    return (
+        portals[['url', 'type']]
+        .merge(identify_all(pages), on='url', how='left')
+        .rename(columns={'portal_type': 'detected_type'})
+    )
+
+def parse_cli() -> dict:
+    """Parses the command line interface.
+
+    Returns:
+        dict: A dict containing the values for data_package_path,
+            max_simultaneous and replay.
+    """
+    parser = argparse.ArgumentParser(
+        description='Identifies the platform and type of the portals in '
+            'the portals resource.')
+    parser.add_argument('data_package',
+        help='path to the valid data package',
+        default=DATA_PACKAGE_PATH,
+        nargs='?',
+    )
+    parser.add_argument('-p', '--processes',
+        metavar='int', type=int,
+        help='number of simultaneous requests',
+        default=MAX_SIMULTANEOUS,
+    )
+    parser.add_argument('--replay',
+        metavar='path', nargs='+',
+        help=('identify the pages captured in these WARC files or folders, '
+            'without network access'),
+        default=None,
+    )
+    args = parser.parse_args()
+    return {
+        'data_package_path': args.data_package,
+        'max_simultaneous': args.processes,
+        'replay': args.replay,
+    }
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_cli()
+    replay = options.pop('replay')
+    if replay:
+        warc.configure(archive=warc.WarcArchive(replay))
+    report = classify_portals(**options)
+    print(report.to_csv(index=False))
+    disagreements = report[report.detected_type.notna() &
+        (report.detected_type != report.type)]
+    logging.info('%d portals identified, %d with a type different from '
+        'the one recorded.', report.platform.notna().sum(), len(disagreements))
@@ -3,20 +3,24 @@ This script opens candidate URLs for municipalities websites in the
 web browser and asks the user to check whether or not they seem to be the
 official city hall or city council portals.
 
+With --batch, the candidate links are fetched beforehand, in parallel,
+and reviewed all together on a local page instead (see batch_review.py).
+
 Usage:
-  python manually_verify_links.py
+  python manually_verify_links.py [--batch]
 
 For instructions use:
   python manually_verify_links.py --help
 
 Este script abre no navegador as URLs candidatas a sites dos municípios e
 pede ao utilizador que verifique se elas parecem ser os portais das
-prefeituras e câmaras municipais.
+prefeituras e câmaras municipais. Com --batch, os links são revistos em
+lote numa página local.
 """
 
 import os
 import argparse
-from datetime import datetime
+from datetime import datetime, timezone
 import logging
 import random
 import webbrowser
@@ -25,18 +29,26 @@ import pandas as pd
 
 from validation.verify_links import (healthy_link, get_title_and_type,
     get_candidate_links, get_output_to_be_merged, store_csv)
+from validation.fingerprint import identify_response
+from validation import batch_review
+from crawling import robots
+from storage.catalogue import Catalogue
 
 INPUT_FOLDER = '../../data/unverified'
 INPUT_FILE = 'municipality-website-candidate-links.csv'
 OUTPUT_FOLDER = '../../data/valid'
 MAX_QUANTITY = 0
+MAX_SIMULTANEOUS = 10
+ROBOTS_CACHE = '../../data/download-cache/robots.sqlite'
+CHANGED_COLUMNS = ['sphere', 'branch', 'url', 'last-verified-manual']
 
 def parse_cli() -> dict:
     """Parses the command line interface.
 
     Returns:
         dict: A dict containing the values for input_folder, input_file,
-            data_package_path, max_quantity, max_simultaneous
+            data_package_path, max_quantity, database, batch,
+            max_simultaneous, port and robots_cache
     """
     parser = argparse.ArgumentParser(
         description='''Opens in a web browser candidate URLs for municipalities
@@ -67,6 +79,36 @@ def parse_cli() -> dict:
         help='maximum quantity of cities to process / quantidade máxima a processar',
         default=0,
         )
+    parser.add_argument('-d', '--database',
+        help=('SQLite catalogue to record results in / '
+            'catálogo SQLite onde registrar os resultados'),
+        default=None,
+        )
+    parser.add_argument('-b', '--batch',
+        action='store_true',
+        help=('fetch the links beforehand and review them all on a local page / '
+            'acessar os links antes e revisá-los todos numa página local'),
+        )
+    parser.add_argument('-p', '--processes',
+        metavar='int', type=int,
+        help=('number of processes to fetch the links with in batch mode / '
+            'número de processos para acessar os links no modo em lote'),
+        default=MAX_SIMULTANEOUS,
+        )
+    parser.add_argument('--port',
+        metavar='int', type=int,
+        help=('port of the review page in batch mode (default any free port) / '
+            'porta da página de revisão no modo em lote'),
+        default=batch_review.PORT,
+        )
+    parser.add_argument('--robots-cache',
+        metavar='path',
+        help=('SQLite file in which the robots.txt files of the sites are '
+            f'kept and shared with other processes (default {ROBOTS_CACHE}) / '
+            'arquivo SQLite onde os arquivos robots.txt dos sites são '
+            'guardados e compartilhados com outros processos'),
+        default=ROBOTS_CACHE,
+        )
     params = {}
     args = parser.parse_args()
     if args.input:
@@ -89,6 +131,11 @@ def parse_cli() -> dict:
         params['max_quantity'] = args.quantity
     else: # use default value
         params['max_quantity'] = MAX_QUANTITY
+    params['database'] = args.database
+    params['batch'] = args.batch
+    params['max_simultaneous'] = args.processes
+    params['port'] = args.port
+    params['robots_cache'] = args.robots_cache
 
     return params
 
@@ -129,6 +176,11 @@ def verify_city_links(candidates, code):
             )
             print(f'  Title is: {title}.')
             print(f'  Most likely site type is: {link_type}')
+            fingerprint = identify_response(working_link)
+            if fingerprint:
+                print(f'  Platform is: {fingerprint.platform}'
+                    + (f' ({fingerprint.portal_type} portal)'
+                        if fingerprint.portal_type else ''))
             if link_type == 'prefeitura':
                 branch = 'executive'
             elif link_type == 'camara':
@@ -174,45 +226,69 @@ def verify_city_links(candidates, code):
                 'sphere': 'municipal',
                 'branch': branch,
                 'url': working_link.url, # update if redirected
-                'last-verified-manual': datetime.utcnow()
+                'last-verified-manual': datetime.now(timezone.utc)
+                    .replace(microsecond=0)
             }
             verified_links.append(verified_link)
         else:
             print('  Error opening URL.')
     return signal, verified_links
 
-def manual_verify(input_folder: str, input_file: str, data_package_path: str,
-        max_quantity: int) -> pd.DataFrame:
-    """Manually verifies links by opening each one of them on the browser
-    for the user to check. Then asks the user to classify the link type.
+def batch_verify(candidates: pd.DataFrame, max_simultaneous: int,
+    port: int = batch_review.PORT, robots_cache: str = ROBOTS_CACHE) -> list:
+    """Verifies links in batch: fetches all of them beforehand, serves
+    them on a local page for the user to review together and waits for
+    the decisions.
 
-    A Python function that does the same job as the script that is run
-    from the command line.
+    Args:
+        candidates (pd.DataFrame): The candidate links.
+        max_simultaneous (int): Number of processes to fetch the links
+            with.
+        port (int): Port of the review page, or 0 for any free port.
+        robots_cache (str): Path to the SQLite file in which the
+            robots.txt files are shared by the processes.
+
+    Returns:
+        list: The verified links.
+    """
+    links = batch_review.prefetch(candidates, max_simultaneous, robots_cache)
+    decisions = batch_review.review(links, port=port)
+    if decisions is None:
+        print('Review interrupted, nothing to record.')
+        return []
+    results = batch_review.decided_links(links, decisions)
+    print(f'Received {len(decisions)} decisions on {len(links)} links, '
+        f'{len(results)} verified links to record.')
+    return results
+
+def merge_results(results: list, data_package_path: str,
+    database: str = None) -> pd.DataFrame:
+    """Merges the manually verified links into the websites table, all at
+    once.
 
     Args:
-        input_folder (str): The folder containing the input table.
-        input_file (str): Name of the file containing the input table in
-            csv format.
+        results (list): The verified links.
         data_package_path (str): Path to the datapackage.json file.
-        max_quantity (int): Maximum quantity of links to check.
+        database (str): Optional path to a SQLite catalogue to record the
+            results in.
 
     Returns:
         pd.DataFrame: Pandas dataframe containing the verified links.
     """
-    candidates = get_candidate_links(
-        file_path=os.path.join(input_folder, input_file),
-        max_quantity=max_quantity)
-    codes = candidates.code.unique()
-    random.shuffle(codes)
-
-    results = []
-    print(f'Verifying candidate URLs for {max_quantity} cities...')
-    for code in codes:
-        signal, links_to_add = verify_city_links(candidates[candidates.code == code], code)
-        if signal == 'q':
-            print('Quitting...')
-            break
-        results.extend(links_to_add)
+    if database:
+        with Catalogue(database) as catalogue:
+            if not catalogue.has_table('websites'):
+                catalogue.import_package(data_package_path)
+            print('Updating values...')
+            for result in results:
+                action = catalogue.upsert('websites', result,
+                    key=['municipality_code', 'branch'],
+                    update_columns=CHANGED_COLUMNS)
+                print(f'{action.capitalize()} {result}.')
+            catalogue.deduplicate('websites', 'url')
+            table = catalogue.read_table('websites')
+        table['municipality_code'] = table['municipality_code'].astype('Int64')
+        return table.sort_values(by=['state_code', 'municipality'])
 
     # read resource to be updated
     table = get_output_to_be_merged(data_package_path)
@@ -227,7 +303,7 @@ def manual_verify(input_folder: str, input_file: str, data_package_path: str,
         if len(existing_data) > 0:
             index = existing_data.index[0]
             row = existing_data.iloc[0].copy()
-            for key in ['sphere', 'branch', 'url', 'last-verified-manual']:
+            for key in CHANGED_COLUMNS:
                 row[key] = result[key] # update only the new values
             print(f'Updating {index} with {row}...')
             table.loc[index] = row
@@ -243,6 +319,60 @@ def manual_verify(input_folder: str, input_file: str, data_package_path: str,
     table.sort_values(by=['state_code', 'municipality'], inplace=True)
     return table
 
+def manual_verify(input_folder: str, input_file: str, data_package_path: str,
+        max_quantity: int, database: str = None, batch: bool = False,
+        max_simultaneous: int = MAX_SIMULTANEOUS,
+        port: int = batch_review.PORT,
+        robots_cache: str = ROBOTS_CACHE) -> pd.DataFrame:
+    """Manually verifies links by opening each one of them on the browser
+    for the user to check. Then asks the user to classify the link type.
+    In batch mode, the links are reviewed all together on a local page.
+
+    A Python function that does the same job as the script that is run
+    from the command line.
+
+    Args:
+        input_folder (str): The folder containing the input table.
+        input_file (str): Name of the file containing the input table in
+            csv format.
+        data_package_path (str): Path to the datapackage.json file.
+        max_quantity (int): Maximum quantity of links to check.
+        database (str): Optional path to a SQLite catalogue to record the
+            results in.
+        batch (bool): Whether to review the links in batch.
+        max_simultaneous (int): Number of processes to fetch the links
+            with in batch mode.
+        port (int): Port of the review page in batch mode.
+        robots_cache (str): Path to the SQLite file in which the
+            robots.txt files are kept and shared with other tools.
+
+    Returns:
+        pd.DataFrame: Pandas dataframe containing the verified links.
+    """
+    candidates = get_candidate_links(
+        file_path=os.path.join(input_folder, input_file),
+        max_quantity=max_quantity)
+
+    if batch:
+        results = batch_verify(candidates, max_simultaneous, port,
+            robots_cache)
+        return merge_results(results, data_package_path, database)
+
+    robots.configure(robots.RobotsCache(robots_cache))
+    codes = candidates.code.unique().tolist()
+    random.shuffle(codes)
+
+    results = []
+    print(f'Verifying candidate URLs for {max_quantity} cities...')
+    for code in codes:
+        signal, links_to_add = verify_city_links(candidates[candidates.code == code], code)
+        if signal == 'q':
+            print('Quitting...')
+            break
+        results.extend(links_to_add)
+
+    return merge_results(results, data_package_path, database)
+
 if __name__ == '__main__':
     logging.getLogger().setLevel(logging.INFO)
     options = parse_cli()
@@ -0,0 +1,188 @@
+"""
+This script combines the partial outputs written by
+`auto_verify_links.py --partial`, e.g. by runs on several machines each
+verifying a shard or some states, into the websites resource.
+
+The result does not depend on the order the shards finished in: the
+partial outputs are read in the order of their file names and the rows
+are sorted before being merged. Within a partial output, only the link
+verified last for each municipality and branch is merged, as in a single
+run. A municipality and branch for which different partial outputs
+disagree on the url, or that matches several existing rows, is a
+conflict: it is left out of the merge and written to a
+conflicts file for review. Links to parked pages or to pages shared by
+several municipalities, in any of the partial outputs, are stored in the
+review file instead of being merged (see similarity.py).
+
+Usage:
+  python merge_shards.py
+
+For instructions use:
+  python merge_shards.py --help
+
+Este script combina as saídas parciais da verificação automática,
+feitas por partes, no recurso de sites dos municípios, detectando
+conflitos entre elas.
+"""
+
+import argparse
+import glob
+import logging
+import os
+from typing import List, Optional
+
+import pandas as pd
+
+from storage.upsert import upsert
+from storage.writer import write_csv
+from validation.auto_verify_links import (OUTPUT_FOLDER, SHARD_FOLDER,
+    CHANGED_COLUMNS, REVIEW_FILE, store_for_review)
+from validation.similarity import split_for_review
+from validation.verify_links import get_output_to_be_merged, store_csv
+
+KEY_COLUMNS = ['municipality_code', 'branch']
+SORT_COLUMNS = ['sphere', 'state_code', 'municipality', 'branch']
+CONFLICTS_FILE = 'conflicts.csv'
+
+def read_shards(paths: List[str]) -> pd.DataFrame:
+    """Reads the partial outputs and combines them in a deterministic
+    order. When the same link was verified in more than one of them,
+    only its latest verification is kept.
+
+    Args:
+        paths (List[str]): Paths to the partial output files.
+
+    Returns:
+        pd.DataFrame: The verified links, with a shard column telling
+            the file each came from.
+    """
+    tables = []
+    for path in sorted(paths):
+        table = pd.read_csv(path, dtype={'municipality_code': 'Int64',
+            'simhash': 'string', 'template': 'string'})
+        logging.info('Read %d verified links from "%s".', len(table), path)
+        tables.append(table.assign(shard=os.path.basename(path)))
+    if not tables:
+        return pd.DataFrame(columns=KEY_COLUMNS + ['url', 'shard'])
+    new_links = pd.concat(tables, ignore_index=True)
+    new_links['last-verified-auto'] = pd.to_datetime(
+        new_links['last-verified-auto'], utc=True)
+    return (
+        new_links
+        .sort_values(KEY_COLUMNS + ['url', 'last-verified-auto', 'shard'],
+            kind='mergesort')
+        .drop_duplicates(subset=KEY_COLUMNS + ['url'], keep='last')
+        .reset_index(drop=True)
+    )
+
+def latest_in_shards(new_links: pd.DataFrame) -> pd.DataFrame:
+    """Keeps, for each municipality and branch, only the link verified
+    last in each partial output, as merge_verified_links does for the
+    links of a single run. Links verified at the same time are taken in
+    the order of the partial output.
+
+    Args:
+        new_links (pd.DataFrame): The verified links, as returned by
+            read_shards.
+
+    Returns:
+        pd.DataFrame: The links kept, in the same order.
+    """
+    return (
+        new_links
+        .sort_values(['shard', 'last-verified-auto'], kind='mergesort')
+        .drop_duplicates(subset=['shard'] + KEY_COLUMNS, keep='last')
+        .sort_index()
+    )
+
+def merge_shards(paths: List[str], data_package_path: str,
+    conflicts_path: Optional[str] = None,
+    review_path: str = REVIEW_FILE) -> pd.DataFrame:
+    """Merges the partial outputs into the websites table.
+
+    Args:
+        paths (List[str]): Paths to the partial output files.
+        data_package_path (str): Path to the datapackage.json file.
+        conflicts_path (str): Optional path to write the conflicting
+            rows to. If there are none, an existing file is removed.
+        review_path (str): Path to the review file.
+
+    Returns:
+        pd.DataFrame: The updated websites table.
+    """
+    new_links, review = split_for_review(read_shards(paths))
+    store_for_review(review, review_path)
+    new_links = latest_in_shards(new_links)
+    new_links = new_links.reset_index(drop=True) # as numbered by upsert
+    table = get_output_to_be_merged(data_package_path)
+    result = upsert(table,
+        new_links[KEY_COLUMNS + [column for column in CHANGED_COLUMNS
+            if column not in KEY_COLUMNS] + ['state_code', 'municipality']],
+        key=KEY_COLUMNS)
+    logging.info('Merged %d shards: %d rows updated, %d inserted, '
+        '%d conflicts.', len(paths), result.updated, result.inserted,
+        len(result.conflicts))
+    if conflicts_path:
+        if len(result.conflicts):
+            # keys are only repeated across shards by now
+            conflicts = new_links.loc[result.conflicts.index] \
+                .assign(reason=result.conflicts.reason.replace(
+                    'key repeated in new data', 'shards disagree on the url'))
+            write_csv(conflicts, conflicts_path,
+                sort_by=KEY_COLUMNS + ['shard', 'url'])
+        elif os.path.exists(conflicts_path):
+            os.remove(conflicts_path)
+
+    table = result.table
+    table['municipality_code'] = table['municipality_code'].astype('Int64')
+    table['last-verified-auto'] = pd.to_datetime(
+        table['last-verified-auto'], utc=True)
+    # as in auto_verify_links, the same url is kept only once, in the
+    # row verified last
+    table = table.drop_duplicates(subset='url', keep='last')
+    return table.sort_values(by=SORT_COLUMNS, kind='mergesort')
+
+def parse_cli() -> dict:
+    """Parses the command line interface.
+
+    Returns:
+        dict: A dict containing the values for paths, data_package_path
+            and conflicts_path.
+    """
+    parser = argparse.ArgumentParser(
+        description='Combines the partial outputs of auto_verify_links.py '
+            'into the websites resource.')
+    parser.add_argument('shards',
+        help=f'partial output files (default: all the CSV files in {SHARD_FOLDER})',
+        nargs='*',
+    )
+    parser.add_argument('-o', '--output',
+        help=('output folder for the CSV '
+            '(must have a datapackage.json with a schema)'),
+        default=OUTPUT_FOLDER,
+    )
+    parser.add_argument('-c', '--conflicts',
+        help='file to write the conflicting rows to',
+        default=os.path.join(SHARD_FOLDER, CONFLICTS_FILE),
+    )
+    args = parser.parse_args()
+    paths = args.shards or [path
+        for path in glob.glob(os.path.join(SHARD_FOLDER, '*.csv'))
+        if os.path.basename(path) != CONFLICTS_FILE]
+    if not paths:
+        raise FileNotFoundError('No partial outputs to merge.')
+    data_package_path = os.path.join(args.output, 'datapackage.json')
+    if not os.path.exists(data_package_path):
+        raise FileNotFoundError(
+            f'datapackage.json not found in folder: {args.output}')
+    return {
+        'paths': paths,
+        'data_package_path': data_package_path,
+        'conflicts_path': args.conflicts,
+    }
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_cli()
+    table = merge_shards(**options)
+    store_csv(table, options['data_package_path'])
@@ -0,0 +1,320 @@
+"""
+This script checks whether the open data portals in the portals resource
+expose a catalogue API (CKAN, DKAN or Socrata), how many datasets they
+list and how fast the API answers, and records the results in the api,
+datasets, api-response-time and last-verified-api columns.
+
+All portals are probed concurrently, sharing a pool of connections, and
+the results are cached for some days, so the script can be run again
+without probing the portals already checked.
+
+Usage:
+  python opendata_api.py
+
+For instructions use:
+  python opendata_api.py --help
+
+Este script verifica se os portais de dados abertos oferecem uma API de
+catálogo (CKAN, DKAN ou Socrata), quantos conjuntos de dados listam e
+quanto tempo a API leva para responder.
+"""
+
+import argparse
+import json
+import logging
+import os
+import pathlib
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import List, Optional
+
+import pandas as pd
+import requests
+from frictionless import Package
+from tqdm import tqdm
+
+from settings import USER_AGENT, DEFAULT_TIMEOUT
+from storage.writer import format_datetime, write_resource
+
+DATA_PACKAGE_PATH = '../../data/valid/datapackage.json'
+PORTAL_RESOURCE_NAME = 'brazilian-transparency-and-open-data-portals'
+CACHE_FILE = '../../data/download-cache/opendata-api.json'
+OPEN_DATA_TYPES = ['PEDAG', 'PTDAG']
+API_COLUMNS = ['api', 'datasets', 'api-response-time', 'last-verified-api']
+MAX_SIMULTANEOUS = 16
+MAX_AGE = 7 # days
+
+# the request that tells whether a catalogue API answers and the request
+# that lists its datasets, relative to the base url of the catalogue
+ENDPOINTS = [
+    ('ckan', 'api/3/action/status_show', 'api/3/action/package_list'),
+    ('dkan', 'api/1/metastore', 'api/1/metastore/schemas/dataset/items'),
+    ('socrata', 'api/views/metadata/v1?limit=1', 'api/views/metadata/v1'),
+]
+
+def new_session(pool_size: int = MAX_SIMULTANEOUS) -> requests.Session:
+    """Creates a session whose pool keeps a connection for each thread.
+
+    Args:
+        pool_size (int): Maximum number of connections per host and of
+            hosts to keep connections to.
+
+    Returns:
+        requests.Session: The session.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({
+        'user-agent': USER_AGENT,
+        'accept': 'application/json',
+    })
+    return session
+
+def base_urls(url: str) -> List[str]:
+    """Gets the urls where a catalogue API could be, relative to a portal
+    url: the url itself and the root of its site.
+
+    Args:
+        url (str): The url of the portal.
+
+    Returns:
+        List[str]: The base urls, ending with a slash.
+    """
+    parts = urllib.parse.urlsplit(url)
+    root = f'{parts.scheme}://{parts.netloc}/'
+    path_url = f'{root}{parts.path.strip("/")}/' if parts.path.strip('/') \
+        else root
+    return list(dict.fromkeys([path_url, root]))
+
+def get_json(session: requests.Session, url: str,
+    timeout: float = DEFAULT_TIMEOUT) -> Optional[object]:
+    """Gets a JSON document.
+
+    Returns:
+        The decoded document, or None if the request failed or the
+        response is not JSON.
+    """
+    try:
+        response = session.get(url, timeout=timeout)
+        if response.status_code != 200:
+            return None
+        return response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+
+def count_datasets(api: str, document: object) -> Optional[int]:
+    """Counts the datasets in the response to a dataset list request.
+
+    Args:
+        api (str): The kind of API.
+        document (object): The decoded response.
+
+    Returns:
+        int: The number of datasets, or None if the response is not
+            in the expected format.
+    """
+    if api == 'ckan' and isinstance(document, dict):
+        result = document.get('result')
+        return len(result) if isinstance(result, list) else None
+    if isinstance(document, list):
+        return len(document)
+    return None
+
+def probe_portal(url: str, session: requests.Session,
+    timeout: float = DEFAULT_TIMEOUT) -> dict:
+    """Tries the known catalogue API endpoints of a portal.
+
+    Args:
+        url (str): The url of the portal.
+        session (requests.Session): The session to use.
+        timeout (float): Timeout of each request, in seconds.
+
+    Returns:
+        dict: The url and the values of the API columns. api is "none"
+            if no API answered.
+    """
+    checked = format_datetime(
+        datetime.now(timezone.utc).replace(microsecond=0))
+    for base in base_urls(url):
+        for api, status_path, list_path in ENDPOINTS:
+            start = time.monotonic()
+            status = get_json(session, urllib.parse.urljoin(base, status_path),
+                timeout)
+            elapsed = time.monotonic() - start
+            if status is None or (api == 'ckan' and (
+                    not isinstance(status, dict) or not status.get('success'))):
+                continue
+            datasets = count_datasets(api, get_json(
+                session, urllib.parse.urljoin(base, list_path), timeout))
+            if api != 'ckan' and datasets is None:
+                continue # answered, but not as this kind of API
+            return {
+                'url': url,
+                'api': api,
+                'datasets': datasets,
+                'api-response-time': round(elapsed, 3),
+                'last-verified-api': checked,
+            }
+    return {'url': url, 'api': 'none', 'datasets': None,
+        'api-response-time': None, 'last-verified-api': checked}
+
+def load_cache(cache_file: str) -> dict:
+    """Loads the cache file.
+
+    Args:
+        cache_file (str): Path to the cache file.
+
+    Returns:
+        dict: The time and result of each portal probed, by url.
+    """
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def read_cache(cache_file: str, max_age: float) -> dict:
+    """Reads the cached results that are not older than max_age days.
+
+    Args:
+        cache_file (str): Path to the cache file.
+        max_age (float): Maximum age of the results, in days.
+
+    Returns:
+        dict: The cached results, by portal url.
+    """
+    oldest = time.time() - max_age * 86400
+    return {url: entry['result'] for url, entry in load_cache(cache_file).items()
+        if entry['time'] >= oldest}
+
+def write_cache(cache_file: str, results: List[dict]):
+    """Adds the results to the cache file, atomically.
+
+    Args:
+        cache_file (str): Path to the cache file.
+        results (List[dict]): The new results.
+    """
+    pathlib.Path(os.path.dirname(cache_file)).mkdir(parents=True, exist_ok=True)
+    cache = load_cache(cache_file)
+    now = time.time()
+    cache.update({result['url']: {'time': now, 'result': result}
+        for result in results})
+    temporary = cache_file + '.part'
+    with open(temporary, 'w', encoding='utf-8') as file:
+        json.dump(cache, file)
+    os.replace(temporary, cache_file)
+
+def probe_portals(urls: List[str], max_simultaneous: int = MAX_SIMULTANEOUS,
+    cache_file: Optional[str] = CACHE_FILE, max_age: float = MAX_AGE) \
+        -> pd.DataFrame:
+    """Probes the catalogue APIs of many portals concurrently.
+
+    Args:
+        urls (List[str]): The urls of the portals.
+        max_simultaneous (int): Maximum number of simultaneous requests.
+        cache_file (str): Path to the cache file, or None to probe all
+            the portals.
+        max_age (float): Maximum age of cached results, in days.
+
+    Returns:
+        pd.DataFrame: The url and API columns of each portal.
+    """
+    urls = list(dict.fromkeys(urls))
+    cached = read_cache(cache_file, max_age) if cache_file else {}
+    pending = [url for url in urls if url not in cached]
+    logging.info('Probing %d portals, %d cached.',
+        len(pending), len(urls) - len(pending))
+    session = new_session(max_simultaneous)
+    with ThreadPoolExecutor(max_workers=max_simultaneous) as executor:
+        results = list(tqdm(
+            executor.map(lambda url: probe_portal(url, session), pending),
+            total=len(pending)))
+    if cache_file and results:
+        write_cache(cache_file, results)
+    return pd.DataFrame(
+        [cached[url] for url in urls if url in cached] + results,
+        columns=['url'] + API_COLUMNS)
+
+def update_portals(data_package_path: str = DATA_PACKAGE_PATH,
+    all_portals: bool = False, max_simultaneous: int = MAX_SIMULTANEOUS,
+    cache_file: Optional[str] = CACHE_FILE, max_age: float = MAX_AGE):
+    """Probes the portals of the portals resource and records the results
+    in its API columns. The columns of the portals probed are replaced
+    by the new results, even where these are missing, while the other
+    portals keep theirs.
+
+    Args:
+        data_package_path (str): Path to the valid data package.
+        all_portals (bool): Whether to probe all portals, not only the
+            open data ones.
+        max_simultaneous (int): Maximum number of simultaneous requests.
+        cache_file (str): Path to the cache file, or None to probe all
+            the portals.
+        max_age (float): Maximum age of cached results, in days.
+
+    Returns:
+        WriteResult: What was done to the CSV file.
+    """
+    package = Package(data_package_path)
+    portals = package.get_resource(PORTAL_RESOURCE_NAME).to_pandas()
+    if any(portals.index.names):
+        portals = portals.reset_index()
+    selected = portals if all_portals else \
+        portals[portals.type.isin(OPEN_DATA_TYPES)]
+    results = probe_portals(selected.url.dropna().tolist(), max_simultaneous,
+        cache_file, max_age).set_index('url')
+    probed = portals.url.isin(results.index)
+    for column in API_COLUMNS:
+        portals[column] = portals.url.map(results[column]) \
+            .where(probed, portals[column])
+    found = results[results.api != 'none']
+    logging.info('Found %d APIs in %d portals, listing %d datasets.',
+        len(found), len(results), found.datasets.fillna(0).sum())
+    return write_resource(portals, data_package_path, PORTAL_RESOURCE_NAME)
+
+def parse_cli() -> dict:
+    """Parses the command line interface.
+
+    Returns:
+        dict: A dict containing the values for data_package_path,
+            all_portals, max_simultaneous, cache_file and max_age.
+    """
+    parser = argparse.ArgumentParser(
+        description='Checks the open data catalogue APIs of the portals.')
+    parser.add_argument('data_package',
+        help='path to the valid data package',
+        default=DATA_PACKAGE_PATH,
+        nargs='?',
+    )
+    parser.add_argument('-a', '--all',
+        help='probe all portals, not only the open data ones',
+        action='store_true',
+    )
+    parser.add_argument('-p', '--processes',
+        metavar='int', type=int,
+        help='number of simultaneous requests',
+        default=MAX_SIMULTANEOUS,
+    )
+    parser.add_argument('--max-age',
+        metavar='days', type=float,
+        help='reuse cached results up to this many days old (0 to refresh)',
+        default=MAX_AGE,
+    )
+    args = parser.parse_args()
+    return {
+        'data_package_path': args.data_package,
+        'all_portals': args.all,
+        'max_simultaneous': args.processes,
+        'cache_file': CACHE_FILE,
+        'max_age': args.max_age,
+    }
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_cli()
+    update_portals(**options)
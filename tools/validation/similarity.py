@@ -0,0 +1,381 @@
+"""
+Finds verified links whose pages should not be counted as municipality
+websites: parked domains and spam left after a domain expired, which
+still answer with status 200, and pages shared by several municipalities,
+such as a vendor landing page they all redirect to.
+
+The text of each page is reduced to a 64 bit SimHash of its word
+shingles, so that near identical pages have hashes that differ in only a
+few bits. The hashes are indexed by bands (locality sensitive hashing):
+two hashes within MAX_DISTANCE bits of each other share at least one
+band exactly, so each page is only compared to the few pages in its
+buckets, and a whole crawl is clustered in roughly linear time. The text
+is also matched against the templates of parking and spam pages. The
+keywords of spam, which a news page of the municipality may also
+mention, only count if they are frequent in the page.
+
+Usage:
+  python similarity.py
+
+For instructions use:
+  python similarity.py --help
+
+Encontra links verificados cujas páginas não devem ser contadas como
+sites de municípios: domínios estacionados, spam e páginas compartilhadas
+por vários municípios.
+"""
+
+import argparse
+import hashlib
+import html
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import requests
+from unidecode import unidecode
+
+from crawling.charset import decode, decode_response
+from crawling.fetch import fetch_page
+from crawling.politeness import HostScheduler
+from validation.verify_links import get_output_to_be_merged
+
+DATA_PACKAGE_PATH = '../../data/valid/datapackage.json'
+MAX_DISTANCE = 3 # bits, out of 64, for pages to be near duplicates
+MIN_WORDS = 30 # pages with less text are not compared
+MAX_WORDS = 5000 # only the beginning of long pages is compared
+SHINGLE_SIZE = 3 # words
+MIN_MUNICIPALITIES = 2 # a cluster is suspicious if shared by this many
+MAX_SIMULTANEOUS = 16
+SIMILARITY_COLUMNS = ['simhash', 'template']
+
+# templates of pages that are not municipality websites, matched against
+# the lowercased text of the page without accents
+PARKING_TEMPLATES = [
+    ('domain for sale', r'this domain (?:is|may be) for sale|buy this domain'
+        r'|domain (?:name )?(?:is )?parked|sedo ?parking|parkingcrew|bodis\.com'
+        r'|afternic|hugedomains|dan\.com'),
+    ('domínio à venda', r'(?:este|esse) dominio (?:esta|pode estar) a venda'
+        r'|dominio a venda|compre (?:este|esse) dominio'),
+    ('domínio expirado', r'dominio (?:expirado|congelado|suspenso)'
+        r'|(?:this )?domain (?:has )?expired'),
+    ('hosting placeholder', r'apache2 (?:ubuntu|debian) default page'
+        r'|welcome to nginx|future home of something quite cool'
+        r'|hospedagem (?:ativa|criada com sucesso)|^index of /'),
+]
+
+# keywords of the spam left on expired domains, which a page only
+# matches if they make up much of its text, as real municipality pages
+# may mention them, e.g. in the news
+SPAM_TEMPLATES = [
+    ('casino spam', r'cassino online|casino online|apostas esportivas|bet365'
+        r'|fortune tiger|jogo do tigrinho|caca-?niqueis'),
+]
+MIN_SPAM_HITS = 5
+MAX_WORDS_PER_SPAM_HIT = 100
+
+COMPILED_TEMPLATES = [(name, re.compile(pattern, re.MULTILINE))
+    for name, pattern in PARKING_TEMPLATES]
+COMPILED_SPAM_TEMPLATES = [(name, re.compile(pattern))
+    for name, pattern in SPAM_TEMPLATES]
+
+re_invisible = re.compile(
+    r'<(script|style|noscript|template)\b.*?</\1\s*>|<!--.*?-->',
+    re.IGNORECASE | re.DOTALL)
+re_tag = re.compile(r'<[^>]*>')
+re_word = re.compile(r'\w+')
+
+def page_text(content: str) -> str:
+    """Extracts the visible text of an HTML page.
+
+    Args:
+        content (str): The HTML of the page.
+
+    Returns:
+        str: The text, lowercased and without accents.
+    """
+    text = re_tag.sub(' ', re_invisible.sub(' ', content))
+    return unidecode(html.unescape(text)).lower()
+
+def simhash(text: str) -> Optional[int]:
+    """Computes the SimHash of a text from its word shingles.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        int: The 64 bit hash, or None if the text is too short to be
+            compared.
+    """
+    words = re_word.findall(text)[:MAX_WORDS]
+    if len(words) < MIN_WORDS:
+        return None
+    shingles = {' '.join(words[position:position + SHINGLE_SIZE])
+        for position in range(len(words) - SHINGLE_SIZE + 1)}
+    # a stable hash, the same in every process and machine
+    hashes = np.frombuffer(b''.join(
+        hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest()
+        for shingle in shingles), dtype=np.uint8).reshape(-1, 8)
+    votes = np.unpackbits(hashes, axis=1).sum(axis=0, dtype=np.int64)
+    return int.from_bytes(
+        np.packbits(votes * 2 > len(shingles)).tobytes(), 'big')
+
+def format_simhash(value: Optional[int]) -> Optional[str]:
+    """Formats a SimHash as 16 hexadecimal digits, which, unlike the
+    number, fits any CSV or JSON reader.
+    """
+    return None if value is None else f'{value:016x}'
+
+def hamming(first: int, second: int) -> int:
+    """Counts the bits that differ between two hashes."""
+    return bin(first ^ second).count('1')
+
+def parking_template(text: str) -> Optional[str]:
+    """Finds the parking or spam template a page matches. A spam
+    template is matched if its keywords appear at least MIN_SPAM_HITS
+    times, and at least once every MAX_WORDS_PER_SPAM_HIT words.
+
+    Args:
+        text (str): The text of the page, as returned by page_text.
+
+    Returns:
+        str: The name of the template, or None.
+    """
+    sample = text[:20000]
+    for name, expression in COMPILED_TEMPLATES:
+        if expression.search(sample):
+            return name
+    words = len(re_word.findall(sample))
+    for name, expression in COMPILED_SPAM_TEMPLATES:
+        hits = len(expression.findall(sample))
+        if hits >= MIN_SPAM_HITS and \
+                hits * MAX_WORDS_PER_SPAM_HIT >= words:
+            return name
+    return None
+
+def text_similarity(text: str) -> Dict[str, Optional[str]]:
+    """Computes the similarity columns of a page.
+
+    Args:
+        text (str): The text of the page, as returned by page_text.
+
+    Returns:
+        dict: The simhash and template of the page.
+    """
+    return {
+        'simhash': format_simhash(simhash(text)),
+        'template': parking_template(text),
+    }
+
+def response_similarity(response: requests.Response) -> Dict[str, Optional[str]]:
+    """Computes the similarity columns of a page fetched with requests.
+
+    Args:
+        response (requests.Response): The response.
+
+    Returns:
+        dict: The simhash and template of the page.
+    """
+    return text_similarity(page_text(decode_response(response)))
+
+class SimHashIndex:
+    """An index of hashes that clusters near duplicates as they are
+    added.
+
+    The 64 bits are split into max_distance + 1 bands, so two hashes
+    within max_distance bits of each other have at least one band in
+    common. Each bucket keeps only one hash per cluster, so clusters of
+    many identical pages do not make the buckets grow.
+
+    Args:
+        max_distance (int): Maximum number of differing bits for two
+            hashes to be in the same cluster.
+    """
+    def __init__(self, max_distance: int = MAX_DISTANCE):
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        bounds = [64 * band // bands for band in range(bands + 1)]
+        self.bands = [(start, (1 << (end - start)) - 1)
+            for start, end in zip(bounds, bounds[1:])]
+        self.buckets: List[Dict[int, List[int]]] = [{} for _ in self.bands]
+        self.hashes: List[int] = []
+        self.parents: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def find(self, item: int) -> int:
+        """Gets the cluster of an item.
+
+        Args:
+            item (int): The position of the item, in the order added.
+
+        Returns:
+            int: The position of the first item added to the cluster.
+        """
+        root = item
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[item] != root: # compress the path
+            self.parents[item], item = root, self.parents[item]
+        return root
+
+    def _union(self, first: int, second: int):
+        first, second = self.find(first), self.find(second)
+        if first != second:
+            self.parents[max(first, second)] = min(first, second)
+
+    def add(self, value: int) -> int:
+        """Adds a hash, joining it to the clusters of the hashes near it.
+
+        Args:
+            value (int): The hash.
+
+        Returns:
+            int: The position of the item.
+        """
+        item = len(self.hashes)
+        self.hashes.append(value)
+        self.parents.append(item)
+        for buckets, (start, mask) in zip(self.buckets, self.bands):
+            bucket = buckets.setdefault((value >> start) & mask, [])
+            matched = False
+            for other in bucket:
+                if hamming(value, self.hashes[other]) <= self.max_distance:
+                    self._union(item, other)
+                    matched = True
+            if not matched:
+                bucket.append(item)
+        return item
+
+def review_reasons(table: pd.DataFrame, code_column: str = 'municipality_code',
+    min_municipalities: int = MIN_MUNICIPALITIES) -> pd.DataFrame:
+    """Finds the rows of verified links that need review: pages matching
+    a parking template and pages near identical to the pages of other
+    municipalities.
+
+    Args:
+        table (pd.DataFrame): The verified links, with the similarity
+            columns.
+        code_column (str): The column with the municipality code.
+        min_municipalities (int): Number of municipalities sharing a page
+            for it to be suspicious.
+
+    Returns:
+        pd.DataFrame: The cluster (the url of its first page) and the
+            reason of each row that needs review, aligned with the table.
+    """
+    result = pd.DataFrame({'cluster': pd.Series(pd.NA, index=table.index,
+        dtype='string')})
+    result['reason'] = pd.Series(pd.NA, index=table.index, dtype='string')
+    hashed = table[table.simhash.notna()]
+    index = SimHashIndex()
+    for value in hashed.simhash:
+        index.add(int(value, 16))
+    roots = pd.Series([index.find(item) for item in range(len(index))],
+        index=hashed.index, dtype='int64')
+    municipalities = hashed[code_column].groupby(roots).transform('nunique')
+    shared = municipalities >= min_municipalities
+    result.loc[shared[shared].index, 'cluster'] = \
+        hashed.url.iloc[roots[shared]].to_numpy()
+    result.loc[shared[shared].index, 'reason'] = [
+        f'same page as in {count} municipalities'
+        for count in municipalities[shared]]
+    parked = table.template.notna()
+    result.loc[parked, 'reason'] = 'parked page: ' + table.template[parked]
+    return result
+
+def split_for_review(table: pd.DataFrame, code_column: str = 'municipality_code') \
+        -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Separates the verified links that need review from the others.
+
+    Args:
+        table (pd.DataFrame): The verified links, with the similarity
+            columns.
+        code_column (str): The column with the municipality code.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: The links that can be counted
+            as verified, without the similarity columns, and the links
+            that need review, with the cluster and reason columns.
+    """
+    for column in SIMILARITY_COLUMNS:
+        if column not in table.columns:
+            table = table.assign(**{column: pd.NA})
+    reasons = review_reasons(table, code_column)
+    needs_review = reasons.reason.notna()
+    if needs_review.any():
+        logging.warning('%d of %d verified links need review: %s.',
+            needs_review.sum(), len(table),
+            reasons.reason[needs_review].str.split(':').str[0]
+                .value_counts().to_dict())
+    return (
+        table[~needs_review].drop(columns=SIMILARITY_COLUMNS),
+        table[needs_review].join(reasons[needs_review]),
+    )
+
+def check_websites(data_package_path: str = DATA_PACKAGE_PATH,
+    max_simultaneous: int = MAX_SIMULTANEOUS) -> pd.DataFrame:
+    """Fetches the municipal websites of the websites resource and finds
+    the ones that need review.
+
+    Args:
+        data_package_path (str): Path to the valid data package.
+        max_simultaneous (int): Maximum number of simultaneous requests.
+
+    Returns:
+        pd.DataFrame: The websites that need review, with the cluster and
+            reason columns.
+    """
+    websites = get_output_to_be_merged(data_package_path)
+    websites = websites[websites.sphere == 'municipal']
+    scheduler = HostScheduler()
+
+    def similarity(url: str) -> Dict[str, Optional[str]]:
+        page = fetch_page(url, scheduler)
+        if page is None or page.status_code != 200:
+            return {column: None for column in SIMILARITY_COLUMNS}
+        return text_similarity(page_text(
+            decode(page.content, page.headers, page.final_url)))
+
+    with ThreadPoolExecutor(max_workers=max_simultaneous) as executor:
+        columns = pd.DataFrame(list(executor.map(similarity, websites.url)),
+            index=websites.index, columns=SIMILARITY_COLUMNS)
+    _, review = split_for_review(websites.join(columns))
+    return review
+
+def parse_cli() -> dict:
+    """Parses the command line interface.
+
+    Returns:
+        dict: A dict containing the values for data_package_path and
+            max_simultaneous.
+    """
+    parser = argparse.ArgumentParser(
+        description='Finds parked, spam and shared pages among the '
+            'municipal websites.')
+    parser.add_argument('data_package',
+        help='path to the valid data package',
+        default=DATA_PACKAGE_PATH,
+        nargs='?',
+    )
+    parser.add_argument('-p', '--processes',
+        metavar='int', type=int,
+        help='number of simultaneous requests',
+        default=MAX_SIMULTANEOUS,
+    )
+    args = parser.parse_args()
+    return {
+        'data_package_path': args.data_package,
+        'max_simultaneous': args.processes,
+    }
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_cli()
+    report = check_websites(**options)
+    print(report[['state_code', 'municipality', 'branch', 'url', 'cluster',
+        'reason']].to_csv(index=False))
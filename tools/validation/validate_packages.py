@@ -0,0 +1,347 @@
+"""
+This script validates the data packages listed in the data validation
+inquiry file (data/data-validation.yaml), in parallel and skipping the
+resources that have not changed since they were last validated.
+
+Usage:
+  python validate_packages.py
+
+For instructions use:
+  python validate_packages.py --help
+
+Este script valida os pacotes de dados listados no arquivo de
+validação (data/data-validation.yaml), em paralelo e pulando os
+recursos que não mudaram desde a última validação.
+"""
+
+import argparse
+import copy
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
+
+import pandas as pd
+import yaml
+from frictionless import Package, validate
+
+from harvest.download import file_hash
+
+ROOT_FOLDER = '../..'
+INQUIRY_FILE = 'data/data-validation.yaml'
+CACHE_FILE = 'data/download-cache/validation-cache.json'
+MAX_SIMULTANEOUS = os.cpu_count() or 1
+# the constraints that check_constraints checks, the others (e.g. unique
+# and pattern) are left to frictionless
+CHECKED_CONSTRAINTS = ['required', 'enum', 'minLength', 'maxLength',
+    'minimum', 'maximum']
+
+# a scheme followed by something without spaces, like the uri format
+# of frictionless
+re_uri = re.compile(r'^[a-z][a-z0-9+.-]*:(?://)?[^\s/?#]+[^\s]*$', re.IGNORECASE)
+
+def read_inquiry(inquiry_file: str, root_folder: str) -> List[str]:
+    """Reads the paths of the data packages from the inquiry file.
+
+    Args:
+        inquiry_file (str): Path to the inquiry file, relative to the
+            root folder.
+        root_folder (str): The root folder of the repository.
+
+    Returns:
+        List[str]: The paths to the datapackage.json files.
+    """
+    with open(os.path.join(root_folder, inquiry_file), 'r') as file:
+        inquiry = yaml.safe_load(file)
+    return [os.path.join(root_folder, task['path']) for task in inquiry['tasks']]
+
+def relax_schema(descriptor: dict) -> dict:
+    """Removes from a resource descriptor the field constraints and
+    formats that are checked by check_constraints, so that frictionless
+    only needs to check the types, keys, table structure and the other
+    constraints.
+
+    Args:
+        descriptor (dict): The resource descriptor.
+
+    Returns:
+        dict: A copy of the descriptor without those constraints.
+    """
+    descriptor = copy.deepcopy(descriptor)
+    for field in descriptor.get('schema', {}).get('fields', []):
+        constraints = field.get('constraints', {})
+        for constraint in CHECKED_CONSTRAINTS:
+            constraints.pop(constraint, None)
+        if not constraints:
+            field.pop('constraints', None)
+        if field.get('format') == 'uri':
+            field['format'] = 'default'
+    return descriptor
+
+def check_constraints(table: pd.DataFrame, fields: List[dict],
+    missing_values: List[str]) -> List[list]:
+    """Checks the required, enum, length, range and uri format
+    constraints of all the rows at once.
+
+    Args:
+        table (pd.DataFrame): The resource data, read as strings.
+        fields (List[dict]): The field descriptors of the schema.
+        missing_values (List[str]): The strings meaning missing values.
+
+    Returns:
+        List[list]: The errors found, as lists of row position, field
+            position, error code and message.
+    """
+    errors = []
+    def report(mask: pd.Series, field_position: int, code: str, message: str):
+        for index, value in table.loc[mask.fillna(False), name].items():
+            errors.append([
+                int(index) + 2, # header is row 1
+                field_position,
+                code,
+                message.format(value=value),
+            ])
+
+    for field_position, field in enumerate(fields, start=1):
+        name = field['name']
+        if name not in table.columns:
+            continue
+        column = table[name]
+        present = ~column.isin(missing_values)
+        constraints = field.get('constraints', {})
+        if constraints.get('required'):
+            report(~present, field_position, 'constraint-error',
+                f'field "{name}" is required')
+        if 'enum' in constraints:
+            report(present & ~column.isin([str(v) for v in constraints['enum']]),
+                field_position, 'constraint-error',
+                f'"{{value}}" of field "{name}" is not one of '
+                f'{constraints["enum"]}')
+        lengths = column.str.len()
+        if 'minLength' in constraints:
+            report(present & (lengths < constraints['minLength']),
+                field_position, 'constraint-error',
+                f'"{{value}}" of field "{name}" is shorter than '
+                f'{constraints["minLength"]}')
+        if 'maxLength' in constraints:
+            report(present & (lengths > constraints['maxLength']),
+                field_position, 'constraint-error',
+                f'"{{value}}" of field "{name}" is longer than '
+                f'{constraints["maxLength"]}')
+        if 'minimum' in constraints or 'maximum' in constraints:
+            numbers = pd.to_numeric(column.where(present), errors='coerce')
+            if 'minimum' in constraints:
+                report(numbers < constraints['minimum'], field_position,
+                    'constraint-error',
+                    f'"{{value}}" of field "{name}" is less than '
+                    f'{constraints["minimum"]}')
+            if 'maximum' in constraints:
+                report(numbers > constraints['maximum'], field_position,
+                    'constraint-error',
+                    f'"{{value}}" of field "{name}" is greater than '
+                    f'{constraints["maximum"]}')
+        if field.get('format') == 'uri':
+            report(present & ~column.str.match(re_uri), field_position,
+                'type-error',
+                f'"{{value}}" of field "{name}" is not a valid uri')
+    return errors
+
+def resource_key(package_path: str, resource_name: str) -> str:
+    """Computes a key that changes whenever the validation result of a
+    resource could change: when its data file, its descriptor or the data
+    files of the resources it refers to (through foreign keys) change.
+
+    Args:
+        package_path (str): Path to the datapackage.json file.
+        resource_name (str): The name of the resource.
+
+    Returns:
+        str: The key.
+    """
+    with open(package_path, 'r', encoding='utf-8') as file:
+        package = json.load(file)
+    resources = {resource['name']: resource for resource in package['resources']}
+    resource = resources[resource_name]
+    digest = hashlib.sha256(
+        json.dumps(resource, sort_keys=True).encode('utf-8'))
+    foreign_keys = resource.get('schema', {}).get('foreignKeys', []) + \
+        resource.get('foreignKeys', [])
+    referenced = [resource_name] + [
+        foreign_key['reference']['resource']
+        for foreign_key in foreign_keys
+        if foreign_key['reference'].get('resource')
+    ]
+    basepath = os.path.dirname(package_path)
+    for name in referenced:
+        digest.update(file_hash(
+            os.path.join(basepath, resources[name]['path'])).encode('ascii'))
+    return digest.hexdigest()
+
+def validate_resource(job: Tuple[str, str]) -> dict:
+    """Validates a single resource of a data package.
+
+    The field constraints are checked with vectorized operations by
+    check_constraints and frictionless checks the rest (types, primary
+    and foreign keys, table structure and the constraints that
+    check_constraints does not check, such as unique and pattern) with
+    those constraints removed.
+
+    Args:
+        job (Tuple[str, str]): Path to the datapackage.json file and the
+            name of the resource.
+
+    Returns:
+        dict: A dict with the keys package, resource, valid and errors.
+    """
+    package_path, resource_name = job
+    with open(package_path, 'r', encoding='utf-8') as file:
+        descriptor = json.load(file)
+    resource_descriptor = next(resource
+        for resource in descriptor['resources']
+        if resource['name'] == resource_name)
+    schema = resource_descriptor.get('schema', {})
+    missing_values = schema.get('missingValues', [''])
+
+    table = pd.read_csv(
+        os.path.join(os.path.dirname(package_path), resource_descriptor['path']),
+        dtype=str,
+        keep_default_na=False,
+    )
+    errors = check_constraints(table, schema.get('fields', []), missing_values)
+
+    relaxed = copy.deepcopy(descriptor)
+    relaxed['resources'] = [
+        relax_schema(resource) for resource in relaxed['resources']]
+    package = Package(relaxed, basepath=os.path.dirname(package_path))
+    report = validate(package.get_resource(resource_name))
+    errors.extend(report.flatten(
+        ['rowPosition', 'fieldPosition', 'code', 'message']))
+
+    return {
+        'package': package_path,
+        'resource': resource_name,
+        'valid': not errors,
+        'errors': sorted(errors, key=lambda error: (error[0] or 0, error[1] or 0)),
+    }
+
+def read_cache(cache_file: str) -> dict:
+    """Reads the cached validation results.
+
+    Args:
+        cache_file (str): Path to the cache file.
+
+    Returns:
+        dict: The cached results, by resource key.
+    """
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def write_cache(cache_file: str, cache: dict):
+    """Records the validation results atomically.
+
+    Args:
+        cache_file (str): Path to the cache file.
+        cache (dict): The results, by resource key.
+    """
+    pathlib.Path(os.path.dirname(cache_file)).mkdir(parents=True, exist_ok=True)
+    temporary = cache_file + '.part'
+    with open(temporary, 'w', encoding='utf-8') as file:
+        json.dump(cache, file)
+    os.replace(temporary, cache_file)
+
+def validate_packages(package_paths: List[str], cache_file: str = None,
+    max_simultaneous: int = MAX_SIMULTANEOUS) -> List[dict]:
+    """Validates all resources of the data packages, in parallel.
+
+    Args:
+        package_paths (List[str]): Paths to the datapackage.json files.
+        cache_file (str): Path to the cache file, or None to validate
+            every resource.
+        max_simultaneous (int): Maximum number of resources to validate
+            in parallel.
+
+    Returns:
+        List[dict]: The results for each resource, as returned by
+            validate_resource.
+    """
+    jobs = []
+    for package_path in package_paths:
+        with open(package_path, 'r', encoding='utf-8') as file:
+            descriptor = json.load(file)
+        jobs.extend((package_path, resource['name'])
+            for resource in descriptor['resources'])
+
+    cache = read_cache(cache_file) if cache_file else {}
+    keys = {job: resource_key(*job) for job in jobs}
+    results = {job: cache[keys[job]] for job in jobs if keys[job] in cache}
+    pending = [job for job in jobs if job not in results]
+    logging.info('Validating %d resources, %d unchanged.',
+        len(pending), len(results))
+
+    if pending:
+        with ProcessPoolExecutor(
+                max_workers=min(max_simultaneous, len(pending))) as executor:
+            for job, result in zip(pending, executor.map(validate_resource, pending)):
+                results[job] = result
+                cache[keys[job]] = result
+        if cache_file:
+            current = set(keys.values())
+            write_cache(cache_file,
+                {key: value for key, value in cache.items() if key in current})
+
+    return [results[job] for job in jobs]
+
+def parse_cli() -> dict:
+    """Parses the command line interface.
+
+    Returns:
+        dict: A dict containing the values for package_paths, cache_file
+            and max_simultaneous.
+    """
+    parser = argparse.ArgumentParser(
+        description='Validates the data packages listed in the inquiry file.')
+    parser.add_argument('inquiry',
+        help='inquiry file listing the data packages, relative to the root',
+        default=INQUIRY_FILE,
+        nargs='?',
+    )
+    parser.add_argument('-r', '--root',
+        help='root folder of the repository',
+        default=ROOT_FOLDER,
+    )
+    parser.add_argument('-p', '--processes',
+        metavar='int', type=int,
+        help='number of resources to validate in parallel',
+        default=MAX_SIMULTANEOUS,
+    )
+    parser.add_argument('--no-cache',
+        help='validate all resources, even if unchanged',
+        action='store_true',
+    )
+    args = parser.parse_args()
+    return {
+        'package_paths': read_inquiry(args.inquiry, args.root),
+        'cache_file': None if args.no_cache \
+            else os.path.join(args.root, CACHE_FILE),
+        'max_simultaneous': args.processes,
+    }
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_cli()
+    all_valid = True
+    for result in validate_packages(**options):
+        status = 'valid' if result['valid'] else 'INVALID'
+        print(f'{result["package"]} {result["resource"]}: {status}')
+        for row, field, code, message in result['errors']:
+            print(f'  row {row}, field {field}, {code}: {message}')
+        all_valid = all_valid and result['valid']
+    sys.exit(0 if all_valid else 1)
@@ -1,9 +1,10 @@
 """Common code for link verification scripts in data validation.
 """
+from datetime import datetime
 import logging
 import random
 import re
-from typing import Tuple
+from typing import Iterator, List, Optional, Sequence, Tuple
 
 import requests
 import pandas as pd
@@ -12,32 +13,67 @@ from unidecode import unidecode
 from frictionless import Package
 
 from settings import USER_AGENT, DEFAULT_TIMEOUT as TIMEOUT
+from crawling import robots, warc
+from crawling.charset import decode_response
+from crawling.politeness import HostScheduler
+from storage.candidates import count_city_links, iter_city_links, READ_DTYPES
+from storage.writer import write_resource
 
 WEBSITE_RESOURCE_NAME = 'brazilian-municipality-and-state-websites'
 
-def healthy_link(link: str) -> requests.Response:
-    """Check whether or not the link is healthy.
+# links are checked one at a time in each process, only the crawl-delay
+# asked for by robots.txt spaces them out, among the processes through
+# the shared robots.txt cache (see robots.wait_turn)
+SCHEDULER = HostScheduler(min_delay=0)
+
+def healthy_link(link: str, checks: Optional[List[dict]] = None) \
+    -> requests.Response:
+    """Check whether or not the link is healthy. Links disallowed by the
+    robots.txt file of their site are not requested, nor are those of a
+    site that could not be reached for its robots.txt file. The response is
+    captured in, or replayed from, a WARC archive if crawling.warc is so
+    configured.
 
     Args:
         link (str): The url of the link to be verified.
+        checks (List[dict]): Optional list to add a record of the check
+            to, for the health history (see storage.health). Replayed
+            responses are not checks and are not recorded.
 
     Returns:
         requests.Response: The Response object in case the link
             is healthy, None otherwise.
     """
-    try:
-        response = requests.get(
-            link,
-            headers={'user-agent': USER_AGENT},
-            timeout=TIMEOUT
-            )
-    except (
-        requests.exceptions.ConnectionError,
-        requests.exceptions.InvalidURL,
-        requests.exceptions.TooManyRedirects,
-        requests.exceptions.ReadTimeout
-    ):
-        return None
+    if warc.replaying():
+        response = warc.replay(link)
+    else:
+        check = {'url': link, 'time': datetime.utcnow(), 'status': 0,
+            'latency': None, 'final_url': None, 'classification': None}
+        if not robots.allowed(link, SCHEDULER):
+            if checks is not None and not robots.reachable(link):
+                checks.append(check) # a failed check, as unreachable
+            return None
+        if checks is not None:
+            checks.append(check)
+        try:
+            with SCHEDULER.slot(link):
+                robots.wait_turn(link)
+                response = requests.get(
+                    link,
+                    headers={'user-agent': USER_AGENT},
+                    timeout=TIMEOUT
+                    )
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.InvalidURL,
+            requests.exceptions.TooManyRedirects,
+            requests.exceptions.ReadTimeout
+        ):
+            return None
+        check.update(status=response.status_code, final_url=response.url,
+            latency=sum((hop.elapsed for hop in response.history),
+                response.elapsed).total_seconds())
+        warc.record(response)
     if response and response.status_code == 200:
         return response
     return None
@@ -56,7 +92,7 @@ def get_title_and_type(
     Returns:
         Tuple[str, str]: The page title and link type category.
     """
-    soup = BeautifulSoup(response.text, 'html.parser')
+    soup = BeautifulSoup(decode_response(response), 'html.parser')
     title_tag = soup.find('title')
     if title_tag is None:
         return None, None
@@ -88,25 +124,103 @@ def get_title_and_type(
         link_type = None
     return title_tag.text, link_type
 
-def get_candidate_links(file_path: str, max_quantity: int) -> pd.DataFrame:
-    """Reads the csv table containing the candidate links.
+def parse_shard(text: str) -> Tuple[int, int]:
+    """Parses a shard selection in the form "i/n".
+
+    Args:
+        text (str): The shard selection, e.g. "2/4" for the second of
+            four shards.
+
+    Returns:
+        Tuple[int, int]: The shard number, from 1 to n, and the number
+            of shards.
+    """
+    try:
+        number, count = (int(part) for part in text.split('/'))
+    except ValueError as error:
+        raise ValueError(f'Invalid shard "{text}", use i/n.') from error
+    if not 1 <= number <= count:
+        raise ValueError(f'Invalid shard "{text}", i must be from 1 to n.')
+    return number, count
+
+def select_candidate_cities(file_path: str, max_quantity: int,
+    states: Optional[Sequence[str]] = None,
+    shard: Optional[Tuple[int, int]] = None) -> pd.Series:
+    """Selects the municipalities whose candidate links are to be
+    verified, reading only the code and state columns of the file.
+
+    Args:
+        file_path (str): The path to the csv file.
+        max_quantity (int): The maximum number of municipalities. If
+            `None` or 0, selects all of them. If less than the number of
+            municipalities in the file, selects a random sample.
+        states (Sequence[str]): Optional state abbreviations to select
+            the municipalities of.
+        shard (Tuple[int, int]): Optional shard number and number of
+            shards to select the municipalities of.
+
+    Returns:
+        pd.Series: The number of candidate links of each selected
+            municipality, indexed by code, in the order of the file.
+    """
+    counts = count_city_links(file_path, states, shard)
+    logging.info('Found %d websites of %d cities in %s.',
+        counts.sum(), len(counts), file_path)
+    if max_quantity and max_quantity < len(counts):
+        codes = counts.index.tolist()
+        sample = set(random.sample(codes, max_quantity)) # quicker processing
+        counts = counts[counts.index.isin(sample)]
+    return counts
+
+def iter_candidate_links(file_path: str, max_quantity: int,
+    states: Optional[Sequence[str]] = None,
+    shard: Optional[Tuple[int, int]] = None) \
+        -> Iterator[Tuple[int, pd.DataFrame]]:
+    """Streams the candidate links of the selected municipalities, one
+    municipality at a time, without reading the whole file in memory.
 
     Args:
         file_path (str): The path to the csv file.
-        max_quantity (int): The maximum number of entries to read. If
-            `None`, returns all the data. If less than the number of
-            entries in the file, selects a sample of this site.
+        max_quantity (int): The maximum number of municipalities, as in
+            select_candidate_cities.
+        states (Sequence[str]): Optional state abbreviations to select
+            the municipalities of.
+        shard (Tuple[int, int]): Optional shard number and number of
+            shards to select the municipalities of.
+
+    Yields:
+        Tuple[int, pd.DataFrame]: The code and the candidate links of
+            each municipality.
+    """
+    counts = select_candidate_cities(file_path, max_quantity, states, shard)
+    yield from iter_city_links(file_path, counts, states)
+
+def get_candidate_links(file_path: str, max_quantity: int,
+    states: Optional[Sequence[str]] = None,
+    shard: Optional[Tuple[int, int]] = None) -> pd.DataFrame:
+    """Reads the candidate links of the selected municipalities.
+
+    Args:
+        file_path (str): The path to the csv file.
+        max_quantity (int): The maximum number of municipalities, as in
+            select_candidate_cities.
+        states (Sequence[str]): Optional state abbreviations to select
+            the municipalities of.
+        shard (Tuple[int, int]): Optional shard number and number of
+            shards to select the municipalities of.
 
     Returns:
         pd.DataFrame: The Pandas dataframe containing the read table.
     """
-    candidates = pd.read_csv(file_path)
-    logging.info('Found %d websites in %s.', len(candidates), file_path)
-    codes = candidates.code.unique()
-    random.shuffle(codes) # randomize sequence
-    if max_quantity:
-        codes = codes[:max_quantity] # take a subsample for quicker processing
-    return candidates[candidates.code.isin(codes)]
+    cities = [links for _, links in iter_candidate_links(
+        file_path, max_quantity, states, shard)]
+    if not cities:
+        return pd.DataFrame({column: pd.Series(dtype=dtype)
+            for column, dtype in READ_DTYPES.items()})
+    candidates = pd.concat(cities)
+    for column, dtype in READ_DTYPES.items(): # categories differ by chunk
+        candidates[column] = candidates[column].astype(dtype)
+    return candidates
 
 def get_output_to_be_merged(data_package_path: str) -> pd.DataFrame:
     """Gets the dataframe for merging the output with.
@@ -119,7 +233,9 @@ def get_output_to_be_merged(data_package_path: str) -> pd.DataFrame:
     """
     package = Package(data_package_path)
     resource = package.get_resource(WEBSITE_RESOURCE_NAME)
-    return resource.to_pandas()
+    table = resource.to_pandas()
+    # frictionless may set the primary key as the index
+    return table.reset_index() if any(table.index.names) else table
 
 def store_csv(table: pd.DataFrame, data_package_path: str):
     """Stores the csv file in the output folder.
@@ -128,9 +244,6 @@ def store_csv(table: pd.DataFrame, data_package_path: str):
         table (pd.DataFrame): The dataframe containing the data.
         data_package_path (str): Path to the data package.
     """
-    package = Package(data_package_path)
-    resource = package.get_resource(WEBSITE_RESOURCE_NAME)
-    output = resource.fullpath # filename of csv to write
-    logging.info('Recording %s...', output)
-    # store the file
-    table.to_csv(output, index=False, date_format='%Y-%m-%dT%H:%M:%SZ')
+    logging.info('Recording %s...', WEBSITE_RESOURCE_NAME)
+    # store the file, replacing it atomically if it changed
+    write_resource(table, data_package_path, WEBSITE_RESOURCE_NAME)